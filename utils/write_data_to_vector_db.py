@@ -1,6 +1,16 @@
+"""Builds and queries the Chroma collection of MedQuAD Q/A pairs."""
+import argparse
+import hashlib
 import os
 import csv
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import chromadb
+import numpy as np
 from dotenv import load_dotenv
 
 from langchain.embeddings.openai import OpenAIEmbeddings
@@ -12,7 +22,17 @@ PERSIST_DIRECTORY = "../vector_db"
 ABS_PATH = os.path.dirname(os.path.abspath(__file__))
 DB_DIR = os.path.join(ABS_PATH, PERSIST_DIRECTORY)
 CONDITIONS = "conditions"
+EMBEDDING_CACHE_DIR = os.path.join(ABS_PATH, "../embedding_cache")
+LEXICAL_INDEX_DIR = os.path.join(ABS_PATH, "../lexical_index")
+VECTOR_INDEX_DIR = os.path.join(ABS_PATH, "../vector_index")
+CSV_PATH = os.path.join(ABS_PATH, "../clean_data/ProcessedData.csv")
+CHECKPOINT_FILE = os.path.join(DB_DIR, "ingest_checkpoint.json")
 
+# The embedding cache lives in the web app so both sides share one store.
+sys.path.append(os.path.join(ABS_PATH, "../webapp"))
+from app.chatbot.embedding_cache import CachedEmbeddings  # noqa: E402
+from app.chatbot.lexical_index import BM25Index  # noqa: E402
+from app.chatbot.vector_index import CENTROIDS_FILE, NumpyVectorIndex  # noqa: E402
 
 settings = chromadb.config.Settings(
     chroma_db_impl="duckdb+parquet",
@@ -25,36 +45,291 @@ def get_client():
     return chromadb.Client(settings=settings)
 
 
-def create_health_conditions_qa_db():
-    EMBEDDINGS = OpenAIEmbeddings()
-    docs = []
-    with open("../clean_data/ProcessedData.csv") as csv_file:
+def get_embeddings():
+    return CachedEmbeddings(OpenAIEmbeddings(), EMBEDDING_CACHE_DIR)
+
+
+def document_id(focus, question):
+    """Stable id of a Q/A pair, independent of its position in the CSV."""
+    return hashlib.sha1(f"{focus}\0{question}".encode()).hexdigest()
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def iter_documents(csv_path=CSV_PATH, start_row=0):
+    """Yield (id, Document) per Q/A row, skipping the first ``start_row`` rows."""
+    seen = {}
+    with open(csv_path) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=",")
+        row_number = 0
         for row in csv_reader:
             question, answer, focus = row
             if question == "Questions":
                 # skip header
                 continue
+            row_number += 1
+            doc_id = document_id(focus, question)
+            # MedQuAD repeats some (focus, question) pairs across files.
+            occurrence = seen.get(doc_id, 0)
+            seen[doc_id] = occurrence + 1
+            if occurrence:
+                doc_id = f"{doc_id}-{occurrence}"
+            if row_number <= start_row:
+                continue
             text = f"{question}\n{answer}"
-            doc = Document(
-                page_content=text, metadata={"focus": focus, "question": question}
+            yield doc_id, Document(
+                page_content=text,
+                metadata={
+                    "focus": focus,
+                    "question": question,
+                    "content_hash": content_hash(text),
+                },
             )
-            docs.append(doc)
 
-    db = Chroma(
+
+def iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def embed_and_write(batches, embeddings, write, concurrency):
+    """Embed up to ``concurrency`` batches at once and write them in order.
+
+    ``write`` is called with the batch, its vectors, the seconds spent
+    embedding it and the 1-based batch number.
+    """
+
+    def embed(batch):
+        start = time.perf_counter()
+        vectors = embeddings.embed_documents([doc.page_content for _, doc in batch])
+        return vectors, time.perf_counter() - start
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for batch_number, batch in enumerate(batches, start=1):
+            pending.append((batch, pool.submit(embed, batch), batch_number))
+            if len(pending) >= concurrency:
+                batch, future, number = pending.popleft()
+                write(batch, *future.result(), number)
+        while pending:
+            batch, future, number = pending.popleft()
+            write(batch, *future.result(), number)
+
+
+def print_throughput(batch_number, rows, batch, embed_seconds, started):
+    elapsed = time.perf_counter() - started
+    print(
+        f"Batch {batch_number}: {rows} rows, "
+        f"{rows / elapsed:.1f} docs/s, "
+        f"{len(batch) / embed_seconds:.1f} embeddings/s"
+    )
+
+
+def load_checkpoint(collection):
+    """Return the number of CSV rows already stored in ``collection``."""
+    if not os.path.exists(CHECKPOINT_FILE):
+        return 0
+    with open(CHECKPOINT_FILE) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint["documents"] != collection.count():
+        print("Checkpoint does not match the collection, starting over")
+        return 0
+    return checkpoint["rows"]
+
+
+def save_checkpoint(rows, documents):
+    with open(CHECKPOINT_FILE, "w") as checkpoint_file:
+        json.dump({"rows": rows, "documents": documents}, checkpoint_file)
+
+
+def write_lexical_index(collection):
+    """Rebuild the BM25 index so it matches the collection."""
+    started = time.perf_counter()
+    index = BM25Index.from_chroma(collection)
+    index.save(LEXICAL_INDEX_DIR)
+    print(
+        f"Lexical index: {len(index)} documents, {len(index.terms)} terms "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+
+def write_vector_index(collection):
+    """Rebuild the NumPy index, keeping the cluster count of the old one."""
+    started = time.perf_counter()
+    clusters = 0
+    centroids_path = os.path.join(VECTOR_INDEX_DIR, CENTROIDS_FILE)
+    if os.path.exists(centroids_path):
+        clusters = len(np.load(centroids_path, mmap_mode="r"))
+    index = NumpyVectorIndex.from_chroma(collection, embedding=None)
+    if clusters:
+        index.build_clusters(clusters)
+    index.save(VECTOR_INDEX_DIR)
+    print(
+        f"Vector index: {len(index)} documents, {clusters} clusters "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+
+def write_indexes(collection):
+    """Rebuild the indexes the web app searches instead of Chroma."""
+    write_lexical_index(collection)
+    write_vector_index(collection)
+
+
+def stored_ids(collection):
+    return set(collection.get(include=[])["ids"])
+
+
+def get_conditions_db(embeddings):
+    return Chroma(
         collection_name=CONDITIONS,
-        embedding_function=EMBEDDINGS,
+        embedding_function=embeddings,
         client_settings=settings,
         persist_directory=DB_DIR,
     )
-    db.add_documents(documents=docs, embedding=EMBEDDINGS)
+
+
+def create_health_conditions_qa_db(
+    batch_size=64, concurrency=4, checkpoint_every=10, resume=True, csv_path=CSV_PATH
+):
+    """Embed and store the CSV in batches, persisting a checkpoint as it goes.
+
+    Up to ``concurrency`` batches are embedded at once while finished batches
+    are written in order. Rerunning after an interruption resumes from the
+    last persisted checkpoint, and rows already in the collection are never
+    embedded or added again. Without ``resume`` the collection is emptied
+    first.
+    """
+    EMBEDDINGS = get_embeddings()
+    db = get_conditions_db(EMBEDDINGS)
+    if resume:
+        rows_done = load_checkpoint(db._collection)
+        existing = stored_ids(db._collection)
+    else:
+        db.delete_collection()
+        # Each Chroma instance opens its own client on the parquet files.
+        db.persist()
+        db = get_conditions_db(EMBEDDINGS)
+        rows_done, existing = 0, set()
+    if rows_done:
+        print(f"Resuming after {rows_done} rows")
+    first_row = rows_done
+
+    def new_documents():
+        # Skipped rows do not count towards rows_done, so a checkpoint may
+        # start a resume early, where they are skipped again, never late.
+        for doc_id, doc in iter_documents(csv_path, start_row=rows_done):
+            if doc_id not in existing:
+                yield doc_id, doc
+
+    def write(batch, vectors, embed_seconds, batch_number):
+        nonlocal rows_done
+        db._collection.add(
+            ids=[doc_id for doc_id, _ in batch],
+            embeddings=vectors,
+            metadatas=[doc.metadata for _, doc in batch],
+            documents=[doc.page_content for _, doc in batch],
+        )
+        rows_done += len(batch)
+        if batch_number % checkpoint_every == 0:
+            db.persist()
+            save_checkpoint(rows_done, db._collection.count())
+        print_throughput(
+            batch_number, rows_done - first_row, batch, embed_seconds, started
+        )
+
+    started = time.perf_counter()
+    batches = iter_batches(new_documents(), batch_size)
+    embed_and_write(batches, EMBEDDINGS, write, concurrency)
+
     db.persist()
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+    write_indexes(db._collection)
+    print("Embedding cache:", EMBEDDINGS.stats())
+
+    return db
+
+
+def update_health_conditions_qa_db(batch_size=64, concurrency=4, csv_path=CSV_PATH):
+    """Sync the collection with the CSV, re-embedding only what changed.
+
+    Rows are matched by their stable id; a row is re-embedded only when its
+    content hash differs from the stored one. Ids missing from the CSV are
+    deleted. The lexical and NumPy indexes are rebuilt afterwards.
+    """
+    EMBEDDINGS = get_embeddings()
+    db = get_conditions_db(EMBEDDINGS)
+    started = time.perf_counter()
+    stored = db._collection.get(include=["metadatas"])
+    stored_hashes = {
+        doc_id: (metadata or {}).get("content_hash")
+        for doc_id, metadata in zip(stored["ids"], stored["metadatas"])
+    }
+
+    seen = set()
+    counts = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
 
+    def changed_documents():
+        for doc_id, doc in iter_documents(csv_path):
+            seen.add(doc_id)
+            if doc_id not in stored_hashes:
+                counts["added"] += 1
+                yield doc_id, doc
+            elif stored_hashes[doc_id] != doc.metadata["content_hash"]:
+                counts["updated"] += 1
+                yield doc_id, doc
+            else:
+                counts["unchanged"] += 1
+
+    rows_done = 0
+
+    def write(batch, vectors, embed_seconds, batch_number):
+        nonlocal rows_done
+        new = [i for i, (doc_id, _) in enumerate(batch) if doc_id not in stored_hashes]
+        old = [i for i, (doc_id, _) in enumerate(batch) if doc_id in stored_hashes]
+        for indexes, method in (
+            (new, db._collection.add),
+            (old, db._collection.update),
+        ):
+            if indexes:
+                method(
+                    ids=[batch[i][0] for i in indexes],
+                    embeddings=[vectors[i] for i in indexes],
+                    metadatas=[batch[i][1].metadata for i in indexes],
+                    documents=[batch[i][1].page_content for i in indexes],
+                )
+        rows_done += len(batch)
+        print_throughput(batch_number, rows_done, batch, embed_seconds, started)
+
+    batches = iter_batches(changed_documents(), batch_size)
+    embed_and_write(batches, EMBEDDINGS, write, concurrency)
+
+    deleted = [doc_id for doc_id in stored_hashes if doc_id not in seen]
+    if deleted:
+        db._collection.delete(ids=deleted)
+    counts["deleted"] = len(deleted)
+    db.persist()
+    write_indexes(db._collection)
+    print(
+        "Added {added}, updated {updated}, deleted {deleted}, "
+        "unchanged {unchanged}".format(**counts),
+        f"in {time.perf_counter() - started:.2f}s",
+    )
+    print("Embedding cache:", EMBEDDINGS.stats())
     return db
 
 
 def get_health_conditions_qa_db(client):
-    EMBEDDINGS = OpenAIEmbeddings()
+    EMBEDDINGS = get_embeddings()
     collections = [col.name for col in client.list_collections()]
     if CONDITIONS in collections:
         return Chroma(
@@ -79,7 +354,44 @@ def retreiver(client, inp):
     return docs
 
 
-if __name__ == "__main__":
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+    ingest = subparsers.add_parser("ingest", help="Embed ProcessedData.csv")
+    ingest.add_argument("--csv", default=CSV_PATH)
+    ingest.add_argument("--batch-size", type=int, default=64)
+    ingest.add_argument("--concurrency", type=int, default=4)
+    ingest.add_argument("--checkpoint-every", type=int, default=10)
+    ingest.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Empty the collection and embed every row again",
+    )
+    update = subparsers.add_parser(
+        "update", help="Re-embed only rows that changed in ProcessedData.csv"
+    )
+    update.add_argument("--csv", default=CSV_PATH)
+    update.add_argument("--batch-size", type=int, default=64)
+    update.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        create_health_conditions_qa_db(
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            checkpoint_every=args.checkpoint_every,
+            resume=not args.no_resume,
+            csv_path=args.csv,
+        )
+        return
+    if args.command == "update":
+        update_health_conditions_qa_db(
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            csv_path=args.csv,
+        )
+        return
+
     # client = get_client()
     # time.sleep(5)
     text = """Back of my neck is hurting.
@@ -98,3 +410,7 @@ if __name__ == "__main__":
         print(doc.metadata["focus"])
         print(doc.page_content)
         print("=========================")
+
+
+if __name__ == "__main__":
+    main()
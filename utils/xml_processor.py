@@ -1,48 +1,58 @@
 # This code is heavily based on this notebook: https://github.com/mahesh-keswani/med-quad-mlm-bert/blob/main/ProcessData.ipynb
+"""Converts the MedQuAD XML files into clean_data/ProcessedData.csv."""
 
-import json
+import argparse
+import csv
 import os
-import xmltodict
 import re
 import time
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
 
 import git
-import pandas as pd
-from jsonpath import jsonpath
 
 
 BASE_PATH = "../clean_data"
 RAW_DATA_PATH = "../raw_data"
 MEDQUAD_REPO_URL = 'git@github.com:abachaa/MedQuAD.git'
-data = {"Questions": [], "Answers": [], "Focus": []}
+CSV_HEADER = ["Questions", "Answers", "Focus"]
+
+
+def clean_answer(answer):
+    # remove the extra spaces from answer with single space
+    x = re.sub(" +", " ", answer)
+    x = re.sub("Key Points", "", x)
+    return x.replace("\n", "").replace("-", "")
 
 
 def processXmlFile(completePath):
-    with open(completePath) as f:
-        xmlstring = f.read()
-        try:
-            dataDict = xmltodict.parse(xmlstring, xml_attribs=False)
-            listOfQA = json.loads(json.dumps(jsonpath(dataDict, "$.." + "QAPair")[0]))
-            focus = json.loads(json.dumps(jsonpath(dataDict, "$.." + "Focus")[0]))
-        except Exception as e:
-            # i.e either QAPair is empty OR Focus
-            return
-
-        # if there is only single QA, then it will be dict instead of list
-        if isinstance(listOfQA, dict):
-            listOfQA = [listOfQA]
-
-        for qaPair in listOfQA:
-            try:
-                # remove the extra spaces from answer with single space
-                x = re.sub(" +", " ", qaPair["Answer"])
-                x = re.sub("Key Points", "", x)
-                x = x.replace("\n", "").replace("-", "")
-                data["Answers"].append(x)
-                data["Questions"].append(qaPair["Question"])
-                data["Focus"].append(focus)
-            except:
-                return
+    """Return (question, answer, focus) rows of a single MedQuAD document.
+
+    Only the Focus and QAPair elements are looked at; everything else is
+    discarded as soon as it has been parsed. Pairs with a blank answer are
+    skipped.
+    """
+    rows = []
+    focus = None
+    try:
+        for _, elem in ET.iterparse(completePath, events=("end",)):
+            if elem.tag == "Focus" and focus is None:
+                focus = (elem.text or "").strip()
+            elif elem.tag == "QAPair":
+                question = elem.findtext("Question")
+                answer = elem.findtext("Answer")
+                if focus is None or question is None:
+                    # i.e either QAPair is empty OR Focus
+                    break
+                answer = clean_answer(answer or "").strip()
+                if answer:
+                    # Some collections ship questions without their answers.
+                    rows.append((question.strip(), answer, focus))
+                elem.clear()
+    except ET.ParseError:
+        return rows
+    return rows
+
 
 def download_med_qa_dataset():
     if os.path.exists(RAW_DATA_PATH):
@@ -64,22 +74,56 @@ foldersWithEmptyAnswers = [
     "ProcessedData.csv",
 ]
 
-download_med_qa_dataset()
 
-for folder in os.listdir(RAW_DATA_PATH):
-    if folder in foldersWithEmptyAnswers:
-        continue
-    else:
-        print("Processing folder:", folder)
-        start = time.time()
-
-        for xmlFileName in os.listdir(os.path.join(RAW_DATA_PATH, folder)):
-            completePath = os.path.join(RAW_DATA_PATH, folder, xmlFileName)
-            processXmlFile(completePath)
-
-        print("Took", time.time() - start)
+def process_dataset(raw_data_path, output_path, workers=None, chunksize=16):
+    """Parse every folder on a process pool and stream rows into the CSV."""
+    total_start = time.time()
+    total_rows = 0
+    with open(output_path, "w", newline="") as csv_file, Pool(workers) as pool:
+        writer = csv.writer(csv_file, lineterminator="\n")
+        writer.writerow(CSV_HEADER)
+        for folder in sorted(os.listdir(raw_data_path)):
+            if folder in foldersWithEmptyAnswers:
+                continue
+            print("Processing folder:", folder)
+            start = time.time()
+            folder_path = os.path.join(raw_data_path, folder)
+            paths = [
+                os.path.join(folder_path, xmlFileName)
+                for xmlFileName in sorted(os.listdir(folder_path))
+            ]
+            folder_rows = 0
+            for rows in pool.imap(processXmlFile, paths, chunksize=chunksize):
+                writer.writerows(rows)
+                folder_rows += len(rows)
+            total_rows += folder_rows
+            print(
+                f"Took {time.time() - start:.2f}s for {len(paths)} files, "
+                f"{folder_rows} rows"
+            )
+    print(f"Wrote {total_rows} rows in {time.time() - total_start:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--raw-data", default=RAW_DATA_PATH)
+    parser.add_argument(
+        "--output", default=os.path.join(BASE_PATH, "ProcessedData.csv")
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Defaults to the CPU count"
+    )
+    parser.add_argument(
+        "--download",
+        action="store_true",
+        help="Clone MedQuAD into --raw-data before processing",
+    )
+    args = parser.parse_args()
+
+    if args.download:
+        download_med_qa_dataset()
+    process_dataset(args.raw_data, args.output, workers=args.workers)
 
 
-df = pd.DataFrame(data)
-df.head()
-df.to_csv(BASE_PATH + "/ProcessedData.csv", index=False)
+if __name__ == "__main__":
+    main()
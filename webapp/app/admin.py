@@ -5,7 +5,9 @@ from .models import Appointment
 @admin.register(Appointment)
 class AppointmentAdmin(admin.ModelAdmin):
     list_display = ("name", "date", "time", "description", "created_at")
-    list_filter = ("name", "date", "time", "description", "created_at")
-    search_fields = ("name", "date", "time", "description", "created_at")
-    ordering = ("name", "date", "time", "description", "created_at")
+    # Filters over name or description list every distinct value.
+    list_filter = ("date", "created_at")
+    search_fields = ("name", "description")
+    # Served by appointment_slot_idx.
+    ordering = ("date", "time")
     date_hierarchy = "date"
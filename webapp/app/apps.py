@@ -4,3 +4,6 @@ from django.apps import AppConfig as Config
 class AppConfig(Config):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,189 @@
+"""Admission control for chat turns: rate limits and a fair concurrency cap."""
+import asyncio
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable, Optional
+
+from django.conf import settings
+
+from .metrics import Histogram
+from .timing import StageTimer
+
+
+class TokenBucket:
+    """Allows ``rate`` messages per second on average, in bursts of ``burst``."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionController:
+    """Decides which chat turns run, shared by all consumers of the process.
+
+    ``allow`` applies a per-user token bucket. ``slot`` caps the number of
+    turns calling the LLM at once; waiting turns are granted round robin
+    across users, so one user's backlog cannot starve everybody else.
+    Consumers report their own queued messages through ``session_queued``.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        rate_per_minute: float = 0,
+        burst: int = 1,
+        max_users: int = 10000,
+    ):
+        self.max_concurrent = max_concurrent
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_users = max_users
+        self.active = 0
+        self.session_queued = 0
+        self.rejected: Dict[str, int] = defaultdict(int)
+        self.wait = Histogram()
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._waiters: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._waiters.values())
+
+    def allow(self, user: Hashable) -> bool:
+        """Take a token from the user's bucket; False means rate limited."""
+        if not self.rate:
+            return True
+        bucket = self._buckets.pop(user, None) or TokenBucket(self.rate, self.burst)
+        self._buckets[user] = bucket
+        if len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        if bucket.try_acquire():
+            return True
+        self.reject("rate_limit")
+        return False
+
+    def reject(self, reason: str) -> None:
+        self.rejected[reason] += 1
+
+    @asynccontextmanager
+    async def slot(self, user: Hashable, timer: Optional[StageTimer] = None):
+        """Hold one of the ``max_concurrent`` slots for the duration of a turn."""
+        start = time.perf_counter()
+        await self._acquire(user)
+        waited = time.perf_counter() - start
+        self.wait.observe(waited)
+        if timer is not None:
+            timer.add("admission_wait", waited)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, user: Hashable) -> None:
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._discard(user, future)
+            else:
+                # The slot was granted just before the turn was cancelled.
+                self._release()
+            raise
+
+    def _discard(self, user: Hashable, future: asyncio.Future) -> None:
+        queue = self._waiters.get(user)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self._waiters[user]
+
+    def _release(self) -> None:
+        self.active -= 1
+        while self._waiters and self.active < self.max_concurrent:
+            user, queue = self._waiters.popitem(last=False)
+            future = queue.popleft()
+            if queue:
+                # Round robin: the user's next turn goes to the back of the line.
+                self._waiters[user] = queue
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_admission_active Turns holding an LLM slot.",
+            "# TYPE chatbot_admission_active gauge",
+            f"chatbot_admission_active {self.active}",
+            "# HELP chatbot_admission_limit Maximum number of turns holding an LLM slot.",
+            "# TYPE chatbot_admission_limit gauge",
+            f"chatbot_admission_limit {self.max_concurrent}",
+            "# HELP chatbot_admission_queue_depth Turns waiting for an LLM slot.",
+            "# TYPE chatbot_admission_queue_depth gauge",
+            f"chatbot_admission_queue_depth {self.waiting}",
+            "# HELP chatbot_admission_queued_users Users with turns waiting for an LLM slot.",
+            "# TYPE chatbot_admission_queued_users gauge",
+            f"chatbot_admission_queued_users {len(self._waiters)}",
+            "# HELP chatbot_session_queue_depth Messages waiting behind a reply of their chat box.",
+            "# TYPE chatbot_session_queue_depth gauge",
+            f"chatbot_session_queue_depth {self.session_queued}",
+            "# HELP chatbot_admission_rejected_total Messages rejected, by reason.",
+            "# TYPE chatbot_admission_rejected_total counter",
+        ]
+        lines += [
+            f'chatbot_admission_rejected_total{{reason="{reason}"}} {count}'
+            for reason, count in sorted(self.rejected.items())
+        ]
+        lines += [
+            "# HELP chatbot_admission_wait_seconds Time turns waited for an LLM slot.",
+            "# TYPE chatbot_admission_wait_seconds histogram",
+        ]
+        lines += self.wait.render("chatbot_admission_wait_seconds", 'scope="process"')
+        return "\n".join(lines) + "\n"
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission() -> AdmissionController:
+    """Return the process-wide admission controller, creating it on first use."""
+    global _admission
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                _admission = AdmissionController(
+                    max_concurrent=settings.CHATBOT_MAX_CONCURRENT_TURNS,
+                    rate_per_minute=settings.CHATBOT_RATE_LIMIT_PER_MINUTE,
+                    burst=settings.CHATBOT_RATE_LIMIT_BURST,
+                    max_users=settings.CHAT_SESSION_MAX_SESSIONS,
+                )
+    return _admission
+
+
+def set_admission(admission: AdmissionController) -> None:
+    """Replace the process-wide admission controller, e.g. for load tests."""
+    global _admission
+    with _admission_lock:
+        _admission = admission
@@ -0,0 +1,216 @@
+"""Batched appointment inserts and async appointment queries.
+
+``create_appointment`` used to run through ``sync_to_async``, i.e. in the
+one thread that also runs every ``database_sync_to_async`` call such as
+the conversation writes. Appointments are now queued
+to a writer thread with its own connection, which inserts everything
+that arrived within a short window with a single ``bulk_create``. Reads
+run in the non thread-sensitive executor, next to the writer under WAL.
+"""
+import asyncio
+import atexit
+import queue
+import threading
+import time
+from datetime import date
+from typing import Callable, Dict, List, Optional
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from .metrics import Histogram
+from .slots import database_conflicts
+
+_STOP = object()
+
+
+class AppointmentWriter:
+    """Inserts unsaved appointments in batches and resolves their futures.
+
+    A batch holds whatever arrives within ``window`` seconds of its first
+    appointment, up to ``max_batch`` rows, in one transaction. When a
+    batch fails, its rows are retried one by one so only the bad ones
+    fail.
+
+    ``check``, when given, is called in that transaction with the batch and
+    returns the exception to fail each rejected appointment with, by
+    ``id()``; see ``slots.database_conflicts``.
+    """
+
+    def __init__(
+        self,
+        window: float = 0.005,
+        max_batch: int = 100,
+        check: Optional[Callable[[List], Dict[int, Exception]]] = None,
+    ):
+        self.window = window
+        self.max_batch = max_batch
+        self.check = check
+        self.batches = 0
+        self.rows = 0
+        self.failures = 0
+        self.latency = Histogram()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, appointment) -> asyncio.Future:
+        """Queue ``appointment``; the future resolves to it once saved."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._start()
+        self._queue.put((appointment, loop, future, time.perf_counter()))
+        return future
+
+    def _start(self) -> None:
+        # Also restarts a thread that died, e.g. on an unexpected error.
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    if self._thread is None:
+                        atexit.register(self.stop)
+                    self._thread = threading.Thread(
+                        target=self._run, name="appointment-writer", daemon=True
+                    )
+                    self._thread.start()
+
+    def stop(self) -> None:
+        """Write what is queued and stop the thread."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(_STOP)
+                self._thread.join()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    item = self._queue.get(timeout=max(timeout, 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            close_old_connections()
+            self._write(batch)
+        connection.close()
+
+    def _write(self, batch: list) -> None:
+        from ..models import Appointment
+
+        rejected = {}
+        try:
+            with transaction.atomic():
+                if self.check is not None:
+                    rejected = self.check([item[0] for item in batch])
+                Appointment.objects.bulk_create(
+                    [item[0] for item in batch if id(item[0]) not in rejected]
+                )
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    self._write([item])
+                return
+            self.failures += 1
+            self._resolve(batch[0], exception=e)
+            return
+        self.batches += 1
+        self.rows += len(batch) - len(rejected)
+        self.failures += len(rejected)
+        for item in batch:
+            self._resolve(item, exception=rejected.get(id(item[0])))
+
+    def _resolve(self, item, exception: Exception = None) -> None:
+        appointment, loop, future, submitted = item
+        self.latency.observe(time.perf_counter() - submitted)
+
+        def resolve():
+            if future.cancelled():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(appointment)
+
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # The submitting loop was closed; nobody awaits the result.
+            pass
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_appointment_writes_total Appointments inserted by the writer.",
+            "# TYPE chatbot_appointment_writes_total counter",
+            f"chatbot_appointment_writes_total {self.rows}",
+            "# HELP chatbot_appointment_write_batches_total Batches inserted by the writer.",
+            "# TYPE chatbot_appointment_write_batches_total counter",
+            f"chatbot_appointment_write_batches_total {self.batches}",
+            "# HELP chatbot_appointment_write_failures_total Appointments that failed to insert.",
+            "# TYPE chatbot_appointment_write_failures_total counter",
+            f"chatbot_appointment_write_failures_total {self.failures}",
+            "# HELP chatbot_appointment_write_seconds Time from submit to commit.",
+            "# TYPE chatbot_appointment_write_seconds histogram",
+        ]
+        lines += self.latency.render("chatbot_appointment_write_seconds", 'writer="batch"')
+        return "\n".join(lines) + "\n"
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_appointment_writer() -> AppointmentWriter:
+    """Return the process-wide appointment writer, creating it on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = AppointmentWriter(
+                    window=settings.CHATBOT_APPOINTMENT_WRITE_WINDOW,
+                    max_batch=settings.CHATBOT_APPOINTMENT_WRITE_BATCH,
+                    check=database_conflicts,
+                )
+    return _writer
+
+
+def _read(function):
+    return database_sync_to_async(function, thread_sensitive=False)
+
+
+@_read
+def aget_appointment(pk: int):
+    from ..models import Appointment
+
+    return Appointment.objects.filter(pk=pk).first()
+
+
+@_read
+def alist_appointments(
+    start: Optional[date] = None, end: Optional[date] = None, limit: int = None
+) -> List:
+    """Appointments from ``start`` to ``end`` inclusive, soonest first."""
+    from ..models import Appointment
+
+    appointments = Appointment.objects.order_by("date", "time")
+    if start is not None:
+        appointments = appointments.filter(date__gte=start)
+    if end is not None:
+        appointments = appointments.filter(date__lte=end)
+    return list(appointments[:limit])
+
+
+@_read
+def acount_appointments(day: date) -> int:
+    from ..models import Appointment
+
+    return Appointment.objects.filter(date=day).count()
@@ -0,0 +1,303 @@
+"""Local extraction of appointment fields from a user message.
+
+Fully specified requests such as "Book a dentist appointment on May 5th at
+3pm" are turned into an appointment without the appointment LLM, which
+re-sends the whole conversation. The LLM still runs when the title, date
+or time cannot be resolved here, and only fills the fields missing below.
+"""
+import calendar
+import json
+import re
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+FIELDS = ("name", "date", "time")
+
+MONTHS = {name.lower(): i for i, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): i for i, name in enumerate(calendar.month_abbr) if name})
+MONTHS["sept"] = 9
+WEEKDAYS = {name.lower(): i for i, name in enumerate(calendar.day_name)}
+WEEKDAYS.update({name.lower(): i for i, name in enumerate(calendar.day_abbr)})
+WEEKDAYS.update({"tues": 1, "thur": 3, "thurs": 3})
+NUMBERS = {
+    word: i
+    for i, word in enumerate(
+        "zero one two three four five six seven eight nine ten".split()
+    )
+}
+NUMBERS["a"] = 1
+
+SPECIALISTS = {
+    "allergist": "Allergist",
+    "cardiologist": "Cardiologist",
+    "chiropractor": "Chiropractor",
+    "dentist": "Dentist",
+    "dermatologist": "Dermatologist",
+    "dietitian": "Dietitian",
+    "doctor": "Doctor",
+    "dr": "Doctor",
+    "ent": "ENT",
+    "gp": "GP",
+    "gynecologist": "Gynecologist",
+    "neurologist": "Neurologist",
+    "nurse": "Nurse",
+    "nutritionist": "Nutritionist",
+    "oncologist": "Oncologist",
+    "ophthalmologist": "Ophthalmologist",
+    "optometrist": "Optometrist",
+    "orthopedist": "Orthopedist",
+    "pediatrician": "Pediatrician",
+    "physician": "Doctor",
+    "physio": "Physiotherapist",
+    "physiotherapist": "Physiotherapist",
+    "psychiatrist": "Psychiatrist",
+    "psychologist": "Psychologist",
+    "surgeon": "Surgeon",
+    "therapist": "Therapist",
+    "urologist": "Urologist",
+}
+VISITS = {
+    "blood test": "Blood test",
+    "check up": "Checkup",
+    "check-up": "Checkup",
+    "checkup": "Checkup",
+    "consultation": "Consultation",
+    "eye exam": "Eye exam",
+    "flu shot": "Flu shot",
+    "follow up": "Follow-up",
+    "follow-up": "Follow-up",
+    "physical": "Physical",
+    "vaccination": "Vaccination",
+}
+# Words that end a "for my ..." complaint or rule it out as one.
+DATE_WORDS = {
+    "today", "tonight", "tomorrow", "next", "this", "in", "on", "at", "day",
+    "week", "weeks", "month", "morning", "afternoon", "evening", "noon",
+    "appointment", "please", "me", "us",
+} | set(MONTHS) | set(WEEKDAYS)
+# "For my son" names a patient, not a complaint.
+RELATIVES = {
+    "baby", "child", "children", "dad", "daughter", "family", "father",
+    "husband", "kid", "kids", "mom", "mother", "parents", "son", "wife",
+}
+
+_MONTH = r"(?P<month>%s)\.?" % "|".join(sorted(MONTHS, key=len, reverse=True))
+_DAY = r"(?P<day>[0-3]?\d)(?:st|nd|rd|th)?"
+_YEAR = r"(?:,?\s+(?P<year>\d{4}))?"
+_DATE_PATTERNS = [
+    re.compile(r"\b(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})\b"),
+    re.compile(rf"\b{_MONTH}\s+(?:the\s+)?{_DAY}\b{_YEAR}"),
+    re.compile(rf"\b(?:the\s+)?{_DAY}\s+(?:of\s+)?{_MONTH}\b{_YEAR}"),
+    # Slashes are read month first.
+    re.compile(r"\b(?P<month>\d{1,2})/(?P<day>\d{1,2})(?:/(?P<year>\d{2}|\d{4}))?\b"),
+]
+_RELATIVE_RE = re.compile(
+    r"\b(?:(?P<after>(?:the\s+)?day\s+after\s+tomorrow)|(?P<today>today|tonight)"
+    r"|(?P<tomorrow>tomorrow)"
+    r"|in\s+(?P<count>\d+|%s)\s+(?P<unit>days?|weeks?)"
+    r"|(?:(?P<which>this|next|on)\s+)?(?P<weekday>%s)\b)"
+    % ("|".join(NUMBERS), "|".join(sorted(WEEKDAYS, key=len, reverse=True)))
+)
+_TIME_PATTERNS = [
+    re.compile(
+        r"\b(?P<hour>1[0-2]|0?[1-9])(?:[:.](?P<minute>[0-5]\d))?\s*"
+        r"(?P<meridiem>[ap])\.?m\b\.?"
+    ),
+    re.compile(r"\b(?P<hour>[01]?\d|2[0-3]):(?P<minute>[0-5]\d)\b"),
+    re.compile(r"\b(?P<noon>noon|midday)\b"),
+    re.compile(r"\bat\s+(?P<bare>1[0-2]|0?[1-9])(?:\s*o'?clock)?\b"),
+]
+_SPECIALIST_RE = re.compile(r"\b(?P<who>%s)\b" % "|".join(SPECIALISTS))
+_COMPLAINT_RE = re.compile(
+    r"\bfor\s+(?:my|a|an|the|some)\s+(?P<what>[a-z][a-z ]*?)"
+    r"(?=\s+(?:%s)\b|[,.!?]|$)" % "|".join(sorted(DATE_WORDS, key=len, reverse=True))
+)
+
+
+def _matches(patterns: List[re.Pattern], text: str) -> List[re.Match]:
+    """Matches of all ``patterns`` in order of position.
+
+    Where matches overlap, the one of the earlier pattern wins, so "10:30am"
+    is not also read as "10:30".
+    """
+    found = []
+    for pattern in patterns:
+        for match in pattern.finditer(text):
+            if not any(
+                match.start() < other.end() and other.start() < match.end()
+                for other in found
+            ):
+                found.append(match)
+    return sorted(found, key=lambda match: match.start())
+
+
+def _year_for(month: int, day: int, today: date) -> Optional[date]:
+    """The next ``month``/``day`` on or after ``today``."""
+    for year in (today.year, today.year + 1):
+        try:
+            candidate = date(year, month, day)
+        except ValueError:
+            return None
+        if candidate >= today:
+            return candidate
+    return None
+
+
+def _explicit_date(match: re.Match, today: date) -> Optional[date]:
+    month = match.group("month")
+    month = MONTHS[month] if month.isalpha() else int(month)
+    day = int(match.group("day"))
+    year = match.group("year")
+    if not year:
+        return _year_for(month, day, today)
+    year = int(year) + (2000 if len(year) == 2 else 0)
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def _relative_date(match: re.Match, today: date) -> date:
+    if match.group("after"):
+        return today + timedelta(days=2)
+    if match.group("today"):
+        return today
+    if match.group("tomorrow"):
+        return today + timedelta(days=1)
+    if match.group("count"):
+        count = match.group("count")
+        count = int(count) if count.isdigit() else NUMBERS[count]
+        return today + timedelta(
+            days=count * (7 if match.group("unit").startswith("week") else 1)
+        )
+    weekday = WEEKDAYS[match.group("weekday")]
+    ahead = (weekday - today.weekday()) % 7
+    which = match.group("which")
+    if which == "next":
+        monday = today - timedelta(days=today.weekday()) + timedelta(days=7)
+        return monday + timedelta(days=weekday)
+    if not ahead and which != "this":
+        ahead = 7
+    return today + timedelta(days=ahead)
+
+
+def extract_date(text: str, today: date) -> Optional[str]:
+    """ISO date of the date in ``text``, None if there is none or several.
+
+    As with times, "May 5th or May 6th" or "in 2 weeks ... on Monday" is
+    left to the LLM to ask about. Explicit dates that do not exist, such
+    as "31/12" (read month first), are skipped. A bare or "on" weekday is
+    the next one after today, "this Friday" may be today, and "next
+    Friday" is the Friday of the following week.
+    """
+    explicit = _matches(_DATE_PATTERNS, text)
+    dates = {_explicit_date(match, today) for match in explicit} - {None}
+    weekdays = {found.weekday() for found in dates}
+    for match in _RELATIVE_RE.finditer(text):
+        if any(
+            match.start() < other.end() and other.start() < match.end()
+            for other in explicit
+        ):
+            continue
+        if match.group("weekday") and WEEKDAYS[match.group("weekday")] in weekdays:
+            # "Friday, May 5" names the weekday of the date.
+            continue
+        dates.add(_relative_date(match, today))
+    return dates.pop().isoformat() if len(dates) == 1 else None
+
+
+def _time(match: re.Match) -> str:
+    groups = match.groupdict()
+    if groups.get("noon"):
+        return "12:00"
+    if groups.get("bare"):
+        hour = int(groups["bare"])
+        return f"{hour + 12 if hour < 8 else hour:02d}:00"
+    hour, minute = int(groups["hour"]), int(groups["minute"] or 0)
+    meridiem = groups.get("meridiem")
+    if meridiem:
+        hour = hour % 12 + (12 if meridiem == "p" else 0)
+    elif len(groups["hour"]) == 1 and hour < 8:
+        hour += 12
+    return f"{hour:02d}:{minute:02d}"
+
+
+def extract_time(text: str) -> Optional[str]:
+    """HH:MM of the time in ``text``, None if there is none or several.
+
+    "at 10 or 11am" is left to the LLM to ask about rather than booking
+    either. Without am/pm, "at 3" and "3:30" are read within clinic hours:
+    8 to 11 in the morning, 12 to 7 in the afternoon. "03:30" is taken as
+    written.
+    """
+    times = {_time(match) for match in _matches(_TIME_PATTERNS, text)}
+    return times.pop() if len(times) == 1 else None
+
+
+def extract_name(text: str) -> Optional[str]:
+    """Appointment title from the specialist, visit or complaint mentioned."""
+    match = _SPECIALIST_RE.search(text)
+    if match:
+        return f"{SPECIALISTS[match.group('who')]} appointment"
+    for phrase, visit in VISITS.items():
+        if re.search(rf"\b{re.escape(phrase)}\b", text):
+            return visit
+    match = _COMPLAINT_RE.search(text)
+    if match:
+        words = match.group("what").split()
+        if len(words) <= 4 and not (DATE_WORDS | RELATIVES).intersection(words):
+            return f"{match.group('what').capitalize()} appointment"
+    return None
+
+
+def extract_appointment(message: str, now: datetime = None) -> Dict[str, Optional[str]]:
+    """Fields of the appointment schema found in ``message``, None if not.
+
+    The date is removed before looking for a time, so "May 5 at 3" does
+    not read the day as an hour.
+    """
+    now = now or datetime.now()
+    text = message.lower()
+    found_date = extract_date(text, now.date())
+    for pattern in _DATE_PATTERNS:
+        text = pattern.sub(" ", text)
+    return {
+        "name": extract_name(text),
+        "date": found_date,
+        "time": extract_time(text),
+        "description": None,
+    }
+
+
+def missing_fields(fields: Dict[str, Optional[str]]):
+    return [field for field in FIELDS if not fields.get(field)]
+
+
+def merge_appointment(
+    known: Dict[str, Optional[str]], extracted: Dict[str, Optional[str]]
+) -> Dict[str, Optional[str]]:
+    """``known`` fields overridden by the ones resolved in ``extracted``."""
+    merged = dict(known)
+    merged.update({field: value for field, value in extracted.items() if value})
+    return merged
+
+
+def complete_llm_result(result: str, extracted: Dict[str, Optional[str]]) -> str:
+    """Use local values in the appointment LLM's JSON where it has none.
+
+    Locally resolved dates and times are deterministic, so they also win
+    over the LLM's. Results that are not JSON are returned unchanged for
+    the usual validation error.
+    """
+    try:
+        fields = json.loads(result)
+    except json.JSONDecodeError:
+        return result
+    if not isinstance(fields, dict):
+        return result
+    local = {
+        field: value
+        for field, value in extracted.items()
+        if value and (field != "name" or not fields.get("name"))
+    }
+    return json.dumps(merge_appointment(fields, local))
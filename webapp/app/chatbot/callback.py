@@ -1,10 +1,22 @@
 """Callback handlers used in the app."""
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Union
+import asyncio
 import json
+import time
 
 from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.schema import LLMResult
 
 from .schemas import ChatResponse
+from .sessions import count_tokens
+
+# Serialised form of ChatResponse(username="bot", message=..., type="stream").
+STREAM_FRAME_PREFIX = '{"username": "bot", "message": '
+STREAM_FRAME_SUFFIX = ', "type": "stream"}'
+
+
+def stream_frame(message: str) -> str:
+    return STREAM_FRAME_PREFIX + json.dumps(message) + STREAM_FRAME_SUFFIX
 
 
 class StreamingLLMCallbackHandler(AsyncCallbackHandler):
@@ -12,12 +24,68 @@ class StreamingLLMCallbackHandler(AsyncCallbackHandler):
 
     def __init__(self, consumer):
         self.consumer = consumer
+        self.timer = None
 
     async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.timer is not None:
+            self.timer.mark("first_token")
         resp = ChatResponse(username="bot", message=token, type="stream")
         await self.consumer.send(text_data=json.dumps(resp.dict()))
 
 
+class BufferedStreamingLLMCallbackHandler(AsyncCallbackHandler):
+    """Callback handler that coalesces streamed tokens into fewer frames.
+
+    Tokens are appended to a buffer that is sent as one "stream" frame once
+    ``flush_interval`` seconds have passed since its first token or it holds
+    ``max_bytes`` characters. Whatever is left is flushed when the LLM ends.
+    """
+
+    def __init__(self, consumer, flush_interval: float = 0.03, max_bytes: int = 512):
+        self.consumer = consumer
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self._buffer: List[str] = []
+        self._size = 0
+        self._window_start = 0.0
+        self._flush_handle = None
+        self.timer = None
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.timer is not None:
+            self.timer.mark("first_token")
+        loop = asyncio.get_running_loop()
+        if not self._buffer:
+            self._window_start = loop.time()
+            self._flush_handle = loop.call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+            )
+        self._buffer.append(token)
+        self._size += len(token)
+        if (
+            self._size >= self.max_bytes
+            or loop.time() - self._window_start >= self.flush_interval
+        ):
+            await self.flush()
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        await self.flush()
+
+    async def on_llm_error(self, error, **kwargs: Any) -> None:
+        await self.flush()
+
+    async def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._buffer:
+            return
+        message = "".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        await self.consumer.send(text_data=stream_frame(message))
+
+
 class QuestionGenCallbackHandler(AsyncCallbackHandler):
     """Callback handler for question generation."""
 
@@ -32,3 +100,53 @@ class QuestionGenCallbackHandler(AsyncCallbackHandler):
             username="bot", message="Synthesizing question...", type="info"
         )
         await self.consumer.send(text_data=json.dumps(resp.dict()))
+
+
+class LLMStageCallbackHandler(AsyncCallbackHandler):
+    """Adds the wall time and token usage of one LLM to the current turn.
+
+    The consumer exposes the ``StageTimer`` of the turn in progress as
+    ``turn_timer``. Token counts come from the API usage when it is reported
+    and are counted locally otherwise, e.g. for streamed answers.
+    """
+
+    def __init__(self, consumer, stage: str):
+        self.consumer = consumer
+        self.stage = stage
+        self._started = None
+        self._prompts: List[str] = []
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    async def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        self._started = time.perf_counter()
+        self._prompts = prompts
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        timer = self.consumer.turn_timer
+        if timer is None or self._started is None:
+            return
+        timer.add(self.stage, time.perf_counter() - self._started)
+        self._started = None
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = sum(count_tokens(prompt) for prompt in self._prompts)
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = sum(
+                count_tokens(generation.text)
+                for generations in response.generations
+                for generation in generations
+            )
+        timer.count(f"{self.stage}_prompt_tokens", prompt_tokens)
+        timer.count(f"{self.stage}_completion_tokens", completion_tokens)
+
+    async def on_llm_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        self._started = None
@@ -1,18 +1,29 @@
 """Create a ChatVectorDBChain for question/answering."""
+import asyncio
+import re
+from typing import Any, Callable, Dict, List
+
+from asgiref.sync import sync_to_async
 from langchain.agents import AgentExecutor, LLMSingleActionAgent
-from langchain.callbacks.base import AsyncCallbackManager
+from langchain.callbacks.base import AsyncCallbackHandler, AsyncCallbackManager
 from langchain.callbacks.base import CallbackManager
 from langchain.callbacks.tracers import LangChainTracer
 from langchain.chains import ConversationalRetrievalChain, ConversationChain
 from langchain.chains.chat_vector_db.prompts import CONDENSE_QUESTION_PROMPT, QA_PROMPT
+from langchain.chains.conversational_retrieval.base import _get_chat_history
 from langchain.chains.llm import LLMChain
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chat_models import ChatOpenAI
-from langchain.llms import OpenAI
 from langchain.memory import ConversationBufferMemory
+from langchain.prompts import ChatPromptTemplate, PromptTemplate
+from langchain.schema import Document, Generation, LLMResult
 
 from langchain.vectorstores.base import VectorStoreRetriever
 
+from .coalesce import CoalescingChatOpenAI, CoalescingOpenAI
+from .lexical_index import HybridRetriever
+from .openai_client import openai_llm_kwargs
+from .timing import StageTimer
 from .utils import (
     AppointmentsOutputParser,
     get_appointment_chat_prompt,
@@ -24,18 +35,150 @@ from .utils import (
 )
 
 
+class CachedConversationalRetrievalChain(ConversationalRetrievalChain):
+    """ConversationalRetrievalChain with a response cache and retrieval prefetch.
+
+    The condensed question (or ``cache_query`` on the first turn) is embedded
+    and looked up before retrieval. Cached answers are replayed token by
+    token through ``stream_handler`` so the client sees a normal stream.
+
+    ``prefetched_docs`` may hold a task started by ``prefetch_docs`` before
+    the chain was called; it is used when the question needs no condensing
+    and cancelled otherwise. Both it and ``timer`` only apply to the next
+    call, which is fine because a chain instance belongs to one session.
+
+    With a ``HybridRetriever``, BM25 searches ``cache_query`` (the user's
+    message, or the condensed question) rather than the question, which
+    carries the health profile.
+
+    With ``context_packer`` set, the retrieved documents are deduplicated
+    and trimmed to its token budget before they are stuffed into the
+    prompt; the tokens kept and saved are counted on the turn's timer.
+    """
+
+    response_cache: Any = None
+    embeddings: Any = None
+    cache_scope: str = ""
+    stream_handler: Any = None
+    prefetched_docs: Any = None
+    timer: Any = None
+    context_packer: Any = None
+
+    def prefetch_docs(
+        self, question: str, timer: StageTimer = None, cache_query: str = None
+    ) -> asyncio.Task:
+        """Start retrieval for ``question`` and return the task."""
+        timer = timer or StageTimer()
+
+        # Retrieval starts inside the task, so cancelling it before it runs
+        # leaves no coroutine behind unawaited.
+        async def retrieve():
+            with timer.stage("retrieval"):
+                return await self._aget_docs(question, {"cache_query": cache_query})
+
+        return asyncio.ensure_future(retrieve())
+
+    async def _aget_docs(self, question: str, inputs: Dict[str, Any]) -> List[Document]:
+        cache_query = inputs.get("cache_query")
+        if cache_query is None or not isinstance(self.retriever, HybridRetriever):
+            return await super()._aget_docs(question, inputs)
+        docs = await self.retriever.aget_relevant_documents(
+            question, lexical_query=cache_query
+        )
+        return self._reduce_tokens_below_limit(docs)
+
+    async def _replay(self, answer: str) -> None:
+        for token in re.findall(r"\s*\S+|\s+", answer):
+            await self.stream_handler.on_llm_new_token(token)
+        await self.stream_handler.on_llm_end(
+            LLMResult(generations=[[Generation(text=answer)]])
+        )
+
+    async def _acall(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        prefetched, self.prefetched_docs = self.prefetched_docs, None
+        timer, self.timer = self.timer or StageTimer(), None
+        inputs = dict(inputs)
+        question = inputs["question"]
+        cache_query = inputs.pop("cache_query", question)
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+        if chat_history_str:
+            if prefetched is not None:
+                prefetched.cancel()
+                prefetched = None
+            with timer.stage("condense_question"):
+                new_question = await self.question_generator.arun(
+                    question=question, chat_history=chat_history_str
+                )
+            cache_query = new_question
+        else:
+            new_question = question
+
+        vector = None
+        if self.response_cache is not None:
+            with timer.stage("cache_lookup"):
+                vector = await sync_to_async(
+                    self.embeddings.embed_query, thread_sensitive=False
+                )(cache_query)
+                answer = self.response_cache.lookup(vector, self.cache_scope)
+            if answer is not None:
+                timer.count("response_cache_hits")
+                if prefetched is not None:
+                    prefetched.cancel()
+                await self._replay(answer)
+                return {self.output_key: answer}
+
+        with timer.stage("retrieval_wait"):
+            if prefetched is not None:
+                docs = await prefetched
+            else:
+                docs = await self._aget_docs(
+                    new_question, {"cache_query": cache_query}
+                )
+        timer.count("retrieved_docs", len(docs))
+        if self.context_packer is not None:
+            with timer.stage("context_packing"):
+                context = self.context_packer.pack(docs, cache_query)
+            docs = context.documents
+            timer.count("context_tokens", context.tokens)
+            timer.count("context_tokens_saved", context.original_tokens - context.tokens)
+        new_inputs = inputs.copy()
+        new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+        with timer.stage("answer"):
+            answer = await self.combine_docs_chain.arun(
+                input_documents=docs, **new_inputs
+            )
+        if vector is not None:
+            self.response_cache.store(vector, self.cache_scope, answer)
+        return {self.output_key: answer}
+
+
 def get_symptoms_chain(
     retriever: VectorStoreRetriever,
     question_handler,
     stream_handler,
     tracing: bool = False,
+    qa_prompt: PromptTemplate = None,
+    response_cache=None,
+    embeddings=None,
+    cache_scope: str = "",
+    instrument: Callable[[str], AsyncCallbackHandler] = None,
+    context_packer=None,
 ) -> ConversationalRetrievalChain:
-    """Create a ChatVectorDBChain for question/answering."""
+    """Create a ChatVectorDBChain for question/answering.
+
+    ``instrument(stage)`` returns a callback handler that records the LLM
+    of that stage, see ``LLMStageCallbackHandler``.
+    """
     # Construct a ChatVectorDBChain with a streaming llm for combine docs
     # and a separate, non-streaming llm for question generation
     manager = AsyncCallbackManager([])
     question_manager = AsyncCallbackManager([question_handler])
     stream_manager = AsyncCallbackManager([stream_handler])
+    if instrument:
+        question_manager.add_handler(instrument("condense_question_llm"))
+        stream_manager.add_handler(instrument("answer_llm"))
     if tracing:
         tracer = LangChainTracer()
         tracer.load_default_session()
@@ -43,16 +186,22 @@ def get_symptoms_chain(
         question_manager.add_handler(tracer)
         stream_manager.add_handler(tracer)
 
-    question_gen_llm = OpenAI(
+    # Both prompts carry the patient's health profile, so their completions
+    # are never stored in the completion cache.
+    question_gen_llm = CoalescingOpenAI(
+        **openai_llm_kwargs(),
         temperature=0,
         verbose=True,
         callback_manager=question_manager,
+        completion_cache=False,
     )
-    streaming_llm = OpenAI(
+    streaming_llm = CoalescingOpenAI(
+        **openai_llm_kwargs(),
         streaming=True,
         callback_manager=stream_manager,
         verbose=True,
         temperature=0,
+        completion_cache=False,
     )
 
     question_generator = LLMChain(
@@ -61,34 +210,48 @@ def get_symptoms_chain(
     doc_chain = load_qa_chain(
         streaming_llm,
         chain_type="stuff",
-        prompt=get_symptoms_qa_prompt(),
+        prompt=qa_prompt or get_symptoms_qa_prompt(),
         callback_manager=manager,
     )
 
-    qa = ConversationalRetrievalChain(
+    qa = CachedConversationalRetrievalChain(
         retriever=retriever,
         combine_docs_chain=doc_chain,
         question_generator=question_generator,
         callback_manager=manager,
+        response_cache=response_cache,
+        embeddings=embeddings,
+        cache_scope=cache_scope,
+        stream_handler=stream_handler,
+        context_packer=context_packer,
     )
     return qa
 
 
-def get_intents_chain():
-    chat = ChatOpenAI(
+def get_intents_chain(chat_prompt: ChatPromptTemplate = None):
+    chat = CoalescingChatOpenAI(
+        **openai_llm_kwargs(),
         temperature=0,
         verbose=True,
     )
-    chat_prompt = get_intent_prompt()
+    chat_prompt = chat_prompt or get_intent_prompt()
     return LLMChain(llm=chat, prompt=chat_prompt)
 
 
-def get_general_chat_chain(stream_handler, memory: ConversationBufferMemory = None):
+def get_general_chat_chain(
+    stream_handler,
+    memory: ConversationBufferMemory = None,
+    chat_prompt: ChatPromptTemplate = None,
+    instrument: Callable[[str], AsyncCallbackHandler] = None,
+):
     if memory is None:
         memory = ConversationBufferMemory()
-    chat_prompt = get_general_chat_prompt()
+    chat_prompt = chat_prompt or get_general_chat_prompt()
     stream_manager = AsyncCallbackManager([stream_handler])
-    chat = ChatOpenAI(
+    if instrument:
+        stream_manager.add_handler(instrument("general_chat_llm"))
+    chat = CoalescingChatOpenAI(
+        **openai_llm_kwargs(),
         streaming=True,
         callback_manager=stream_manager,
         verbose=True,
@@ -108,6 +271,7 @@ def get_appointment_agent_executor(
     tool_names = [tool.name for tool in tools]
     chat_prompt = get_appointment_chat_prompt(tools=tools)
     chat = ChatOpenAI(
+        **openai_llm_kwargs(),
         streaming=True,
         callback_manager=stream_manager,
         temperature=0,
@@ -126,12 +290,21 @@ def get_appointment_agent_executor(
     return agent_executor
 
 
-def get_appointment_chain(memory: ConversationBufferMemory = None):
+def get_appointment_chain(
+    memory: ConversationBufferMemory = None,
+    chat_prompt: ChatPromptTemplate = None,
+    instrument: Callable[[str], AsyncCallbackHandler] = None,
+):
     if memory is None:
         memory = ConversationBufferMemory()
-    chat_prompt = get_appointment_json_prompt()
-    chat = ChatOpenAI(
+    chat_prompt = chat_prompt or get_appointment_json_prompt()
+    manager = None
+    if instrument:
+        manager = AsyncCallbackManager([instrument("appointment_llm")])
+    chat = CoalescingChatOpenAI(
+        **openai_llm_kwargs(),
         streaming=False,
+        callback_manager=manager,
         verbose=True,
         temperature=0,
     )
@@ -0,0 +1,220 @@
+"""Single-flight coalescing of identical concurrent LLM calls.
+
+Many users greeting the bot at once produce the same rendered prompt. The
+first call becomes the flight; identical calls made while it is in the air
+subscribe to it instead of calling OpenAI. Streamed tokens are fanned out to
+every subscriber's callback manager, late subscribers get the tokens they
+missed first.
+"""
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from langchain.callbacks.base import AsyncCallbackHandler, AsyncCallbackManager
+from langchain.chat_models import ChatOpenAI
+from langchain.llms import OpenAI
+
+from .completion_cache import (
+    CompletionCache,
+    get_completion_cache,
+    replay_tokens,
+)
+
+
+async def _send_token(manager, verbose: bool, token: str) -> None:
+    if manager.is_async:
+        await manager.on_llm_new_token(token, verbose=verbose)
+    else:
+        manager.on_llm_new_token(token, verbose=verbose)
+
+
+class Flight:
+    """One in-flight completion and the callback managers waiting for it."""
+
+    def __init__(self):
+        self.tokens: List[str] = []
+        self.subscribers: List[tuple] = []
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def publish(self, token: str) -> None:
+        self.tokens.append(token)
+        await asyncio.gather(
+            *(
+                _send_token(manager, verbose, token)
+                for manager, verbose in list(self.subscribers)
+            )
+        )
+
+    async def subscribe(self, manager, verbose: bool) -> None:
+        # Tokens may arrive while the backlog is replayed, so catch up until
+        # there is nothing left before joining the live fan-out.
+        sent = 0
+        while sent < len(self.tokens):
+            await _send_token(manager, verbose, self.tokens[sent])
+            sent += 1
+        self.subscribers.append((manager, verbose))
+
+
+class _FlightHandler(AsyncCallbackHandler):
+    """Forwards the tokens of the shared call to the flight."""
+
+    def __init__(self, flight: Flight):
+        self.flight = flight
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        await self.flight.publish(token)
+
+
+class SingleFlight:
+    """In-flight LLM calls of the process, keyed by prompt and model."""
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.coalesced: Dict[str, int] = defaultdict(int)
+
+    async def run(self, llm, key: str, call):
+        """Return ``call(shared_llm)``, shared with identical concurrent calls.
+
+        ``shared_llm`` is a copy of ``llm`` whose tokens go to the flight;
+        ``llm``'s own callback manager receives them as a subscriber.
+        """
+        kind = getattr(llm, "_llm_type", type(llm).__name__)
+        flight = self.flights.get(key)
+        if flight is None:
+            self.calls[kind] += 1
+            flight = self.flights[key] = Flight()
+            shared_llm = llm.copy(
+                update={"callback_manager": AsyncCallbackManager([_FlightHandler(flight)])}
+            )
+            flight.task = asyncio.ensure_future(call(shared_llm))
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+        else:
+            self.coalesced[kind] += 1
+        subscriber = (llm.callback_manager, llm.verbose)
+        flight.waiters += 1
+        try:
+            await flight.subscribe(*subscriber)
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if subscriber in flight.subscribers:
+                flight.subscribers.remove(subscriber)
+            if not flight.waiters and not flight.task.done():
+                # Everybody who wanted the answer is gone.
+                self._land(key, flight)
+                flight.task.cancel()
+
+    def _land(self, key: str, flight: Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_llm_calls_total LLM calls sent to the provider.",
+            "# TYPE chatbot_llm_calls_total counter",
+        ]
+        lines += [
+            f'chatbot_llm_calls_total{{llm="{kind}"}} {count}'
+            for kind, count in sorted(self.calls.items())
+        ]
+        lines += [
+            "# HELP chatbot_llm_coalesced_total LLM calls answered by an identical call in flight.",
+            "# TYPE chatbot_llm_coalesced_total counter",
+        ]
+        lines += [
+            f'chatbot_llm_coalesced_total{{llm="{kind}"}} {count}'
+            for kind, count in sorted(self.coalesced.items())
+        ]
+        lines += [
+            "# HELP chatbot_llm_in_flight Distinct LLM calls in flight.",
+            "# TYPE chatbot_llm_in_flight gauge",
+            f"chatbot_llm_in_flight {len(self.flights)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class CoalescingMixin:
+    """Routes the async calls of an LLM or chat model through ``SingleFlight``.
+
+    The key is the rendered prompts or messages, the stop words and the
+    model's identifying parameters (model name, temperature, streaming...).
+    Calls at temperature 0 are deterministic, so they are also answered from
+    the completion cache when possible and stored in it otherwise, unless
+    ``completion_cache`` is off: prompts that embed patient data must not
+    outlive the conversation.
+    """
+
+    def _flight_key(self, inputs: list, stop: Optional[List[str]]) -> str:
+        rendered = [
+            item if isinstance(item, str) else [item.type, item.content]
+            for item in inputs
+        ]
+        return json.dumps(
+            [type(self).__name__, rendered, stop, getattr(self, "_identifying_params", {})],
+            sort_keys=True,
+            default=str,
+        )
+
+    def _cacheable(self) -> bool:
+        return (
+            settings.CHATBOT_COMPLETION_CACHE
+            and getattr(self, "completion_cache", True)
+            and getattr(self, "temperature", None) == 0
+            and getattr(self, "n", 1) == 1
+        )
+
+    async def _agenerate(self, inputs: list, stop: Optional[List[str]] = None):
+        key = self._flight_key(inputs, stop)
+        cache_key = None
+        if self._cacheable():
+            cache_key = CompletionCache.make_key(key)
+            result = await get_completion_cache().aget(cache_key)
+            if result is not None:
+                if getattr(self, "streaming", False):
+                    await replay_tokens(self, result)
+                return result
+
+        async def call(llm):
+            result = await super(CoalescingMixin, llm)._agenerate(inputs, stop)
+            if cache_key is not None:
+                await get_completion_cache().aset(
+                    cache_key,
+                    getattr(llm, "_llm_type", type(llm).__name__),
+                    result,
+                )
+            return result
+
+        if not settings.CHATBOT_COALESCE_LLM_CALLS:
+            return await call(self)
+        return await get_single_flight().run(self, key, call)
+
+
+class CoalescingOpenAI(CoalescingMixin, OpenAI):
+    completion_cache: bool = True
+
+
+class CoalescingChatOpenAI(CoalescingMixin, ChatOpenAI):
+    completion_cache: bool = True
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """Return the process-wide single-flight table, creating it on first use."""
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight()
+    return _single_flight
@@ -0,0 +1,218 @@
+"""Exact-match cache of temperature-0 LLM completions.
+
+An in-process LRU sits in front of ``CompletionCacheEntry`` rows, so answers
+survive restarts and are shared by all workers using the same database.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional, Union
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from langchain.schema import (
+    AIMessage,
+    ChatGeneration,
+    ChatResult,
+    Generation,
+    LLMResult,
+)
+
+_TOKEN_RE = re.compile(r"\s*\S+|\s+")
+
+# Rows beyond the size limit are deleted once every this many stores.
+PRUNE_EVERY = 100
+
+# Cache hits cost no tokens.
+CACHED_USAGE = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def dump_result(result: Union[ChatResult, LLMResult]) -> str:
+    if isinstance(result, ChatResult):
+        generations = [
+            [{"text": g.message.content, "generation_info": g.generation_info}]
+            for g in result.generations
+        ]
+        return json.dumps({"chat": True, "generations": generations})
+    generations = [
+        [{"text": g.text, "generation_info": g.generation_info} for g in prompt]
+        for prompt in result.generations
+    ]
+    return json.dumps({"chat": False, "generations": generations})
+
+
+def load_result(payload: str) -> Union[ChatResult, LLMResult]:
+    """Rebuild a stored result, reporting no token usage."""
+    data = json.loads(payload)
+    if data["chat"]:
+        return ChatResult(
+            generations=[
+                ChatGeneration(
+                    message=AIMessage(content=g["text"]),
+                    generation_info=g["generation_info"],
+                )
+                for [g] in data["generations"]
+            ],
+            llm_output={"token_usage": dict(CACHED_USAGE)},
+        )
+    return LLMResult(
+        generations=[[Generation(**g) for g in prompt] for prompt in data["generations"]],
+        llm_output={"token_usage": dict(CACHED_USAGE)},
+    )
+
+
+async def replay_tokens(llm, result: Union[ChatResult, LLMResult]) -> None:
+    """Stream a cached answer through ``llm``'s callbacks, as if generated."""
+    if isinstance(result, ChatResult):
+        text = result.generations[0].text
+    else:
+        text = result.generations[0][0].text
+    manager = llm.callback_manager
+    for token in _TOKEN_RE.findall(text):
+        if manager.is_async:
+            await manager.on_llm_new_token(token, verbose=llm.verbose)
+        else:
+            manager.on_llm_new_token(token, verbose=llm.verbose)
+
+
+class CompletionCache:
+    """Completions by key, kept ``ttl`` seconds and at most ``max_size`` rows.
+
+    The memory tier holds the ``memory_size`` most recently used entries.
+    The database tier drops the least recently used rows beyond its size.
+    """
+
+    def __init__(self, ttl: float, max_size: int, memory_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+        self._stores = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(description: str) -> str:
+        """Hash of a description of the call: model, parameters and prompt."""
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _remember(self, key: str, payload: str, expires: float) -> None:
+        with self._lock:
+            self._memory[key] = (payload, expires)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return entry[0]
+
+    def _get_database(self, key: str) -> Optional[str]:
+        from ..models import CompletionCacheEntry
+
+        entry = CompletionCacheEntry.objects.filter(key=key).first()
+        if entry is None:
+            return None
+        age = (timezone.now() - entry.created_at).total_seconds()
+        if age > self.ttl:
+            entry.delete()
+            return None
+        CompletionCacheEntry.objects.filter(pk=entry.pk).update(
+            hits=F("hits") + 1, used_at=timezone.now()
+        )
+        self._remember(key, entry.result, time.monotonic() + self.ttl - age)
+        return entry.result
+
+    def _set_database(self, key: str, model: str, payload: str) -> None:
+        from ..models import CompletionCacheEntry
+
+        CompletionCacheEntry.objects.update_or_create(
+            key=key, defaults={"model": model, "result": payload}
+        )
+        self._stores += 1
+        if self._stores % PRUNE_EVERY == 0:
+            self.prune()
+
+    async def aget(self, key: str) -> Optional[Union[ChatResult, LLMResult]]:
+        payload = self._get_memory(key)
+        if payload is not None:
+            self.memory_hits += 1
+        else:
+            payload = await database_sync_to_async(self._get_database)(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self.database_hits += 1
+        return load_result(payload)
+
+    async def aset(
+        self, key: str, model: str, result: Union[ChatResult, LLMResult]
+    ) -> None:
+        payload = dump_result(result)
+        self._remember(key, payload, time.monotonic() + self.ttl)
+        await database_sync_to_async(self._set_database)(key, model, payload)
+
+    def prune(self) -> int:
+        """Delete expired rows and the least recently used ones beyond the size."""
+        from ..models import CompletionCacheEntry
+
+        deleted, _ = CompletionCacheEntry.objects.filter(
+            created_at__lt=timezone.now() - timedelta(seconds=self.ttl)
+        ).delete()
+        stale = CompletionCacheEntry.objects.order_by("-used_at").values_list(
+            "pk", flat=True
+        )[self.max_size :]
+        if stale:
+            removed, _ = CompletionCacheEntry.objects.filter(pk__in=list(stale)).delete()
+            deleted += removed
+        return deleted
+
+    def clear_memory(self) -> None:
+        with self._lock:
+            self._memory.clear()
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_completion_cache_lookups_total Completion cache lookups, by result.",
+            "# TYPE chatbot_completion_cache_lookups_total counter",
+            f'chatbot_completion_cache_lookups_total{{result="memory_hit"}} {self.memory_hits}',
+            f'chatbot_completion_cache_lookups_total{{result="database_hit"}} {self.database_hits}',
+            f'chatbot_completion_cache_lookups_total{{result="miss"}} {self.misses}',
+            "# HELP chatbot_completion_cache_memory_entries Completions held in memory.",
+            "# TYPE chatbot_completion_cache_memory_entries gauge",
+            f"chatbot_completion_cache_memory_entries {len(self._memory)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> CompletionCache:
+    """Return the process-wide completion cache, creating it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CompletionCache(
+                    ttl=settings.CHATBOT_COMPLETION_CACHE_TTL,
+                    max_size=settings.CHATBOT_COMPLETION_CACHE_SIZE,
+                    memory_size=settings.CHATBOT_COMPLETION_CACHE_MEMORY_SIZE,
+                )
+    return _cache
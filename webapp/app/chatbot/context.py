@@ -0,0 +1,134 @@
+"""Token-budgeted packing of retrieved documents for the "stuff" QA chain.
+
+MedQuAD answers run to thousands of tokens and answers about the same
+focus repeat whole paragraphs. Packing drops the repeats and, when the
+documents do not fit the budget, keeps the sentences that share the most
+words with the question.
+"""
+import functools
+import re
+from typing import List, NamedTuple, Tuple
+
+import tiktoken
+from langchain.schema import Document
+
+from .lexical_index import tokenize
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+_SPACE_RE = re.compile(r"\s+")
+
+# The stuff chain joins documents with a blank line.
+DOCUMENT_SEPARATOR = "\n\n"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class PackedContext(NamedTuple):
+    documents: List[Document]
+    original_tokens: int
+    tokens: int
+
+
+class _Sentence(NamedTuple):
+    document: int
+    line: int
+    text: str
+    tokens: int
+    relevance: int
+
+
+class ContextPacker:
+    """Fits documents into ``budget`` tokens of ``model_name``'s encoding.
+
+    The first line of a document (the MedQuAD question) is kept whenever
+    any of its answer is. Sentences already seen in a higher ranked
+    document are dropped, and so are documents with nothing new left.
+    """
+
+    def __init__(self, budget: int, model_name: str = "text-davinci-003"):
+        self.budget = budget
+        self.encoding = get_encoding(model_name)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def _split(self, documents: List[Document], query_terms: set):
+        """Headers of the documents and their new sentences."""
+        seen = set()
+        headers: List[str] = []
+        sentences: List[_Sentence] = []
+        for number, doc in enumerate(documents):
+            header, _, body = doc.page_content.partition("\n")
+            if not body:
+                header, body = "", header
+            headers.append(header)
+            for line, text in enumerate(body.split("\n")):
+                for sentence in _SENTENCE_RE.split(text.strip()):
+                    key = _SPACE_RE.sub(" ", sentence.lower()).strip()
+                    if not key or key in seen:
+                        continue
+                    seen.add(key)
+                    sentences.append(
+                        _Sentence(
+                            number,
+                            line,
+                            sentence,
+                            self.count(sentence) + 1,
+                            len(query_terms.intersection(tokenize(sentence))),
+                        )
+                    )
+        return headers, sentences
+
+    def _select(self, headers: List[str], sentences: List[_Sentence]):
+        """Sentences that fit, most relevant first, kept in document order."""
+        separator = self.count(DOCUMENT_SEPARATOR)
+        left = self.budget
+        opened = set()
+        chosen = set()
+        ranked = sorted(
+            range(len(sentences)),
+            key=lambda i: (-sentences[i].relevance, sentences[i].document),
+        )
+        for i in ranked:
+            sentence = sentences[i]
+            cost = sentence.tokens
+            if sentence.document not in opened:
+                cost += self.count(headers[sentence.document]) + separator
+            if cost > left:
+                continue
+            left -= cost
+            opened.add(sentence.document)
+            chosen.add(i)
+        return [sentence for i, sentence in enumerate(sentences) if i in chosen]
+
+    def pack(self, documents: List[Document], query: str) -> PackedContext:
+        original = sum(self.count(doc.page_content) for doc in documents)
+        original += self.count(DOCUMENT_SEPARATOR) * max(len(documents) - 1, 0)
+        headers, sentences = self._split(documents, set(tokenize(query)))
+        if sum(s.tokens for s in sentences) + sum(map(self.count, headers)) > self.budget:
+            sentences = self._select(headers, sentences)
+        packed = []
+        for number, doc in enumerate(documents):
+            lines: List[Tuple[int, List[str]]] = []
+            # ``sentences`` keeps document order, so lines come out in order.
+            for sentence in sentences:
+                if sentence.document != number:
+                    continue
+                if lines and lines[-1][0] == sentence.line:
+                    lines[-1][1].append(sentence.text)
+                else:
+                    lines.append((sentence.line, [sentence.text]))
+            if not lines:
+                continue
+            body = [" ".join(texts) for _, texts in lines]
+            content = "\n".join([headers[number]] + body if headers[number] else body)
+            packed.append(Document(page_content=content, metadata=doc.metadata))
+        tokens = sum(self.count(doc.page_content) for doc in packed)
+        tokens += self.count(DOCUMENT_SEPARATOR) * max(len(packed) - 1, 0)
+        return PackedContext(packed, original, tokens)
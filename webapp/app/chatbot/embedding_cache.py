@@ -0,0 +1,235 @@
+"""Content-addressed cache in front of an embeddings client.
+
+This module has no Django dependencies so that the indexing scripts in
+``utils/`` can share the cache with the web app.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class EmbeddingStore:
+    """Append-only float32 matrix on disk, read through a memory map.
+
+    ``keys.txt`` maps content hashes to rows of ``vectors.f32``, one
+    ``<key> <row>`` line each. Several processes may share the directory:
+    writers hold an ``fcntl`` lock on ``vectors.f32`` and number new rows
+    by its size, and readers pick up new ``keys.txt`` lines on a miss.
+    Vectors are written before their keys; what a torn write leaves behind
+    (a vector without a key, half a key line) is cut off under the lock.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.dimensions: Optional[int] = None
+        self.rows: Dict[str, int] = {}
+        self._keys_offset = 0
+        self._matrix = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self._lock, self._locked_vectors() as vectors_file:
+            self._repair(vectors_file)
+            self._refresh()
+
+    @contextlib.contextmanager
+    def _locked_vectors(self):
+        with open(self.vectors_path, "ab") as vectors_file:
+            fcntl.flock(vectors_file, fcntl.LOCK_EX)
+            try:
+                yield vectors_file
+            finally:
+                fcntl.flock(vectors_file, fcntl.LOCK_UN)
+
+    def _repair(self, vectors_file) -> None:
+        """Cut off torn writes; only call while holding the file lock."""
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, "rb+") as keys_file:
+            content = keys_file.read()
+            complete = content[: content.rfind(b"\n") + 1]
+            if complete != content:
+                keys_file.seek(0)
+                keys_file.write(complete)
+                keys_file.truncate()
+        self._read_meta()
+        if self.dimensions is None:
+            return
+        referenced = 1 + max(
+            (int(line.split()[1]) for line in complete.splitlines()), default=-1
+        )
+        if os.fstat(vectors_file.fileno()).st_size > referenced * self.dimensions * 4:
+            vectors_file.truncate(referenced * self.dimensions * 4)
+
+    def _keys_end_cleanly(self) -> bool:
+        if not os.path.exists(self.keys_path):
+            return True
+        with open(self.keys_path, "rb") as keys_file:
+            if not keys_file.seek(0, os.SEEK_END):
+                return True
+            keys_file.seek(-1, os.SEEK_END)
+            return keys_file.read(1) == b"\n"
+
+    def _read_meta(self) -> None:
+        if self.dimensions is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as meta_file:
+                self.dimensions = json.load(meta_file)["dimensions"]
+
+    def _refresh(self) -> None:
+        """Read the complete ``keys.txt`` lines written since the last read."""
+        self._read_meta()
+        if not os.path.exists(self.keys_path):
+            return
+        if os.path.getsize(self.keys_path) == self._keys_offset:
+            return
+        with open(self.keys_path, "rb") as keys_file:
+            keys_file.seek(self._keys_offset)
+            for line in keys_file:
+                if not line.endswith(b"\n"):
+                    # Another process is still writing it.
+                    break
+                self._keys_offset += len(line)
+                key, row = line.split()
+                self.rows[key.decode()] = int(row)
+
+    def _map(self, row: int):
+        if self._matrix is None or len(self._matrix) <= row:
+            self._matrix = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r"
+            ).reshape(-1, self.dimensions)
+        return self._matrix
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self.rows.get(key)
+            if row is None:
+                # Another process may have stored it since.
+                self._refresh()
+                row = self.rows.get(key)
+                if row is None:
+                    return None
+            return np.array(self._map(row)[row])
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]) -> None:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        with self._lock, self._locked_vectors() as vectors_file:
+            if not self._keys_end_cleanly():
+                self._repair(vectors_file)
+            self._refresh()
+            if self.dimensions is None:
+                self.dimensions = matrix.shape[1]
+                with open(self.meta_path, "w") as meta_file:
+                    json.dump({"dimensions": self.dimensions}, meta_file)
+            new = {}
+            for key, vector in zip(keys, matrix):
+                if key not in self.rows:
+                    new.setdefault(key, vector)
+            if not new:
+                return
+            first = os.fstat(vectors_file.fileno()).st_size // (self.dimensions * 4)
+            # Part of a vector may be left by a torn write; keep rows aligned.
+            vectors_file.truncate(first * self.dimensions * 4)
+            for vector in new.values():
+                vectors_file.write(vector.tobytes())
+            vectors_file.flush()
+            with open(self.keys_path, "ab") as keys_file:
+                keys_file.write(
+                    "".join(f"{key} {first + i}\n" for i, key in enumerate(new)).encode()
+                )
+            self._refresh()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an ``Embeddings`` client with an LRU and an on-disk store.
+
+    Texts are keyed by a SHA-256 of the model name and the text itself, so
+    re-indexing unchanged documents or repeating a question costs no calls.
+    """
+
+    def __init__(self, embeddings: Embeddings, directory: str, lru_size: int = 10000):
+        self.embeddings = embeddings
+        self.store = EmbeddingStore(directory)
+        self.lru_size = lru_size
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, kind: str, text: str) -> str:
+        model = getattr(self.embeddings, f"{kind}_model_name", None)
+        model = model or type(self.embeddings).__name__
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                return vector
+        vector = self.store.get(key)
+        if vector is not None:
+            self._remember(key, vector)
+        return vector
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        # float32 arrays take a sixth of the memory of lists of floats.
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key("document", text) for text in texts]
+        vectors = [self._lookup(key) for key in keys]
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None:
+                missing.setdefault(key, text)
+        self.hits += len(texts) - sum(vector is None for vector in vectors)
+        self.misses += len(missing)
+        if missing:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            self.store.put_many(list(missing), computed)
+            for key, vector in zip(missing, computed):
+                self._remember(key, np.asarray(vector, dtype=np.float32))
+            fresh = dict(zip(missing, computed))
+            return [
+                fresh[key] if vector is None else vector.tolist()
+                for key, vector in zip(keys, vectors)
+            ]
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key("query", text)
+        vector = self._lookup(key)
+        if vector is not None:
+            self.hits += 1
+            return vector.tolist()
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        self.store.put_many([key], [vector])
+        self._remember(key, np.asarray(vector, dtype=np.float32))
+        return vector
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "stored": len(self.store),
+        }
@@ -0,0 +1,115 @@
+"""Deterministic local stand-ins for OpenAI models, used by benchmarks."""
+import asyncio
+import re
+import time
+from typing import Any, List, Optional
+
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+
+from .intents import HashingEmbeddings
+
+_TOKEN_RE = re.compile(r"\s*\S+|\s+")
+
+
+async def stream_tokens(llm, text: str) -> None:
+    """Emit ``text`` word by word through the callbacks of ``llm``.
+
+    Tokens are spaced ``1 / llm.tokens_per_second`` apart, or sent back to
+    back when the rate is 0.
+    """
+    manager = llm.callback_manager
+    for token in _TOKEN_RE.findall(text):
+        if llm.tokens_per_second:
+            await asyncio.sleep(1 / llm.tokens_per_second)
+        if manager.is_async:
+            await manager.on_llm_new_token(token, verbose=llm.verbose)
+        else:
+            manager.on_llm_new_token(token, verbose=llm.verbose)
+
+
+class FakeLLM(LLM):
+    """Answers with ``responder(prompt)`` after a fixed ``latency``."""
+
+    responder: Any = None
+    latency: float = 0.0
+    streaming: bool = False
+    tokens_per_second: float = 0.0
+    # Answers are deterministic, like OpenAI models at temperature 0.
+    temperature: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _respond(self, prompt: str) -> str:
+        return self.responder(prompt) if self.responder else "None"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        time.sleep(self.latency)
+        return self._respond(prompt)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        await asyncio.sleep(self.latency)
+        text = self._respond(prompt)
+        if self.streaming:
+            await stream_tokens(self, text)
+        return text
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model counterpart of ``FakeLLM``.
+
+    ``responder`` receives the messages joined into a single string.
+    """
+
+    responder: Any = None
+    latency: float = 0.0
+    streaming: bool = False
+    tokens_per_second: float = 0.0
+    temperature: float = 0.0
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"streaming": self.streaming, "temperature": self.temperature}
+
+    def _respond(self, messages: List[BaseMessage]) -> ChatResult:
+        prompt = "\n".join(message.content for message in messages)
+        text = self.responder(prompt) if self.responder else "None"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _generate(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None
+    ) -> ChatResult:
+        time.sleep(self.latency)
+        return self._respond(messages)
+
+    async def _agenerate(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None
+    ) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        result = self._respond(messages)
+        if self.streaming:
+            await stream_tokens(self, result.generations[0].text)
+        return result
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embeddings that count calls and sleep like a remote API."""
+
+    def __init__(self, dimensions: int = 1536, latency: float = 0.0):
+        self.embeddings = HashingEmbeddings(dimensions)
+        self.latency = latency
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.embeddings.embed_query(text)
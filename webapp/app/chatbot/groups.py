@@ -0,0 +1,19 @@
+"""Group membership lookups used to skip the channel layer."""
+from typing import Optional
+
+from channels.layers import InMemoryChannelLayer
+
+
+async def group_size(channel_layer, group: str) -> Optional[int]:
+    """Return the number of channels in ``group``, or None if unknown.
+
+    The in-memory layer is local to the process, so its group table is
+    exact. channels_redis keeps every group in a sorted set shared by all
+    workers, which is counted with a single ZCARD.
+    """
+    if isinstance(channel_layer, InMemoryChannelLayer):
+        return len(channel_layer.groups.get(group, {}))
+    if hasattr(channel_layer, "_group_key") and hasattr(channel_layer, "connection"):
+        connection = channel_layer.connection(channel_layer.consistent_hash(group))
+        return await connection.zcard(channel_layer._group_key(group))
+    return None
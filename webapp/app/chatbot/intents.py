@@ -0,0 +1,107 @@
+"""Local intent classification in front of the intents LLM chain."""
+import csv
+import os
+import re
+import zlib
+from typing import List, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from .utils import INTENT_EXAMPLES
+
+ABS_PATH = os.path.dirname(os.path.abspath(__file__))
+INTENT_TRAINING_FILE = os.path.join(ABS_PATH, "data", "intent_examples.csv")
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+class HashingEmbeddings(Embeddings):
+    """Local embeddings built from hashed words and character trigrams.
+
+    They are cheap enough to run on every message and need no network,
+    which makes them suitable for routing but not for retrieval.
+    """
+
+    def __init__(self, dimensions: int = 4096):
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD_RE.findall(text.lower())
+        features = [f"w:{word}" for word in words]
+        features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"<{word}>"
+            features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature in self._features(text):
+            vector[zlib.crc32(feature.encode()) % self.dimensions] += 1.0
+        np.log1p(vector, out=vector)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed(text).tolist() for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed(text).tolist()
+
+
+def load_intent_examples(path: str = INTENT_TRAINING_FILE) -> List[dict]:
+    """Return the few-shot prompt examples plus the labelled training file."""
+    examples = list(INTENT_EXAMPLES)
+    if os.path.exists(path):
+        with open(path) as csv_file:
+            examples += list(csv.DictReader(csv_file))
+    return examples
+
+
+class IntentRouter:
+    """Nearest-centroid intent classifier over local embeddings.
+
+    Confidence is the softmax weight of the winning centroid. Messages below
+    ``threshold`` are sent to the LLM intents chain instead.
+    """
+
+    def __init__(
+        self,
+        examples: List[dict] = None,
+        embeddings: HashingEmbeddings = None,
+        threshold: float = 0.6,
+        temperature: float = 0.05,
+    ):
+        if examples is None:
+            examples = load_intent_examples()
+        self.embeddings = embeddings or HashingEmbeddings()
+        self.threshold = threshold
+        self.temperature = temperature
+        self.labels = sorted({example["intent"] for example in examples})
+        centroids = np.zeros(
+            (len(self.labels), self.embeddings.dimensions), dtype=np.float32
+        )
+        for example in examples:
+            index = self.labels.index(example["intent"])
+            centroids[index] += self.embeddings.embed(example["input"])
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        self.centroids = centroids
+        self.llm_fallbacks = 0
+        self.local_hits = 0
+
+    def classify(self, text: str) -> Tuple[str, float]:
+        scores = self.centroids @ self.embeddings.embed(text)
+        weights = np.exp((scores - scores.max()) / self.temperature)
+        weights /= weights.sum()
+        best = int(weights.argmax())
+        return self.labels[best], float(weights[best])
+
+    async def aroute(self, text: str, intents_chain) -> str:
+        """Return the intent, asking ``intents_chain`` only when unsure."""
+        intent, confidence = self.classify(text)
+        if confidence >= self.threshold:
+            self.local_hits += 1
+            return intent
+        self.llm_fallbacks += 1
+        return await intents_chain.arun(input=text)
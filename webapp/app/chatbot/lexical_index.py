@@ -0,0 +1,287 @@
+"""BM25 index of the MedQuAD questions and hybrid lexical + vector retrieval.
+
+Like ``embedding_cache``, this module has no Django dependencies so that
+``utils/write_data_to_vector_db.py`` can rebuild the index whenever it
+writes the vector store.
+"""
+import json
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import BaseRetriever, Document
+
+TERMS_FILE = "terms.json"
+DOCUMENTS_FILE = "documents.json"
+OFFSETS_FILE = "offsets.npy"
+POSTINGS_FILE = "postings.npy"
+FREQUENCIES_FILE = "frequencies.npy"
+LENGTHS_FILE = "lengths.npy"
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Words that carry no meaning in a symptom query or a MedQuAD question.
+STOPWORDS = frozenset(
+    """
+    a about after all also am an and any are as at be been before being but
+    by can could did do does doing for from had has have having he her him
+    his how i if in into is it its just me more most my no not of on or our
+    out over she so some such than that the their them then there these they
+    this those to too under up very was we were what when where which while
+    who whom why will with would you your
+    """.split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def indexed_text(text: str, metadata: Optional[dict]) -> str:
+    """The focus and question of a document, falling back to its first line."""
+    metadata = metadata or {}
+    question = metadata.get("question") or text.split("\n", 1)[0]
+    return f"{metadata.get('focus', '')} {question}"
+
+
+class BM25Index:
+    """Okapi BM25 over the focus and question of each document.
+
+    Postings are stored like a CSR matrix: the rows containing term ``t``
+    are ``postings[offsets[t]:offsets[t + 1]]`` and the term's frequency in
+    each of them is at the same positions of ``frequencies``. The BM25
+    weight of every posting is computed once on load, so a search only
+    adds slices of one float32 array.
+    """
+
+    def __init__(
+        self,
+        terms: List[str],
+        offsets: np.ndarray,
+        postings: np.ndarray,
+        frequencies: np.ndarray,
+        lengths: np.ndarray,
+        texts: List[str],
+        metadatas: List[dict],
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.texts = texts
+        self.metadatas = metadatas
+        documents = len(texts)
+        frequency = np.diff(offsets).astype(np.float32)
+        self.idf = np.log1p((documents - frequency + 0.5) / (frequency + 0.5))
+        # Query terms missing from the index count as the rarest term.
+        self.unknown_idf = float(np.log1p((documents + 0.5) / 0.5))
+        average = float(lengths.mean()) if documents else 1.0
+        norms = k1 * (1 - b + b * lengths[postings] / max(average, 1.0))
+        tf = frequencies.astype(np.float32)
+        self.weights = (
+            np.repeat(self.idf, np.diff(offsets)) * tf * (k1 + 1) / (tf + norms)
+        ).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @classmethod
+    def from_texts(
+        cls, texts: List[str], metadatas: Optional[List[dict]] = None, **kwargs
+    ) -> "BM25Index":
+        metadatas = metadatas or [{} for _ in texts]
+        vocabulary: Dict[str, int] = {}
+        rows: List[List[Tuple[int, int]]] = []
+        lengths = np.zeros(len(texts), dtype=np.int32)
+        for row, (text, metadata) in enumerate(zip(texts, metadatas)):
+            tokens = tokenize(indexed_text(text, metadata))
+            lengths[row] = len(tokens)
+            for token in tokens:
+                term = vocabulary.setdefault(token, len(vocabulary))
+                if len(rows) <= term:
+                    rows.append([])
+                postings = rows[term]
+                if postings and postings[-1][0] == row:
+                    postings[-1] = (row, postings[-1][1] + 1)
+                else:
+                    postings.append((row, 1))
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings) for postings in rows])
+        flat = [posting for postings in rows for posting in postings]
+        return cls(
+            list(vocabulary),
+            offsets,
+            np.array([row for row, _ in flat], dtype=np.int32),
+            np.array([count for _, count in flat], dtype=np.uint16),
+            lengths,
+            list(texts),
+            list(metadatas),
+            **kwargs,
+        )
+
+    @classmethod
+    def from_chroma(cls, collection, **kwargs) -> "BM25Index":
+        data = collection.get(include=["documents", "metadatas"])
+        return cls.from_texts(data["documents"], data["metadatas"], **kwargs)
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, TERMS_FILE), "w") as terms_file:
+            json.dump(list(self.terms), terms_file)
+        with open(os.path.join(directory, DOCUMENTS_FILE), "w") as documents_file:
+            json.dump({"texts": self.texts, "metadatas": self.metadatas}, documents_file)
+        for name, array in (
+            (OFFSETS_FILE, self.offsets),
+            (POSTINGS_FILE, self.postings),
+            (FREQUENCIES_FILE, self.frequencies),
+            (LENGTHS_FILE, self.lengths),
+        ):
+            np.save(os.path.join(directory, name), array)
+
+    @classmethod
+    def load(cls, directory: str, **kwargs) -> "BM25Index":
+        with open(os.path.join(directory, TERMS_FILE)) as terms_file:
+            terms = json.load(terms_file)
+        with open(os.path.join(directory, DOCUMENTS_FILE)) as documents_file:
+            documents = json.load(documents_file)
+        arrays = [
+            np.load(os.path.join(directory, name))
+            for name in (OFFSETS_FILE, POSTINGS_FILE, FREQUENCIES_FILE, LENGTHS_FILE)
+        ]
+        return cls(terms, *arrays, documents["texts"], documents["metadatas"], **kwargs)
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray, float]:
+        """Best ``k`` rows with their scores, and the confidence of the best.
+
+        The confidence is the best score over the sum of the idf of the
+        query terms, i.e. about 1.0 for an average length question that
+        contains every term of the query once.
+        """
+        tokens = set(tokenize(query))
+        scores = np.zeros(len(self), dtype=np.float32)
+        ceiling = 0.0
+        for token in tokens:
+            term = self.terms.get(token)
+            if term is None:
+                ceiling += self.unknown_idf
+                continue
+            ceiling += float(self.idf[term])
+            start, end = self.offsets[term], self.offsets[term + 1]
+            scores[self.postings[start:end]] += self.weights[start:end]
+        if not ceiling:
+            return np.array([], dtype=int), scores[:0], 0.0
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k)[:k]]
+        best = matched[np.argsort(-scores[matched], kind="stable")]
+        confidence = float(scores[best[0]]) / ceiling if len(best) else 0.0
+        return best, scores[best], confidence
+
+    def document(self, row: int) -> Document:
+        return Document(page_content=self.texts[row], metadata=self.metadatas[row])
+
+
+def reciprocal_rank_fusion(
+    rankings: Iterable[List[Document]], k: int, rrf_k: int = 60
+) -> List[Document]:
+    """Merge ranked lists by the sum of ``1 / (rrf_k + rank)`` per document."""
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1 / (
+                rrf_k + rank
+            )
+            documents.setdefault(doc.page_content, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[text] for text in best]
+
+
+class HybridRetriever(BaseRetriever):
+    """BM25 in front of a vector retriever, fused by reciprocal rank.
+
+    When the best lexical match reaches ``confidence`` (e.g. "neck pain"
+    against the "Neck Pain" questions) the lexical results are returned
+    as is and the query is never embedded. Otherwise the ``fetch_k`` best
+    lexical rows and the vector results are merged with RRF.
+
+    ``lexical_query``, when given, is what BM25 searches instead of the
+    query, e.g. the user's own words without the health profile that the
+    symptoms chain appends: profile terms such as "diabetes" would
+    otherwise outrank the actual symptom.
+    """
+
+    def __init__(
+        self,
+        lexical: BM25Index,
+        vector_retriever: BaseRetriever,
+        k: int = 4,
+        fetch_k: int = 20,
+        confidence: float = 0.9,
+        rrf_k: int = 60,
+    ):
+        self.lexical = lexical
+        self.vector_retriever = vector_retriever
+        self.k = k
+        self.fetch_k = fetch_k
+        self.confidence = confidence
+        self.rrf_k = rrf_k
+        self.lexical_only = 0
+        self.fused = 0
+        self._lock = threading.Lock()
+
+    def _lexical(self, query: str) -> Tuple[List[Document], bool]:
+        rows, _, confidence = self.lexical.search(query, self.fetch_k)
+        docs = [self.lexical.document(row) for row in rows]
+        confident = confidence >= self.confidence
+        with self._lock:
+            if confident:
+                self.lexical_only += 1
+            else:
+                self.fused += 1
+        return docs, confident
+
+    def _fuse(self, lexical: List[Document], vector: List[Document]) -> List[Document]:
+        return reciprocal_rank_fusion([lexical, vector], self.k, self.rrf_k)
+
+    def get_relevant_documents(
+        self, query: str, lexical_query: Optional[str] = None
+    ) -> List[Document]:
+        lexical, confident = self._lexical(lexical_query or query)
+        if confident:
+            return lexical[: self.k]
+        vector = self.vector_retriever.get_relevant_documents(query)
+        return self._fuse(lexical, vector)
+
+    async def aget_relevant_documents(
+        self, query: str, lexical_query: Optional[str] = None
+    ) -> List[Document]:
+        lexical, confident = self._lexical(lexical_query or query)
+        if confident:
+            return lexical[: self.k]
+        vector = await self.vector_retriever.aget_relevant_documents(query)
+        return self._fuse(lexical, vector)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_retrievals_total Document retrievals, by method.",
+            "# TYPE chatbot_retrievals_total counter",
+            f'chatbot_retrievals_total{{method="lexical"}} {self.lexical_only}',
+            f'chatbot_retrievals_total{{method="hybrid"}} {self.fused}',
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def init_hybrid_retriever(vector_retriever: BaseRetriever, directory, **kwargs):
+    """Wrap ``vector_retriever`` with the BM25 index saved in ``directory``."""
+    if not os.path.exists(os.path.join(directory, TERMS_FILE)):
+        raise Exception(
+            f"No lexical index in {directory}. "
+            "Please run `python manage.py build_lexical_index` to create it."
+        )
+    return HybridRetriever(BM25Index.load(str(directory)), vector_retriever, **kwargs)
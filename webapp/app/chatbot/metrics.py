@@ -0,0 +1,179 @@
+"""Process-wide aggregates of chat turn timings, in Prometheus text format."""
+import atexit
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from .timing import StageTimer
+
+_STOP = object()
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets: List[int] = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = [
+            f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+            for bound, count in zip(BUCKETS, self.buckets)
+        ]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class TraceWriter:
+    """Appends JSON lines to ``path`` from a thread of its own.
+
+    ``write`` only queues the record, so a slow disk never blocks the
+    event loop; the thread writes whatever has queued up in one go.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record: dict) -> None:
+        self._start()
+        self._queue.put(record)
+
+    def _start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    if self._thread is None:
+                        atexit.register(self.stop)
+                    self._thread = threading.Thread(
+                        target=self._run, name="trace-writer", daemon=True
+                    )
+                    self._thread.start()
+
+    def stop(self) -> None:
+        """Write what is queued and stop the thread."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(_STOP)
+                self._thread.join()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            records = [self._queue.get()]
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in records:
+                stopping = True
+                records = [record for record in records if record is not _STOP]
+            if records:
+                with open(self.path, "a") as trace:
+                    trace.writelines(json.dumps(record) + "\n" for record in records)
+
+
+class TurnMetrics:
+    """Collects the ``StageTimer`` of every finished turn.
+
+    Stage durations and marks (e.g. time to first token) become histograms
+    labelled by handler, counts become counters. With ``trace_file`` set,
+    every turn is also appended to it as one JSON line, by a ``TraceWriter``.
+    """
+
+    def __init__(self, trace_file: Optional[str] = None):
+        self.trace_file = trace_file
+        self.trace = TraceWriter(trace_file) if trace_file else None
+        self.turns: Dict[str, int] = defaultdict(int)
+        self.stages: Dict[tuple, Histogram] = defaultdict(Histogram)
+        self.marks: Dict[tuple, Histogram] = defaultdict(Histogram)
+        self.counts: Dict[tuple, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def observe(self, handler: str, timer: StageTimer, session_key: str = "") -> None:
+        total = timer.elapsed()
+        with self._lock:
+            self.turns[handler] += 1
+            self.stages[(handler, "total")].observe(total)
+            for stage, seconds in timer.stages.items():
+                self.stages[(handler, stage)].observe(seconds)
+            for mark, seconds in timer.marks.items():
+                self.marks[(handler, mark)].observe(seconds)
+            for name, value in timer.counts.items():
+                self.counts[(handler, name)] += value
+        if self.trace is not None:
+            self.trace.write(
+                {
+                    "time": time.time(),
+                    "session": session_key,
+                    "handler": handler,
+                    **timer.as_dict(),
+                }
+            )
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_turns_total Chat turns answered, by handler.",
+            "# TYPE chatbot_turns_total counter",
+        ]
+        with self._lock:
+            for handler, count in sorted(self.turns.items()):
+                lines.append(f'chatbot_turns_total{{handler="{handler}"}} {count}')
+            lines += [
+                "# HELP chatbot_stage_seconds Wall time of each stage of a turn.",
+                "# TYPE chatbot_stage_seconds histogram",
+            ]
+            for (handler, stage), histogram in sorted(self.stages.items()):
+                lines += histogram.render(
+                    "chatbot_stage_seconds", f'handler="{handler}",stage="{stage}"'
+                )
+            lines += [
+                "# HELP chatbot_event_seconds Time from the start of a turn to an event.",
+                "# TYPE chatbot_event_seconds histogram",
+            ]
+            for (handler, mark), histogram in sorted(self.marks.items()):
+                lines += histogram.render(
+                    "chatbot_event_seconds", f'handler="{handler}",event="{mark}"'
+                )
+            lines += [
+                "# HELP chatbot_turn_count_total Tokens, documents and other counts per turn.",
+                "# TYPE chatbot_turn_count_total counter",
+            ]
+            for (handler, name), value in sorted(self.counts.items()):
+                lines.append(
+                    f'chatbot_turn_count_total{{handler="{handler}",name="{name}"}} {value}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> TurnMetrics:
+    """Return the process-wide metrics, creating them on first use."""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = TurnMetrics(trace_file=settings.CHATBOT_TRACE_FILE)
+    return _metrics
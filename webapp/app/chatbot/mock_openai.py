@@ -0,0 +1,151 @@
+"""Local OpenAI-compatible server for load tests, built on aiohttp.
+
+Serves /v1/completions, /v1/chat/completions (both with streaming) and
+/v1/embeddings. Every answer is ``answer_tokens`` words sent after
+``latency`` seconds at ``tokens_per_second``; ``error_rate`` of the requests
+fail with a 503 to exercise retries.
+"""
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+from .intents import HashingEmbeddings
+
+
+class MockOpenAIServer:
+    def __init__(
+        self,
+        latency: float = 0.2,
+        tokens_per_second: float = 50.0,
+        answer_tokens: int = 50,
+        error_rate: float = 0.0,
+        dimensions: int = 1536,
+    ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.tokens = [f"word{i} " for i in range(answer_tokens)]
+        self.embeddings = HashingEmbeddings(dimensions)
+        self.requests = 0
+        self.errors = 0
+        self._transports = set()
+
+    @property
+    def connections(self) -> int:
+        """Number of distinct TCP connections that sent a request."""
+        return len(self._transports)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/completions", self.completions)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/embeddings", self.embeddings_view)
+        return app
+
+    async def _start(self, request):
+        self.requests += 1
+        self._transports.add(id(request.transport))
+        await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise web.HTTPServiceUnavailable(
+                text=json.dumps({"error": {"message": "Mock overload", "type": "server_error"}}),
+                content_type="application/json",
+            )
+        return await request.json()
+
+    def _usage(self, prompt_tokens: int) -> dict:
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(self.tokens),
+            "total_tokens": prompt_tokens + len(self.tokens),
+        }
+
+    async def _stream(self, request, chunk):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in self.tokens:
+            if self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            await response.write(f"data: {json.dumps(chunk(token))}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def completions(self, request):
+        body = await self._start(request)
+        prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+        if body.get("stream"):
+            return await self._stream(
+                request,
+                lambda token: {
+                    "object": "text_completion",
+                    "model": body["model"],
+                    "choices": [
+                        {"text": token, "index": 0, "logprobs": None, "finish_reason": None}
+                    ],
+                },
+            )
+        text = "".join(self.tokens)
+        return web.json_response(
+            {
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {"text": text, "index": i, "logprobs": None, "finish_reason": "stop"}
+                    for i in range(len(prompts))
+                ],
+                "usage": self._usage(sum(len(p.split()) for p in prompts)),
+            }
+        )
+
+    async def chat_completions(self, request):
+        body = await self._start(request)
+        if body.get("stream"):
+            return await self._stream(
+                request,
+                lambda token: {
+                    "object": "chat.completion.chunk",
+                    "model": body["model"],
+                    "choices": [
+                        {"delta": {"content": token}, "index": 0, "finish_reason": None}
+                    ],
+                },
+            )
+        prompt = " ".join(message["content"] for message in body["messages"])
+        return web.json_response(
+            {
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(self.tokens)},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": self._usage(len(prompt.split())),
+            }
+        )
+
+    async def embeddings_view(self, request):
+        body = await self._start(request)
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        # langchain may send token ids instead of text.
+        texts = [text if isinstance(text, str) else " ".join(map(str, text)) for text in texts]
+        return web.json_response(
+            {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": vector}
+                    for i, vector in enumerate(self.embeddings.embed_documents(texts))
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+        )
@@ -0,0 +1,183 @@
+"""Connection pools shared by every OpenAI request of the process.
+
+Unless ``openai.aiosession`` is set, openai opens a new aiohttp session, and
+so a new TCP and TLS connection, for every async request. Blocking requests
+keep one session per thread. The pools here are sized and retried from
+settings; ``OPENAI_API_BASE`` can point them at a local mock server.
+"""
+import asyncio
+import atexit
+import random
+import threading
+import weakref
+
+import aiohttp
+import openai
+import requests
+from django.conf import settings
+from openai import api_requestor
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def openai_llm_kwargs() -> dict:
+    """Timeout and retry arguments for OpenAI and ChatOpenAI.
+
+    Failed requests are retried in the transport with jitter, so langchain
+    makes a single attempt instead of its own fixed 4-10s backoff.
+    """
+    return {"request_timeout": settings.OPENAI_REQUEST_TIMEOUT, "max_retries": 1}
+
+
+class RetryingSession:
+    """Stands in for the aiohttp session openai uses, retrying failed requests.
+
+    Connection errors and ``RETRY_STATUSES`` are retried up to
+    ``max_retries`` times with full-jitter exponential backoff, honouring
+    Retry-After. Timeouts are not retried.
+    """
+
+    def __init__(self, session, max_retries=3, backoff=0.5, max_backoff=8.0):
+        self.session = session
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+        self.closer = None
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed
+
+    async def request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            retry_after = 0.0
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except aiohttp.ClientConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if response.status not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                try:
+                    retry_after = float(response.headers.get("Retry-After", 0))
+                except ValueError:
+                    pass
+                response.release()
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+            await asyncio.sleep(max(delay, retry_after))
+            attempt += 1
+            self.retries += 1
+
+    async def close(self) -> None:
+        await self.session.close()
+
+
+_async_sessions = weakref.WeakKeyDictionary()
+
+
+async def _close_at_shutdown(session: RetryingSession) -> None:
+    """Wait until cancelled, then close ``session``.
+
+    asyncio.run and async_to_sync cancel the tasks left on their loop before
+    closing it, which is the only hook a loop offers.
+    """
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await session.close()
+
+
+@atexit.register
+def _close_async_sessions() -> None:
+    """Close the sessions of loops that are still open at exit, e.g. daphne's."""
+    for loop, session in list(_async_sessions.items()):
+        if not session.closed and not loop.is_closed() and not loop.is_running():
+            loop.run_until_complete(session.close())
+
+
+def get_async_session() -> RetryingSession:
+    """Return the pooled session of the running event loop.
+
+    It is closed when the loop shuts down.
+    """
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.OPENAI_MAX_CONNECTIONS,
+            limit_per_host=settings.OPENAI_MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=settings.OPENAI_KEEPALIVE_TIMEOUT,
+        )
+        session = RetryingSession(
+            aiohttp.ClientSession(connector=connector),
+            max_retries=settings.OPENAI_MAX_RETRIES,
+            backoff=settings.OPENAI_RETRY_BACKOFF,
+            max_backoff=settings.OPENAI_RETRY_MAX_BACKOFF,
+        )
+        _async_sessions[loop] = session
+        # Held by the session, or the pending task could be collected.
+        session.closer = loop.create_task(_close_at_shutdown(session))
+    return session
+
+
+class OpenAISessionMiddleware:
+    """ASGI middleware that sends a connection's OpenAI calls through the pool.
+
+    ``openai.aiosession`` is a context variable, so it is set for every
+    connection; tasks and sync_to_async threads started from it inherit it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        token = openai.aiosession.set(get_async_session())
+        try:
+            return await self.app(scope, receive, send)
+        finally:
+            openai.aiosession.reset(token)
+
+
+_requests_session = None
+_requests_session_lock = threading.Lock()
+
+
+def get_requests_session() -> requests.Session:
+    """Return the blocking session shared by all threads."""
+    global _requests_session
+    if _requests_session is None:
+        with _requests_session_lock:
+            if _requests_session is None:
+                retry = Retry(
+                    total=settings.OPENAI_MAX_RETRIES,
+                    backoff_factor=settings.OPENAI_RETRY_BACKOFF,
+                    backoff_max=settings.OPENAI_RETRY_MAX_BACKOFF,
+                    backoff_jitter=settings.OPENAI_RETRY_BACKOFF,
+                    status_forcelist=RETRY_STATUSES,
+                    allowed_methods=None,
+                    raise_on_status=False,
+                )
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=settings.OPENAI_MAX_CONNECTIONS_PER_HOST,
+                    pool_maxsize=settings.OPENAI_MAX_CONNECTIONS,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _requests_session = session
+    return _requests_session
+
+
+def install_openai_pools() -> None:
+    """Make openai's blocking requests use the shared session and timeout.
+
+    openai 0.27 has no public hook for this; it creates a session per thread
+    with ``api_requestor._make_session``.
+    """
+    api_requestor._make_session = get_requests_session
+    api_requestor.TIMEOUT_SECS = settings.OPENAI_REQUEST_TIMEOUT
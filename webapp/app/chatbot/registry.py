@@ -0,0 +1,164 @@
+"""Process-wide registry of the chatbot resources shared by all connections."""
+import threading
+from typing import NamedTuple
+
+from django.conf import settings
+from langchain.chains import ConversationalRetrievalChain, ConversationChain
+from langchain.chains.llm import LLMChain
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.memory import ConversationBufferMemory
+
+from .chains import (
+    get_appointment_chain,
+    get_general_chat_chain,
+    get_intents_chain,
+    get_symptoms_chain,
+)
+from .context import ContextPacker
+from .embedding_cache import CachedEmbeddings
+from .intents import IntentRouter
+from .lexical_index import init_hybrid_retriever
+from .openai_client import install_openai_pools
+from .response_cache import SemanticResponseCache
+from .utils import (
+    get_appointment_json_prompt,
+    get_general_chat_prompt,
+    get_intent_prompt,
+    get_symptoms_qa_prompt,
+    init_retriever,
+)
+from .vector_index import init_numpy_retriever
+
+
+class SessionChains(NamedTuple):
+    """Chains bound to the callback handlers of a single connection."""
+
+    intents: LLMChain
+    symptoms_qa: ConversationalRetrievalChain
+    general_chat: LLMChain
+    appointment: ConversationChain
+
+
+class ChatbotRegistry:
+    """Loads the vector store, embeddings client and prompts once per process.
+
+    Connections only build thin chain wrappers around these objects, so the
+    cost of a connect no longer depends on the size of the vector store.
+    ``embeddings`` and ``retriever`` default to OpenAI and the persisted
+    Chroma collection; benchmarks pass local fakes instead.
+    """
+
+    def __init__(self, embeddings=None, retriever=None):
+        install_openai_pools()
+        self.embeddings = embeddings or CachedEmbeddings(
+            # Retries happen in the shared requests session, with jitter.
+            OpenAIEmbeddings(max_retries=1),
+            settings.CHATBOT_EMBEDDING_CACHE_DIR,
+        )
+        if retriever is None:
+            retriever = self.init_retriever()
+        self.retriever = retriever
+        self.intent_prompt = get_intent_prompt()
+        self.symptoms_qa_prompt = get_symptoms_qa_prompt()
+        self.general_chat_prompt = get_general_chat_prompt()
+        self.appointment_prompt = get_appointment_json_prompt()
+        # The intents chain has no per-connection callbacks, so a single
+        # instance is shared by every session.
+        self.intents_chain = get_intents_chain(chat_prompt=self.intent_prompt)
+        self.intent_router = IntentRouter(
+            threshold=settings.CHATBOT_INTENT_CONFIDENCE
+        )
+        self.response_cache = SemanticResponseCache(
+            threshold=settings.CHATBOT_RESPONSE_CACHE_THRESHOLD,
+            ttl=settings.CHATBOT_RESPONSE_CACHE_TTL,
+            max_size=settings.CHATBOT_RESPONSE_CACHE_SIZE,
+        )
+        self.context_packer = None
+        if settings.CHATBOT_CONTEXT_TOKEN_BUDGET:
+            self.context_packer = ContextPacker(settings.CHATBOT_CONTEXT_TOKEN_BUDGET)
+
+    def init_retriever(self):
+        """The retriever chosen by CHATBOT_VECTOR_INDEX and CHATBOT_HYBRID_RETRIEVAL."""
+        if settings.CHATBOT_VECTOR_INDEX == "numpy":
+            retriever = init_numpy_retriever(
+                self.embeddings,
+                settings.CHATBOT_VECTOR_INDEX_DIR,
+                nprobe=settings.CHATBOT_VECTOR_INDEX_NPROBE,
+            )
+        else:
+            retriever = init_retriever(embeddings=self.embeddings)
+        if settings.CHATBOT_HYBRID_RETRIEVAL:
+            retriever = init_hybrid_retriever(
+                retriever,
+                settings.CHATBOT_LEXICAL_INDEX_DIR,
+                confidence=settings.CHATBOT_HYBRID_LEXICAL_CONFIDENCE,
+                rrf_k=settings.CHATBOT_HYBRID_RRF_K,
+            )
+        return retriever
+
+    def render(self) -> str:
+        render = getattr(self.retriever, "render", None)
+        return self.response_cache.render() + (render() if render else "")
+
+    def build_session_chains(
+        self,
+        question_handler,
+        stream_handler,
+        memory: ConversationBufferMemory,
+        tracing: bool = False,
+        cache_scope: str = "",
+        instrument=None,
+    ) -> SessionChains:
+        symptoms_qa = get_symptoms_chain(
+            self.retriever,
+            question_handler,
+            stream_handler,
+            tracing=tracing,
+            qa_prompt=self.symptoms_qa_prompt,
+            response_cache=self.response_cache,
+            embeddings=self.embeddings,
+            cache_scope=cache_scope,
+            instrument=instrument,
+            context_packer=self.context_packer,
+        )
+        general_chat = get_general_chat_chain(
+            stream_handler,
+            memory=memory,
+            chat_prompt=self.general_chat_prompt,
+            instrument=instrument,
+        )
+        appointment = get_appointment_chain(
+            memory, chat_prompt=self.appointment_prompt, instrument=instrument
+        )
+        return SessionChains(
+            intents=self.intents_chain,
+            symptoms_qa=symptoms_qa,
+            general_chat=general_chat,
+            appointment=appointment,
+        )
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ChatbotRegistry:
+    """Return the process-wide registry, creating it on first use."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ChatbotRegistry()
+    return _registry
+
+
+def render_registry() -> str:
+    """Metrics of the registry, without loading it just for them."""
+    return _registry.render() if _registry is not None else ""
+
+
+def set_registry(registry: ChatbotRegistry) -> None:
+    """Replace the process-wide registry, e.g. with one built on fakes."""
+    global _registry
+    with _registry_lock:
+        _registry = registry
@@ -0,0 +1,112 @@
+"""Semantic cache of symptoms answers keyed by question embeddings."""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+
+def get_cache_scope(health_data: str) -> str:
+    """Answers are only shared between users with identical health data."""
+    return hashlib.sha256(health_data.encode()).hexdigest()
+
+
+class SemanticResponseCache:
+    """Fixed-size matrix of normalised question vectors and their answers.
+
+    A lookup returns the answer of the most similar stored question within
+    the same scope if its cosine similarity reaches ``threshold``. Entries
+    expire after ``ttl`` seconds and the least recently used one is replaced
+    once ``max_size`` is reached.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_size: int = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.replaced = 0
+        self._vectors = None
+        self._entries = [None] * max_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _normalise(self, vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector: List[float], scope: str) -> Optional[str]:
+        query = self._normalise(vector)
+        now = time.monotonic()
+        with self._lock:
+            if self._vectors is not None:
+                scores = self._vectors @ query
+                for slot in np.argsort(-scores):
+                    if scores[slot] < self.threshold:
+                        break
+                    entry = self._entries[slot]
+                    if entry is None or entry[0] != scope:
+                        continue
+                    if now - entry[2] > self.ttl:
+                        self._evict(slot)
+                        self.expired += 1
+                        continue
+                    self._lru.move_to_end(slot)
+                    self.hits += 1
+                    return entry[1]
+            self.misses += 1
+            return None
+
+    def store(self, vector: List[float], scope: str, answer: str) -> None:
+        query = self._normalise(vector)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_size, len(query)), dtype=np.float32)
+            if len(self._lru) < self.max_size:
+                slot = self._entries.index(None)
+            else:
+                slot, _ = self._lru.popitem(last=False)
+                self.replaced += 1
+            self._vectors[slot] = query
+            self._entries[slot] = (scope, answer, time.monotonic())
+            self._lru[slot] = None
+
+    def _evict(self, slot: int) -> None:
+        self._vectors[slot] = 0
+        self._entries[slot] = None
+        self._lru.pop(slot, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "expired": self.expired,
+            "replaced": self.replaced,
+            "size": len(self._lru),
+        }
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_response_cache_lookups_total Semantic response cache lookups, by result.",
+            "# TYPE chatbot_response_cache_lookups_total counter",
+            f'chatbot_response_cache_lookups_total{{result="hit"}} {self.hits}',
+            f'chatbot_response_cache_lookups_total{{result="miss"}} {self.misses}',
+            "# HELP chatbot_response_cache_evictions_total Answers dropped, by reason.",
+            "# TYPE chatbot_response_cache_evictions_total counter",
+            f'chatbot_response_cache_evictions_total{{reason="expired"}} {self.expired}',
+            f'chatbot_response_cache_evictions_total{{reason="lru"}} {self.replaced}',
+            "# HELP chatbot_response_cache_entries Answers held by the cache.",
+            "# TYPE chatbot_response_cache_entries gauge",
+            f"chatbot_response_cache_entries {len(self._lru)}",
+            "# HELP chatbot_response_cache_capacity Answers the cache can hold.",
+            "# TYPE chatbot_response_cache_capacity gauge",
+            f"chatbot_response_cache_capacity {self.max_size}",
+        ]
+        return "\n".join(lines) + "\n"
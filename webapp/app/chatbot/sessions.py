@@ -0,0 +1,208 @@
+"""Per-session conversation state with a bounded token budget."""
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Tuple
+
+import tiktoken
+from channels.db import database_sync_to_async
+from django.conf import settings
+from langchain.memory import ConversationBufferMemory
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+class BoundedConversationMemory(ConversationBufferMemory):
+    """Conversation buffer that drops the oldest messages above a token limit."""
+
+    max_token_limit: int = 1000
+
+    def save_context(self, inputs, outputs) -> None:
+        super().save_context(inputs, outputs)
+        messages = self.chat_memory.messages
+        total = sum(count_tokens(message.content) for message in messages)
+        while messages and total > self.max_token_limit:
+            total -= count_tokens(messages.pop(0).content)
+
+
+class ConversationSession:
+    """Chat history and appointment memory of a single chat box/user pair."""
+
+    def __init__(self, key: str, token_limit: int):
+        self.key = key
+        self.token_limit = token_limit
+        self.chat_history: List[Tuple[str, str]] = []
+        self.memory = BoundedConversationMemory(max_token_limit=token_limit)
+        self.last_used = time.monotonic()
+        self._history_tokens: List[int] = []
+
+    def add_turn(self, question: str, answer: str) -> None:
+        self.chat_history.append((question, answer))
+        self._history_tokens.append(count_tokens(question) + count_tokens(answer))
+        total = sum(self._history_tokens)
+        while self.chat_history and total > self.token_limit:
+            self.chat_history.pop(0)
+            total -= self._history_tokens.pop(0)
+
+
+class ConversationStore:
+    """LRU of live sessions; subclasses decide where turns are persisted.
+
+    Subclasses that store turns set ``persists``, otherwise no write is
+    dispatched to the database executor at all.
+    """
+
+    persists = False
+
+    def __init__(self, max_sessions: int, idle_timeout: float, token_limit: int):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.token_limit = token_limit
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> ConversationSession:
+        """Return the session for ``key``, loading it from the backend on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                session.last_used = now
+                return session
+        session = self.load(key)
+        with self._lock:
+            session = self._sessions.setdefault(key, session)
+            self._sessions.move_to_end(key)
+            self._evict(now)
+        return session
+
+    def _evict(self, now: float) -> None:
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            idle = now - session.last_used > self.idle_timeout
+            if not idle and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[key]
+
+    def load(self, key: str) -> ConversationSession:
+        return ConversationSession(key, self.token_limit)
+
+    def persist(
+        self, key: str, kind: str, question: str, answer: str, keep: int
+    ) -> None:
+        """Store a turn, keeping the ``keep`` newest turns of its kind."""
+
+    async def aadd_turn(self, session: ConversationSession, question, answer):
+        session.add_turn(question, answer)
+        if self.persists:
+            await database_sync_to_async(self.persist)(
+                session.key, "history", question, answer, len(session.chat_history)
+            )
+
+    async def asave_context(self, session: ConversationSession, question, answer):
+        session.memory.save_context({"input": question}, {"output": answer})
+        await self.apersist_memory(session, question, answer)
+
+    async def apersist_memory(self, session: ConversationSession, question, answer):
+        """Persist a memory turn that a chain already saved to ``session.memory``."""
+        if self.persists:
+            # The buffer drops single messages; a half-kept turn still loads.
+            keep = -(-len(session.memory.chat_memory.messages) // 2)
+            await database_sync_to_async(self.persist)(
+                session.key, "memory", question, answer, keep
+            )
+
+
+class InMemoryConversationStore(ConversationStore):
+    pass
+
+
+class DatabaseConversationStore(ConversationStore):
+    """Keeps the LRU in front of ``ConversationTurn`` rows in the Django DB.
+
+    Rows that fell out of the session's token window are deleted as new
+    turns are written, so a session never holds more rows than it loads.
+    """
+
+    persists = True
+
+    def load(self, key: str) -> ConversationSession:
+        from ..models import ConversationTurn
+
+        session = super().load(key)
+        turns = ConversationTurn.objects.filter(session_key=key).order_by("-id")
+        # Rows are read newest first and stop once both buffers are full.
+        history, memory = [], []
+        history_tokens = memory_tokens = 0
+        for turn in turns.iterator():
+            tokens = count_tokens(turn.question) + count_tokens(turn.answer)
+            if turn.kind == ConversationTurn.HISTORY:
+                if history_tokens + tokens <= self.token_limit:
+                    history.append(turn)
+                    history_tokens += tokens
+            elif memory_tokens + tokens <= self.token_limit:
+                memory.append(turn)
+                memory_tokens += tokens
+            if history_tokens >= self.token_limit and memory_tokens >= self.token_limit:
+                break
+        for turn in reversed(history):
+            session.add_turn(turn.question, turn.answer)
+        for turn in reversed(memory):
+            session.memory.save_context(
+                {"input": turn.question}, {"output": turn.answer}
+            )
+        return session
+
+    def persist(
+        self, key: str, kind: str, question: str, answer: str, keep: int
+    ) -> None:
+        from ..models import ConversationTurn
+
+        turn = ConversationTurn.objects.create(
+            session_key=key, kind=kind, question=question, answer=answer
+        )
+        turns = ConversationTurn.objects.filter(
+            session_key=key, kind=kind, id__lte=turn.id
+        )
+        kept = turns.order_by("-id").values_list("id", flat=True)
+        oldest_kept = kept[max(keep, 1) - 1 : max(keep, 1)].first()
+        if oldest_kept is not None:
+            turns.filter(id__lt=oldest_kept).delete()
+
+
+CONVERSATION_STORE_BACKENDS = {
+    "memory": InMemoryConversationStore,
+    "database": DatabaseConversationStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = CONVERSATION_STORE_BACKENDS[settings.CHAT_SESSION_BACKEND]
+                _store = backend(
+                    max_sessions=settings.CHAT_SESSION_MAX_SESSIONS,
+                    idle_timeout=settings.CHAT_SESSION_IDLE_TIMEOUT,
+                    token_limit=settings.CHAT_HISTORY_TOKEN_LIMIT,
+                )
+    return _store
+
+
+def get_session_key(user, chat_box_name: str) -> str:
+    user_id = user.pk if user is not None and user.is_authenticated else "anonymous"
+    return f"{user_id}:{chat_box_name}"
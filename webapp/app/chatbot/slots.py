@@ -0,0 +1,264 @@
+"""Booked appointment slots per day, for conflict checks and free slot offers.
+
+Every appointment lasts ``minutes``; at most ``capacity`` of them may
+overlap. The index holds the sorted start minutes of each day from the day
+it was loaded, so checking a slot is a bisect instead of a query. It is
+kept current by the Appointment signals in app/signals.py and by the
+appointment tools for batched inserts, which send no signals.
+
+Bookings made by other server processes are not in the index, so every
+insert checks its slot again against the database in its own transaction
+(``check_database``), which also reloads the days it checked. On SQLite a
+row committed by another process between that check and the insert makes
+the insert fail with "database is locked" instead of double booking.
+"""
+import bisect
+import threading
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+
+def _minute(value: time) -> int:
+    return value.hour * 60 + value.minute
+
+
+def _slot(appointment) -> Tuple[date, int]:
+    """Day and start minute, also of fields assigned as strings."""
+    if isinstance(appointment.date, str) or isinstance(appointment.time, str):
+        field = appointment._meta.get_field
+        return (
+            field("date").to_python(appointment.date),
+            _minute(field("time").to_python(appointment.time)),
+        )
+    return appointment.date, _minute(appointment.time)
+
+
+class SlotTaken(Exception):
+    """The database already holds an overlapping appointment."""
+
+    def __init__(self, appointment):
+        super().__init__(f"{appointment.date} {appointment.time} is already booked")
+        self.appointment = appointment
+
+
+class SlotIndex:
+    def __init__(
+        self,
+        minutes: int = 30,
+        capacity: int = 1,
+        hours: Tuple[int, int] = (8, 19),
+        weekdays: Tuple[int, ...] = (0, 1, 2, 3, 4),
+    ):
+        self.minutes = minutes
+        self.capacity = capacity
+        self.hours = hours
+        self.weekdays = weekdays
+        self.conflicts = 0
+        self._days: Dict[date, List[int]] = defaultdict(list)
+        self._where: Dict[object, Tuple[date, int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def load(self, since: date) -> None:
+        """Index the appointments from ``since`` on."""
+        from ..models import Appointment
+
+        rows = Appointment.objects.filter(date__gte=since).values_list(
+            "pk", "date", "time"
+        )
+        with self._lock:
+            self._fill(rows.iterator())
+
+    def _fill(self, rows: Iterable[Tuple[int, date, time]]) -> None:
+        days = set()
+        for pk, day, start in rows:
+            self._remove(pk)
+            self._where[pk] = (day, _minute(start))
+            self._days[day].append(_minute(start))
+            days.add(day)
+        for day in days:
+            self._days[day].sort()
+
+    def check_database(self, appointments: List) -> List:
+        """The ``appointments`` whose slots the database rows already fill.
+
+        Meant to run in the transaction that inserts the others; each one
+        counts against the slots of those before it. The index is reloaded
+        with the rows of the days checked, reservations kept.
+        """
+        from ..models import Appointment
+
+        slots = [_slot(appointment) for appointment in appointments]
+        days = {day for day, _ in slots}
+        rows = list(
+            Appointment.objects.filter(date__in=days).values_list("pk", "date", "time")
+        )
+        stored = SlotIndex(self.minutes, self.capacity, self.hours, self.weekdays)
+        stored._fill(rows)
+        taken = []
+        with stored._lock:
+            for appointment, (day, minute) in zip(appointments, slots):
+                if stored._busy(day, minute):
+                    taken.append(appointment)
+                else:
+                    stored._insert(("reserved", id(appointment)), day, minute)
+        with self._lock:
+            for key, (day, _) in list(self._where.items()):
+                if day in days and not isinstance(key, tuple):
+                    self._remove(key)
+            self._fill(rows)
+            self.conflicts += len(taken)
+        return taken
+
+    def _insert(self, key, day: date, minute: int) -> None:
+        self._remove(key)
+        self._where[key] = (day, minute)
+        bisect.insort(self._days[day], minute)
+
+    def _remove(self, key) -> None:
+        where = self._where.pop(key, None)
+        if where is not None:
+            starts = self._days[where[0]]
+            del starts[bisect.bisect_left(starts, where[1])]
+
+    def _busy(self, day: date, minute: int) -> bool:
+        starts = self._days.get(day)
+        if not starts:
+            return False
+        lo = bisect.bisect_right(starts, minute - self.minutes)
+        hi = bisect.bisect_left(starts, minute + self.minutes)
+        if hi - lo < self.capacity:
+            return False
+        if self.capacity == 1:
+            return True
+        # Overlap only changes where one of the neighbours starts.
+        neighbours = starts[lo:hi]
+        for point in [minute] + [s for s in neighbours if s > minute]:
+            overlapping = sum(point - self.minutes < s <= point for s in neighbours)
+            if overlapping >= self.capacity:
+                return True
+        return False
+
+    def is_free(self, day: date, start: time) -> bool:
+        with self._lock:
+            return not self._busy(day, _minute(start))
+
+    def reserve(self, appointment) -> bool:
+        """Hold the slot of an unsaved appointment unless it is taken."""
+        day, minute = _slot(appointment)
+        with self._lock:
+            if self._busy(day, minute):
+                self.conflicts += 1
+                return False
+            self._insert(("reserved", id(appointment)), day, minute)
+            return True
+
+    def release(self, appointment) -> None:
+        with self._lock:
+            self._remove(("reserved", id(appointment)))
+
+    def add(self, appointment) -> None:
+        """Index a saved appointment, replacing its reservation or old slot."""
+        day, minute = _slot(appointment)
+        with self._lock:
+            self._remove(("reserved", id(appointment)))
+            self._insert(appointment.pk, day, minute)
+
+    def remove(self, pk) -> None:
+        with self._lock:
+            self._remove(pk)
+
+    def free_slots(self, after: datetime, n: int, days: int = 30) -> List[datetime]:
+        """The first ``n`` free slot starts from ``after`` within ``days``."""
+        opening, closing = self.hours[0] * 60, self.hours[1] * 60 - self.minutes
+        earliest = after.hour * 60 + after.minute
+        found = []
+        with self._lock:
+            for offset in range(days):
+                day = after.date() + timedelta(days=offset)
+                if day.weekday() not in self.weekdays:
+                    continue
+                first = opening
+                if offset == 0 and earliest > opening:
+                    first += -(-(earliest - opening) // self.minutes) * self.minutes
+                for minute in range(first, closing + 1, self.minutes):
+                    if not self._busy(day, minute):
+                        found.append(
+                            datetime.combine(day, time(minute // 60, minute % 60))
+                        )
+                        if len(found) == n:
+                            return found
+        return found
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_appointment_conflicts_total Bookings rejected as the slot was taken.",
+            "# TYPE chatbot_appointment_conflicts_total counter",
+            f"chatbot_appointment_conflicts_total {self.conflicts}",
+            "# HELP chatbot_slot_index_appointments Appointments in the slot index.",
+            "# TYPE chatbot_slot_index_appointments gauge",
+            f"chatbot_slot_index_appointments {len(self)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def database_conflicts(appointments: List) -> Dict[int, Exception]:
+    """``SlotTaken`` per ``id()`` of the appointments that must not be inserted."""
+    taken = get_slot_index().check_database(appointments)
+    return {id(appointment): SlotTaken(appointment) for appointment in taken}
+
+
+def format_slots(slots: List[datetime]) -> str:
+    return ", ".join(f"{slot:%Y-%m-%d %H:%M}" for slot in slots)
+
+
+def conflict_message(appointment, slots: List[datetime]) -> str:
+    message = (
+        f"The time {appointment.time:%H:%M} on {appointment.date} is already "
+        "booked."
+    )
+    if slots:
+        message += f" Free times: {format_slots(slots)}."
+    return message
+
+
+_index: Optional[SlotIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_slot_index() -> SlotIndex:
+    """Return the process-wide slot index, loading it on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = SlotIndex(
+                    minutes=settings.CHATBOT_APPOINTMENT_MINUTES,
+                    capacity=settings.CHATBOT_APPOINTMENT_CAPACITY,
+                    hours=settings.CHATBOT_CLINIC_HOURS,
+                    weekdays=settings.CHATBOT_CLINIC_WEEKDAYS,
+                )
+                index.load(date.today())
+                _index = index
+    return _index
+
+
+async def aget_slot_index() -> SlotIndex:
+    if _index is not None:
+        return _index
+    return await database_sync_to_async(get_slot_index, thread_sensitive=False)()
+
+
+def loaded_slot_index() -> Optional[SlotIndex]:
+    """The slot index if something has loaded it, for signal handlers."""
+    return _index
+
+
+def render_slots() -> str:
+    return _index.render() if _index is not None else ""
@@ -0,0 +1,50 @@
+"""Wall-clock timings of the stages of a single chat turn."""
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class StageTimer:
+    """Records how long each named stage took, relative to one turn.
+
+    Stages may overlap, e.g. retrieval prefetch running while the intent is
+    classified. ``mark`` records a point in time such as the first token and
+    ``count`` accumulates numbers such as tokens or retrieved documents.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.marks: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        """Add ``seconds`` to a stage that may run more than once per turn."""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def mark(self, name: str) -> None:
+        """Record the first time ``name`` happens during the turn."""
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - self.started
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> Dict[str, float]:
+        timings = {f"{name}_ms": value * 1000 for name, value in self.stages.items()}
+        timings.update({f"{name}_at_ms": value * 1000 for name, value in self.marks.items()})
+        timings["total_ms"] = self.elapsed() * 1000
+        timings = {name: round(value, 2) for name, value in timings.items()}
+        timings.update(self.counts)
+        return timings
@@ -1,6 +1,9 @@
 import json
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db import transaction
 
-from asgiref.sync import sync_to_async
 from langchain import OpenAI
 from langchain.chains.base import Chain
 from langchain.agents import initialize_agent, Tool, AgentType
@@ -8,9 +11,17 @@ from langchain.tools import BaseTool
 from pydantic import BaseModel, root_validator
 from pydantic import ValidationError
 
+from .appointment_store import get_appointment_writer
 from .schemas import AppointmentSchema
+from .slots import (
+    SlotTaken,
+    aget_slot_index,
+    conflict_message,
+    database_conflicts,
+    get_slot_index,
+)
 
-from ..models import create_appointment
+from ..models import build_appointment
 
 
 class AppointmentJSONException(Exception):
@@ -46,12 +57,57 @@ def convert_json_to_obj(json_str: str):
 
 def create_appointment_from_json_str(json_str: str) -> str:
     try:
-        json_obj = convert_json_to_obj(json_str)
-        return create_appointment(json_obj)
+        appointment = build_appointment(convert_json_to_obj(json_str))
+        slots = get_slot_index()
+        if not slots.reserve(appointment):
+            raise AppointmentJSONException(offer_free_slots(slots, appointment))
+        try:
+            with transaction.atomic():
+                if database_conflicts([appointment]):
+                    raise SlotTaken(appointment)
+                appointment.save()
+        except SlotTaken:
+            slots.release(appointment)
+            raise AppointmentJSONException(offer_free_slots(slots, appointment))
+        except Exception:
+            slots.release(appointment)
+            raise
+        slots.add(appointment)
+        return appointment
+    except Exception as e:
+        raise AppointmentJSONException(e)
+
+
+async def acreate_appointment_from_json_str(json_str: str):
+    """Validate on the event loop and queue the insert to the batch writer."""
+    try:
+        appointment = build_appointment(convert_json_to_obj(json_str))
+        slots = await aget_slot_index()
+        if not slots.reserve(appointment):
+            raise AppointmentJSONException(offer_free_slots(slots, appointment))
+        try:
+            await get_appointment_writer().submit(appointment)
+        except SlotTaken:
+            # Booked by another process; the index now knows that day.
+            slots.release(appointment)
+            raise AppointmentJSONException(offer_free_slots(slots, appointment))
+        except BaseException:
+            slots.release(appointment)
+            raise
+        # bulk_create sends no post_save, so index the saved row here.
+        slots.add(appointment)
+        return appointment
     except Exception as e:
         raise AppointmentJSONException(e)
 
 
+def offer_free_slots(slots, appointment) -> str:
+    """The conflict message with the first free slots of that day onwards."""
+    after = max(datetime.combine(appointment.date, time()), datetime.now())
+    free = slots.free_slots(after, settings.CHATBOT_FREE_SLOTS_OFFERED)
+    return conflict_message(appointment, free)
+
+
 class AppointmentTool(BaseTool):
     name = "Appointment tool"
     description = "Creates an appointment from a valid json string"
@@ -64,6 +120,6 @@ class AppointmentTool(BaseTool):
 
     async def _arun(self, json_str: str) -> str:
         try:
-            return await sync_to_async(create_appointment_from_json_str)(json_str)
+            return await acreate_appointment_from_json_str(json_str)
         except Exception as e:
             return str(e)
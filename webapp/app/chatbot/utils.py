@@ -1,5 +1,6 @@
 import os
 import re
+import threading
 
 from datetime import datetime
 from typing import List, Union
@@ -20,8 +21,44 @@ from langchain.vectorstores import Chroma
 from .tools import AppointmentTool, AppointmentToolInputModel
 
 
-def init_retriever():
-    EMBEDDINGS = OpenAIEmbeddings()
+class _LockedCollection:
+    """Proxy to a Chroma collection that runs one call at a time.
+
+    The DuckDB connection behind Chroma is shared by every collection of a
+    client and fails randomly when searches from several executor threads
+    overlap.
+    """
+
+    def __init__(self, collection, lock):
+        self._collection = collection
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class ThreadSafeChroma(Chroma):
+    """Chroma store that can be searched from concurrent connections.
+
+    Only the collection calls are serialised; query embeddings are still
+    computed in parallel.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._collection = _LockedCollection(self._collection, threading.Lock())
+
+
+def init_retriever(embeddings=None):
+    EMBEDDINGS = embeddings or OpenAIEmbeddings()
     PERSIST_DIRECTORY = "../../../vector_db"
     ABS_PATH = os.path.dirname(os.path.abspath(__file__))
     DB_DIR = os.path.join(ABS_PATH, PERSIST_DIRECTORY)
@@ -32,7 +69,7 @@ def init_retriever():
         persist_directory=DB_DIR,
         anonymized_telemetry=False,
     )
-    db = Chroma(
+    db = ThreadSafeChroma(
         collection_name=CONDITIONS,
         embedding_function=EMBEDDINGS,
         client_settings=settings,
@@ -46,19 +83,21 @@ def init_retriever():
         )
 
 
+INTENT_EXAMPLES = [
+    {"input": "Hey, I have a headache", "intent": "symptom"},
+    {"input": "What about May 5th", "intent": "appointment"},
+    {"input": "I want to see a doctor this week", "intent": "appointment"},
+    {"input": "Tomorrow works?", "intent": "appointment"},
+    {"input": "I don't feel good", "intent": "symptom"},
+    {"input": "hey, how are you?", "intent": "None"},
+    {"input": "how does this shit work?", "intent": "None"},
+    {"input": "I love you!", "intent": "None"},
+    {"input": "this is bullshit", "intent": "None"},
+    {"input": "a random stuff", "intent": "None"},
+]
+
+
 def get_intent_prompt():
-    INTENT_EXAMPLES = [
-        {"input": "Hey, I have a headache", "intent": "symptom"},
-        {"input": "What about May 5th", "intent": "appointment"},
-        {"input": "I want to see a doctor this week", "intent": "appointment"},
-        {"input": "Tomorrow works?", "intent": "appointment"},
-        {"input": "I don't feel good", "intent": "symptom"},
-        {"input": "hey, how are you?", "intent": "None"},
-        {"input": "how does this shit work?", "intent": "None"},
-        {"input": "I love you!", "intent": "None"},
-        {"input": "this is bullshit", "intent": "None"},
-        {"input": "a random stuff", "intent": "None"},
-    ]
     example_formatter_template = """
     input: {input}\n
     intent: {intent}\n
@@ -253,17 +292,18 @@ def get_appointment_json_prompt():
     Remember to return a JSON with data derived from conversation!
     Don't make up answers!
     
-    Current date and time is: %s
+    Current date and time is: {now}
     
     Current conversation:
     {history}
     Human: {input}
-    """ % (
-        datetime.now()
-    )
+    """
     prompt = PromptTemplate(
         template=template,
         input_variables=["history", "input"],
+        # Rendered at call time with minute precision, so identical requests
+        # within a minute share a completion cache entry.
+        partial_variables={"now": lambda: datetime.now().strftime("%Y-%m-%d %H:%M")},
     )
     system_message_prompt = SystemMessagePromptTemplate(prompt=prompt)
     human_template = "{input}"
@@ -0,0 +1,318 @@
+"""In-memory NumPy index of the conditions collection.
+
+The MedQuAD collection fits in RAM, so instead of querying Chroma's DuckDB
+backend for every question all embeddings live in one float32 matrix that
+is searched with a single matrix-vector product. Saved indexes are memory
+mapped, so worker processes on one host share the same pages.
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores.base import VectorStore
+
+VECTORS_FILE = "vectors.npy"
+DOCUMENTS_FILE = "documents.json"
+CENTROIDS_FILE = "centroids.npy"
+OFFSETS_FILE = "offsets.npy"
+
+
+def normalise(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the ``k`` highest scores, best first."""
+    if k < len(scores):
+        positions = np.argpartition(-scores, k)[:k]
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.argsort(-scores[positions], kind="stable")]
+
+
+def maximal_marginal_relevance(
+    query_scores: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float
+) -> List[int]:
+    """Greedy MMR over normalised ``candidates``, in selection order.
+
+    Same selection as langchain's ``maximal_marginal_relevance``, but the
+    pairwise similarities are one matrix product and the running maximum
+    similarity to the selected documents is updated in place.
+    """
+    if not len(candidates):
+        return []
+    similarities = candidates @ candidates.T
+    selected = [int(np.argmax(query_scores))]
+    redundancy = similarities[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * query_scores - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, similarities[best], out=redundancy)
+    return selected
+
+
+class NumpyVectorIndex(VectorStore):
+    """Normalised embeddings in one matrix, searched by cosine similarity.
+
+    Searches are exact by default. After ``build_clusters`` rows are grouped
+    by spherical k-means cluster and, with ``nprobe`` set, only the rows of
+    the ``nprobe`` clusters nearest to the query are scored. Metadata
+    filters, e.g. ``{"focus": "Asthma"}``, always score just the matching
+    rows exactly.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        vectors: np.ndarray,
+        texts: List[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        centroids: Optional[np.ndarray] = None,
+        offsets: Optional[np.ndarray] = None,
+        nprobe: int = 0,
+    ):
+        self.embedding_function = embedding_function
+        self.vectors = vectors
+        self.texts = list(texts)
+        self.metadatas = list(metadatas) if metadatas else [{} for _ in self.texts]
+        self.ids = list(ids) if ids else [str(i) for i in range(len(self.texts))]
+        self.centroids = centroids
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self._metadata_rows: Dict[str, Dict[Any, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    # Building and persistence.
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorIndex":
+        vectors = normalise(embedding.embed_documents(list(texts)))
+        return cls(embedding, vectors, texts, metadatas, ids, **kwargs)
+
+    @classmethod
+    def from_chroma(cls, collection, embedding: Embeddings, **kwargs: Any):
+        """Copy every embedding and document of a Chroma collection."""
+        data = collection.get(include=["embeddings", "documents", "metadatas"])
+        return cls(
+            embedding,
+            normalise(data["embeddings"]),
+            data["documents"],
+            data["metadatas"],
+            data["ids"],
+            **kwargs,
+        )
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """Append texts; clusters are dropped until rebuilt."""
+        texts = list(texts)
+        vectors = normalise(self.embedding_function.embed_documents(texts))
+        ids = ids or [str(len(self.texts) + i) for i in range(len(texts))]
+        with self._lock:
+            self.vectors = np.vstack([self.vectors, vectors])
+            self.texts += texts
+            self.metadatas += metadatas or [{} for _ in texts]
+            self.ids += ids
+            self.centroids = self.offsets = None
+            self._metadata_rows = {}
+        return ids
+
+    def build_clusters(self, clusters: int, iterations: int = 10, seed: int = 0):
+        """Group rows by spherical k-means cluster for approximate search."""
+        clusters = min(clusters, len(self))
+        vectors = np.asarray(self.vectors)
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), clusters, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            # Empty clusters keep their previous centroid.
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalise(sums)
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        with self._lock:
+            self.vectors = vectors[order]
+            self.texts = [self.texts[i] for i in order]
+            self.metadatas = [self.metadatas[i] for i in order]
+            self.ids = [self.ids[i] for i in order]
+            self.centroids = centroids
+            self.offsets = np.searchsorted(assignments[order], np.arange(clusters + 1))
+            self._metadata_rows = {}
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, VECTORS_FILE), np.asarray(self.vectors))
+        with open(os.path.join(directory, DOCUMENTS_FILE), "w") as documents_file:
+            json.dump(
+                {"ids": self.ids, "texts": self.texts, "metadatas": self.metadatas},
+                documents_file,
+            )
+        for name, array in ((CENTROIDS_FILE, self.centroids), (OFFSETS_FILE, self.offsets)):
+            path = os.path.join(directory, name)
+            if array is not None:
+                np.save(path, array)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def load(
+        cls, directory: str, embedding: Embeddings, nprobe: int = 0, mmap: bool = True
+    ) -> "NumpyVectorIndex":
+        vectors = np.load(
+            os.path.join(directory, VECTORS_FILE), mmap_mode="r" if mmap else None
+        )
+        with open(os.path.join(directory, DOCUMENTS_FILE)) as documents_file:
+            documents = json.load(documents_file)
+        centroids = offsets = None
+        if os.path.exists(os.path.join(directory, CENTROIDS_FILE)):
+            centroids = np.load(os.path.join(directory, CENTROIDS_FILE))
+            offsets = np.load(os.path.join(directory, OFFSETS_FILE))
+        return cls(
+            embedding,
+            vectors,
+            documents["texts"],
+            documents["metadatas"],
+            documents["ids"],
+            centroids=centroids,
+            offsets=offsets,
+            nprobe=nprobe,
+        )
+
+    # Search.
+
+    def _rows_where(self, key: str, value: Any) -> np.ndarray:
+        rows = self._metadata_rows.get(key)
+        if rows is None:
+            with self._lock:
+                grouped: Dict[Any, List[int]] = {}
+                for row, metadata in enumerate(self.metadatas):
+                    grouped.setdefault((metadata or {}).get(key), []).append(row)
+                rows = {v: np.array(r) for v, r in grouped.items()}
+                self._metadata_rows[key] = rows
+        return rows.get(value, np.array([], dtype=int))
+
+    def _candidate_rows(self, query: np.ndarray, filter: Optional[dict]):
+        """Rows to score, or None for all of them."""
+        if filter:
+            rows = None
+            for key, value in filter.items():
+                if isinstance(value, dict):
+                    raise ValueError("Only equality filters are supported")
+                matches = self._rows_where(key, value)
+                rows = matches if rows is None else np.intersect1d(rows, matches)
+            return rows
+        if self.nprobe and self.centroids is not None:
+            nearest = top_k(self.centroids @ query, self.nprobe)
+            return np.concatenate(
+                [np.arange(self.offsets[c], self.offsets[c + 1]) for c in nearest]
+            )
+        return None
+
+    def _search(
+        self, embedding: List[float], k: int, filter: Optional[dict] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the query vector and the best ``k`` rows with their scores."""
+        query = normalise(embedding)
+        rows = self._candidate_rows(query, filter)
+        if rows is None:
+            scores = self.vectors @ query
+            best = top_k(scores, k)
+            return query, best, scores[best]
+        scores = self.vectors[rows] @ query
+        best = top_k(scores, k)
+        return query, rows[best], scores[best]
+
+    def _document(self, row: int) -> Document:
+        return Document(page_content=self.texts[row], metadata=self.metadatas[row])
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        _, rows, scores = self._search(embedding, k, filter)
+        return [(self._document(row), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """Documents with their cosine similarity to ``query``, best first."""
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, filter)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        _, rows, _ = self._search(embedding, k, filter)
+        return [self._document(row) for row in rows]
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector(embedding, k, filter)
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        _, rows, scores = self._search(embedding, fetch_k, filter)
+        selected = maximal_marginal_relevance(
+            scores, np.asarray(self.vectors[rows]), k, lambda_mult
+        )
+        return [self._document(rows[i]) for i in selected]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(
+            embedding, k, fetch_k, lambda_mult, filter
+        )
+
+
+def init_numpy_retriever(embeddings: Embeddings, directory, nprobe: int = 0):
+    """MMR retriever over the saved index, a drop-in for ``init_retriever``."""
+    if not os.path.exists(os.path.join(directory, VECTORS_FILE)):
+        raise Exception(
+            f"No vector index in {directory}. "
+            "Please run `python manage.py build_vector_index` to create it."
+        )
+    index = NumpyVectorIndex.load(str(directory), embeddings, nprobe=nprobe)
+    return index.as_retriever(search_type="mmr")
@@ -0,0 +1,171 @@
+"""Explicit warm-up of the chat stack before the server accepts connections.
+
+Loading the registry opens the Chroma client and reads the prompts, but
+Chroma only loads its HNSW index on the first query and tiktoken builds an
+encoding on first use, so the first chat turn used to pay for both. Each
+step below is timed; /ready/ answers 503 until all of them have run.
+``start_warm_up`` runs them in a background thread, so the server listens
+(and can answer /ready/) in the meantime.
+"""
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+
+_timings: Dict[str, float] = {}
+_ready = threading.Event()
+
+
+def _retriever_collections(retriever) -> List:
+    """Chroma collections behind ``retriever``, through hybrid wrappers."""
+    collections = []
+    inner = getattr(retriever, "vector_retriever", None)
+    if inner is not None:
+        collections += _retriever_collections(inner)
+    store = getattr(retriever, "vectorstore", None)
+    if store is not None and hasattr(store, "_collection"):
+        collections.append(store._collection)
+    return collections
+
+
+def warm_chroma(registry) -> None:
+    """Query each collection with a stored embedding to load its index."""
+    for collection in _retriever_collections(registry.retriever):
+        stored = collection.get(limit=1, include=["embeddings"])
+        if stored["embeddings"]:
+            collection.query(query_embeddings=stored["embeddings"][:1], n_results=1)
+
+
+def warm_tiktoken(registry) -> None:
+    from .context import get_encoding as get_model_encoding
+    from .sessions import get_encoding as get_session_encoding
+
+    get_session_encoding().encode("warm up")
+    if registry.context_packer is not None:
+        registry.context_packer.count("warm up")
+    else:
+        get_model_encoding("text-davinci-003").encode("warm up")
+
+
+def warm_prompts(registry) -> None:
+    """Format every prompt once so template errors surface at startup."""
+    for prompt in (
+        registry.intent_prompt,
+        registry.symptoms_qa_prompt,
+        registry.general_chat_prompt,
+        registry.appointment_prompt,
+    ):
+        prompt.format_prompt(**{name: "" for name in prompt.input_variables})
+
+
+def warm_chains(registry) -> None:
+    """Build one set of session chains, as the first connection would."""
+    from langchain.memory import ConversationBufferMemory
+
+    from .callback import QuestionGenCallbackHandler, StreamingLLMCallbackHandler
+
+    registry.build_session_chains(
+        QuestionGenCallbackHandler(None),
+        StreamingLLMCallbackHandler(None),
+        ConversationBufferMemory(),
+    )
+
+
+def warm_slots(registry) -> None:
+    from .slots import get_slot_index
+
+    try:
+        get_slot_index()
+    except DatabaseError as e:
+        # E.g. before migrate; the first booking loads the index instead.
+        print(f"WARM-UP: slot index not loaded: {e}")
+
+
+STEPS: List[Tuple[str, Callable]] = [
+    ("chroma", warm_chroma),
+    ("tiktoken", warm_tiktoken),
+    ("prompts", warm_prompts),
+    ("chains", warm_chains),
+    ("slots", warm_slots),
+]
+
+
+def warm_up() -> Dict[str, float]:
+    """Load the registry and run every warm-up step, timing each one."""
+    from .registry import get_registry
+
+    start = time.perf_counter()
+    registry = get_registry()
+    _timings["registry"] = time.perf_counter() - start
+    for name, step in STEPS:
+        begin = time.perf_counter()
+        try:
+            step(registry)
+        except Exception as e:
+            # The first request loads it instead; a cold cache is no reason
+            # to keep the server down.
+            print(f"WARM-UP: {name} failed: {e!r}")
+        _timings[name] = time.perf_counter() - begin
+    print(
+        "WARM-UP:",
+        {name: round(seconds * 1000, 1) for name, seconds in _timings.items()},
+        f"total {(time.perf_counter() - start) * 1000:.1f} ms",
+    )
+    _ready.set()
+    return dict(_timings)
+
+
+def _warm_up_in_thread() -> None:
+    try:
+        warm_up()
+    finally:
+        # The thread's own connection, opened by the slot index.
+        connection.close()
+
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def start_warm_up() -> threading.Thread:
+    """Run ``warm_up`` once in a daemon thread and return the thread."""
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(
+                target=_warm_up_in_thread, name="warm-up", daemon=True
+            )
+            _thread.start()
+    return _thread
+
+
+def wait_for_warm_up(timeout: float = None) -> bool:
+    return _ready.wait(timeout)
+
+
+def is_ready() -> bool:
+    """Warm-up has finished, or is disabled."""
+    return _ready.is_set() or not settings.CHATBOT_WARM_UP
+
+
+def warm_up_timings() -> Dict[str, float]:
+    return dict(_timings)
+
+
+def render_warmup() -> str:
+    lines = [
+        "# HELP chatbot_warmup_seconds Duration of each startup warm-up step.",
+        "# TYPE chatbot_warmup_seconds gauge",
+    ]
+    lines += [
+        f'chatbot_warmup_seconds{{step="{name}"}} {seconds:.6f}'
+        for name, seconds in _timings.items()
+    ]
+    lines += [
+        "# HELP chatbot_ready Whether startup warm-up has finished.",
+        "# TYPE chatbot_ready gauge",
+        f"chatbot_ready {int(is_ready())}",
+    ]
+    return "\n".join(lines) + "\n"
@@ -1,52 +1,88 @@
+import asyncio
+import functools
 import json
+import logging
+import time
+from datetime import datetime
 
 from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from langchain.memory import ConversationBufferMemory
+from django.conf import settings
+from patient.profiles import aget_profile_snapshot
 
 from .chatbot.schemas import ChatResponse
-from .chatbot.tools import AppointmentJSONException, create_appointment_from_json_str
+from .chatbot.tools import AppointmentJSONException, acreate_appointment_from_json_str
 
 from .chatbot.callback import (
+    BufferedStreamingLLMCallbackHandler,
+    LLMStageCallbackHandler,
     QuestionGenCallbackHandler,
     StreamingLLMCallbackHandler,
 )
-from .chatbot.chains import (
-    get_appointment_chain,
-    get_general_chat_chain,
-    get_intents_chain,
-    get_symptoms_chain,
+from .chatbot.admission import get_admission
+from .chatbot.appointments import (
+    complete_llm_result,
+    extract_appointment,
+    merge_appointment,
+    missing_fields,
 )
+from .chatbot.groups import group_size
+from .chatbot.metrics import get_metrics
+from .chatbot.registry import get_registry
+from .chatbot.response_cache import get_cache_scope
+from .chatbot.sessions import get_conversation_store, get_session_key
+from .chatbot.slots import aget_slot_index, format_slots
+from .chatbot.timing import StageTimer
+
+logger = logging.getLogger(__name__)
+
+
+def chat_turn(handler):
+    """Runs a channel layer handler as one timed turn of the conversation.
+
+    The handler receives the turn's ``StageTimer`` and the retrieval prefetch
+    started by ``receive``, if any. Timings are recorded when it returns.
+    Events from other members of the group wait in the turn queue, so a
+    consumer never runs two turns at once.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(self, event):
+        if asyncio.current_task() is not self.turn_worker:
+            self.enqueue_turn(event)
+            return
+        timer, prefetch = self.start_turn(event["message"])
+        try:
+            await handler(self, event, timer, prefetch)
+        finally:
+            self.finish_turn(handler.__name__, timer)
 
-from .chatbot.utils import init_retriever
-
-
-# TODO(murat): Use a single chat history
-# TODO(murat): Use a vectorstore for storing chat history
-chat_history = []
-memory = ConversationBufferMemory()
-
-
-@database_sync_to_async
-def get_profile(user):
-    prof = user.healthprofile
-    data = f"""User health data:
-    Gender: {prof.gender};
-    Age: {prof.age};
-    Weight: {prof.weight} kilograms;
-    Height: {prof.height} centimeters;
-    Health condition notes: {prof.health_conditions_notes}"""
-    return data
+    return wrapper
 
 
 class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         # TODO(murat): check if user is authenticated.
         # TODO(murat): create a chat session and use session id as chat_box_name.
-        self.health_data = await get_profile(self.scope["user"])
         self.chat_box_name = self.scope["url_route"]["kwargs"]["chat_box_name"]
         self.group_name = "chat_%s" % self.chat_box_name
+        self.conversation_store = get_conversation_store()
+        self.health_data, self.conversation = await asyncio.gather(
+            aget_profile_snapshot(self.scope["user"].pk),
+            database_sync_to_async(self.conversation_store.get)(
+                get_session_key(self.scope["user"], self.chat_box_name)
+            ),
+        )
+        self.pending_turn = None
+        self.turn_timer = None
+        # Fields of an appointment we asked the user to complete.
+        self.pending_appointment = {}
+        # Messages are answered one at a time, by a task of their own, so that
+        # receive() can turn away messages sent while a reply streams.
+        self.turn_queue = asyncio.Queue()
+        self.turns_in_flight = 0
+        self.turn_worker = None
 
         await self.channel_layer.group_add(self.group_name, self.channel_name)
 
@@ -55,30 +91,101 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
         await self.send(text_data=json.dumps(resp.dict()))
 
         question_handler = QuestionGenCallbackHandler(self)
-        stream_handler = StreamingLLMCallbackHandler(self)
-        retriever = await sync_to_async(init_retriever)()
-        self.intents_chain = await sync_to_async(get_intents_chain)()
-        self.symptopms_qa_chain = await sync_to_async(get_symptoms_chain)(
-            retriever, question_handler, stream_handler, tracing=True
-        )
-        self.general_chat_chain = await sync_to_async(get_general_chat_chain)(
-            stream_handler, memory=memory
+        if settings.CHATBOT_STREAM_FLUSH_INTERVAL:
+            stream_handler = BufferedStreamingLLMCallbackHandler(
+                self,
+                flush_interval=settings.CHATBOT_STREAM_FLUSH_INTERVAL,
+                max_bytes=settings.CHATBOT_STREAM_MAX_BYTES,
+            )
+        else:
+            stream_handler = StreamingLLMCallbackHandler(self)
+        self.stream_handler = stream_handler
+        registry = await sync_to_async(get_registry)()
+        chains = registry.build_session_chains(
+            question_handler,
+            stream_handler,
+            memory=self.conversation.memory,
+            tracing=True,
+            cache_scope=get_cache_scope(self.health_data),
+            instrument=lambda stage: LLMStageCallbackHandler(self, stage),
         )
-        self.appointment_chain = await sync_to_async(get_appointment_chain)(memory)
+        self.intents_chain = chains.intents
+        self.intent_router = registry.intent_router
+        self.symptopms_qa_chain = chains.symptoms_qa
+        self.general_chat_chain = chains.general_chat
+        self.appointment_chain = chains.appointment
         resp = ChatResponse(
             username="bot", message="Ready to accept questions", type="info"
         )
         await self.send(text_data=json.dumps(resp.dict()))
+        self.turn_worker = asyncio.create_task(self.process_turns())
 
     async def disconnect(self, close_code):
+        if getattr(self, "turn_worker", None) is not None:
+            self.turn_worker.cancel()
+            get_admission().session_queued -= self.turn_queue.qsize()
+        if getattr(self, "pending_turn", None) and self.pending_turn[2] is not None:
+            self.pending_turn[2].cancel()
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive(self, text_data):
+        admission = get_admission()
+        if self.turns_in_flight > settings.CHATBOT_SESSION_QUEUE_SIZE:
+            admission.reject("busy")
+            await self.send_error("Please wait until the current answer is finished.")
+        elif not admission.allow(self.scope["user"].pk):
+            await self.send_error(
+                "You are sending messages too quickly. Please wait a moment."
+            )
+        else:
+            self.turns_in_flight += 1
+            self.enqueue_turn(text_data, StageTimer())
+
+    async def send_error(self, message):
+        resp = ChatResponse(username="bot", message=message, type="error")
+        await self.send(text_data=json.dumps(resp.dict()))
+
+    def enqueue_turn(self, item, timer=None):
+        get_admission().session_queued += 1
+        self.turn_queue.put_nowait((item, timer, time.perf_counter()))
+
+    async def process_turns(self):
+        """Run queued messages and group events, each holding an LLM slot."""
+        admission = get_admission()
+        while True:
+            item, timer, queued = await self.turn_queue.get()
+            admission.session_queued -= 1
+            if timer is not None:
+                timer.add("session_queue", time.perf_counter() - queued)
+            try:
+                async with admission.slot(self.scope["user"].pk, timer):
+                    if isinstance(item, dict):
+                        await self.dispatch(item)
+                    else:
+                        await self.answer(item, timer)
+            except Exception:
+                logger.exception("turn failed")
+                await self.send_error("Sorry, something went wrong. Please try again.")
+            finally:
+                if not isinstance(item, dict):
+                    self.turns_in_flight -= 1
+
+    async def answer(self, text_data, timer):
         data = await self.decode_json(text_data)
         message = data.get("message", "")
         type_of_msg = data.get("type", "")
 
-        intent = await self.intents_chain.arun(input=message)
+        # Retrieval for a first symptom question does not depend on the
+        # intent, so it runs while the intent is being classified.
+        prefetch = None
+        if not self.conversation.chat_history and type_of_msg != "clarification":
+            prefetch = self.symptopms_qa_chain.prefetch_docs(
+                self.get_symptom_question(message), timer=timer, cache_query=message
+            )
+        self.set_pending_turn((message, timer, prefetch))
+
+        with timer.stage("intent"):
+            intent = await self.intent_router.aroute(message, self.intents_chain)
 
         if intent == "appointment" or type_of_msg == "clarification":
             chat_hanlder = "appointment_message"
@@ -87,16 +194,58 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
         else:
             chat_hanlder = "general_chat_message"
 
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                "type": chat_hanlder,
-                "message": message,
-                "username": "you",  # TODO: get username from session
-            },
-        )
-
-    async def appointment_message(self, event):
+        if prefetch is not None and chat_hanlder != "symptom_message":
+            prefetch.cancel()
+            prefetch = None
+        self.set_pending_turn((message, timer, prefetch))
+
+        event = {
+            "type": chat_hanlder,
+            "message": message,
+            "username": "you",  # TODO: get username from session
+        }
+        # Other members of the chat box (e.g. a second tab, possibly on another
+        # worker) need the channel layer; a lone member handles it right here.
+        if await group_size(self.channel_layer, self.group_name) == 1:
+            timer.count("direct_dispatch")
+            await self.dispatch(event)
+        else:
+            await self.channel_layer.group_send(self.group_name, event)
+
+    def get_symptom_question(self, message):
+        return f"Original question: {message}.\nPatient health data: {self.health_data}"
+
+    def set_pending_turn(self, turn):
+        """Replace the pending turn, cancelling a prefetch nobody will await.
+
+        The previous one is still pending when its group event has not come
+        back yet, e.g. behind another member's messages.
+        """
+        previous = self.pending_turn
+        if previous is not None and previous[2] not in (None, turn[2]):
+            previous[2].cancel()
+        self.pending_turn = turn
+
+    def start_turn(self, message):
+        """Return the timer and retrieval prefetch that receive() started."""
+        turn = self.pending_turn
+        if turn is not None and turn[0] == message:
+            self.pending_turn = None
+        else:
+            # The message came from another member of the group; ours, if
+            # pending, is still on its way.
+            turn = (message, StageTimer(), None)
+        self.turn_timer = self.stream_handler.timer = turn[1]
+        return turn[1], turn[2]
+
+    def finish_turn(self, handler, timer):
+        self.turn_timer = self.stream_handler.timer = None
+        self.last_timings = timer.as_dict()
+        get_metrics().observe(handler, timer, session_key=self.conversation.key)
+        logger.debug("turn timings: %s", self.last_timings)
+
+    @chat_turn
+    async def appointment_message(self, event, timer, prefetch):
         print("IN APPOINTMENT MESSAGE")
         message = event["message"]
         username = event["username"]
@@ -108,12 +257,33 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
         start_resp = ChatResponse(username="bot", message="", type="start")
         await self.send(text_data=json.dumps(start_resp.dict()))
 
-        result = await self.appointment_chain.arun(input=message)
+        fast_path = settings.CHATBOT_APPOINTMENT_FAST_PATH
+        with timer.stage("appointment_extraction"):
+            extracted = extract_appointment(message)
+            fields = merge_appointment(self.pending_appointment, extracted)
+        if fast_path and not missing_fields(fields):
+            timer.count("appointment_fast_path")
+            fields["description"] = fields.get("description") or message
+            result = json.dumps(fields)
+        else:
+            with timer.stage("appointment_chain"):
+                result = await self.appointment_chain.arun(input=message)
+            if fast_path:
+                result = complete_llm_result(result, extracted)
         print("@@@@@@@@@@= RESULT: ", result)
+        with timer.stage("db_write"):
+            await self.conversation_store.apersist_memory(
+                self.conversation, message, result
+            )
         try:
-            output = await sync_to_async(create_appointment_from_json_str)(result)
+            with timer.stage("db_write"):
+                output = await acreate_appointment_from_json_str(result)
+            self.pending_appointment = {}
             output_msg = f'Created an appointment with title "{output.name}" on {output.date} at {output.time}.'
-            chat_history.append((message, output_msg))
+            with timer.stage("db_write"):
+                await self.conversation_store.aadd_turn(
+                    self.conversation, message, output_msg
+                )
 
             resp = ChatResponse(username="bot", message=output_msg, type="stream")
             await self.send(text_data=json.dumps(resp.dict()))
@@ -125,6 +295,7 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
             error_msg = str(e)
             is_field_error = any([x in error_msg for x in ["date", "time", "name"]])
             if is_field_error:
+                error_msg += await self.free_slots_hint(result)
                 resp = ChatResponse(
                     username="bot",
                     message=error_msg,
@@ -134,14 +305,21 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
                 # a missing value and that we asked a user to provide it.
                 serialized_result = ""
                 appointment_dict = json.loads(result)
+                self.pending_appointment = {
+                    key: value for key, value in appointment_dict.items() if value
+                }
                 for key, value in appointment_dict.items():
                     serialized_result += f"{key}: {value}\n"
-                await sync_to_async(memory.save_context)(
-                    {"input": serialized_result}, {"ouput": error_msg}
-                )
-                chat_history.append((message, error_msg))
+                with timer.stage("db_write"):
+                    await self.conversation_store.asave_context(
+                        self.conversation, serialized_result, error_msg
+                    )
+                    await self.conversation_store.aadd_turn(
+                        self.conversation, message, error_msg
+                    )
                 await self.send(text_data=json.dumps(resp.dict()))
             else:
+                self.pending_appointment = {}
                 resp = ChatResponse(
                     username="bot",
                     message="Sorry, something went wrong. Please try again.",
@@ -152,7 +330,22 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
                 end_resp = ChatResponse(username="bot", message="", type="end")
                 await self.send(text_data=json.dumps(end_resp.dict()))
 
-    async def general_chat_message(self, event):
+    async def free_slots_hint(self, result):
+        """Free times of the requested day when the user has not given one."""
+        try:
+            fields = json.loads(result)
+            day = datetime.strptime(fields["date"], "%Y-%m-%d").date()
+        except (TypeError, ValueError, KeyError):
+            return ""
+        if fields.get("time"):
+            return ""
+        slots = await aget_slot_index()
+        after = max(datetime.combine(day, datetime.min.time()), datetime.now())
+        free = slots.free_slots(after, settings.CHATBOT_FREE_SLOTS_OFFERED)
+        return f" Free times: {format_slots(free)}." if free else ""
+
+    @chat_turn
+    async def general_chat_message(self, event, timer, prefetch):
         print("IN GENERAL CHAT MESSAGE")
         message = event["message"]
         username = event["username"]
@@ -164,15 +357,20 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
         start_resp = ChatResponse(username="bot", message="", type="start")
         await self.send(text_data=json.dumps(start_resp.dict()))
 
-        result = await self.general_chat_chain.acall(
-            {"text": message, "chat_history": chat_history}
-        )
-        chat_history.append((message, result["text"]))
+        with timer.stage("general_chat_chain"):
+            result = await self.general_chat_chain.acall(
+                {"text": message, "chat_history": self.conversation.chat_history}
+            )
+        with timer.stage("db_write"):
+            await self.conversation_store.aadd_turn(
+                self.conversation, message, result["text"]
+            )
 
         end_resp = ChatResponse(username="bot", message="", type="end")
         await self.send(text_data=json.dumps(end_resp.dict()))
 
-    async def symptom_message(self, event):
+    @chat_turn
+    async def symptom_message(self, event, timer, prefetch):
         print("IN SYMPTOM MESSAGE")
         message = event["message"]
         username = event["username"]
@@ -184,13 +382,20 @@ class ChatRoomConsumer(AsyncJsonWebsocketConsumer):
         start_resp = ChatResponse(username="bot", message="", type="start")
         await self.send(text_data=json.dumps(start_resp.dict()))
 
-        question = (
-            f"Original question: {message}.\nPatient health data: {self.health_data}"
-        )
+        question = self.get_symptom_question(message)
+        self.symptopms_qa_chain.prefetched_docs = prefetch
+        self.symptopms_qa_chain.timer = timer
         result = await self.symptopms_qa_chain.acall(
-            {"question": question, "chat_history": chat_history}
+            {
+                "question": question,
+                "chat_history": self.conversation.chat_history,
+                "cache_query": message,
+            }
         )
-        chat_history.append((question, result["answer"]))
+        with timer.stage("db_write"):
+            await self.conversation_store.aadd_turn(
+                self.conversation, question, result["answer"]
+            )
 
         end_resp = ChatResponse(username="bot", message="", type="end")
         await self.send(text_data=json.dumps(end_resp.dict()))
@@ -0,0 +1,114 @@
+import asyncio
+import csv
+import json
+import os
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from app.chatbot.appointments import (
+    FIELDS,
+    complete_llm_result,
+    extract_appointment,
+    missing_fields,
+)
+from app.chatbot.chains import get_appointment_chain
+from app.chatbot.fakes import FakeChatModel
+from app.chatbot.intents import ABS_PATH
+
+from .bench_chat_load import percentile
+
+APPOINTMENT_EVAL_FILE = os.path.join(ABS_PATH, "data", "appointment_eval.csv")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the local appointment extractor against a fixture set and "
+        "compares the fast path with always calling the appointment LLM"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--eval-file", default=APPOINTMENT_EVAL_FILE)
+        parser.add_argument(
+            "--now",
+            default="2023-05-03 10:00",
+            help="Reference time of the fixture's relative dates",
+        )
+        parser.add_argument(
+            "--llm-latency",
+            type=float,
+            default=1.5,
+            help="Seconds the fake appointment LLM waits before answering",
+        )
+
+    def handle(self, *args, **options):
+        os.environ.setdefault("OPENAI_API_KEY", "load-test")
+        with open(options["eval_file"]) as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        now = datetime.strptime(options["now"], "%Y-%m-%d %H:%M")
+        gold = {row["input"]: row for row in rows}
+
+        def oracle(prompt):
+            # The fake LLM always answers correctly; only its latency matters.
+            row = gold[prompt.rsplit("\n", 1)[-1]]
+            return json.dumps({field: row[field] for field in FIELDS})
+
+        chain = get_appointment_chain()
+        chain.llm = FakeChatModel(responder=oracle, latency=options["llm_latency"])
+
+        correct = {field: 0 for field in FIELDS}
+        wrong = {field: 0 for field in FIELDS}
+        missed = {field: 0 for field in FIELDS}
+        timings = []
+        for row in rows:
+            start = time.perf_counter()
+            extracted = extract_appointment(row["input"], now)
+            timings.append(time.perf_counter() - start)
+            for field in FIELDS:
+                value, expected = extracted[field] or "", row[field]
+                correct[field] += value == expected
+                missed[field] += not value
+                if value and value != expected:
+                    wrong[field] += 1
+                    self.stdout.write(
+                        f"  wrong {field}: {row['input']!r} -> {value!r}, "
+                        f"expected {expected!r}"
+                    )
+        self.stdout.write(
+            f"local extractor: p50 {percentile(timings, 0.5) * 1000:.3f} ms, "
+            f"p95 {percentile(timings, 0.95) * 1000:.3f} ms"
+        )
+        for field in FIELDS:
+            self.stdout.write(
+                f"{field:>6}: {correct[field]}/{len(rows)} correct, "
+                f"{wrong[field]} wrong, {missed[field]} left to the LLM"
+            )
+
+        async def run(fast_path):
+            timings, calls, exact = [], 0, 0
+            for row in rows:
+                chain.memory.clear()
+                start = time.perf_counter()
+                extracted = extract_appointment(row["input"], now)
+                if fast_path and not missing_fields(extracted):
+                    result = json.dumps(extracted)
+                else:
+                    calls += 1
+                    result = await chain.arun(input=row["input"])
+                    if fast_path:
+                        result = complete_llm_result(result, extracted)
+                timings.append(time.perf_counter() - start)
+                fields = json.loads(result)
+                exact += all(
+                    (fields.get(field) or "") == row[field] for field in FIELDS
+                )
+            return timings, calls, exact
+
+        for label, fast_path in (("llm chain", False), ("fast path", True)):
+            timings, calls, exact = asyncio.run(run(fast_path))
+            self.stdout.write(
+                f"{label:>10}: p50 {percentile(timings, 0.5) * 1000:7.1f} ms, "
+                f"mean {sum(timings) / len(timings) * 1000:7.1f} ms, "
+                f"{calls}/{len(rows)} LLM calls, {exact}/{len(rows)} exactly right"
+            )
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from app.chatbot.appointment_store import AppointmentWriter, alist_appointments
+from app.models import Appointment, build_appointment, create_appointment
+
+from .bench_chat_load import percentile
+
+
+def booking(i):
+    day = date(2023, 6, 1) + timedelta(days=i % 60)
+    return {
+        "name": f"Benchmark appointment {i}",
+        "date": day.isoformat(),
+        "time": f"{9 + i % 8:02d}:{i % 4 * 15:02d}",
+        "description": "Created by bench_appointment_writes",
+    }
+
+
+@database_sync_to_async
+def thread_sensitive_read(day):
+    # What the conversation store does on every turn.
+    return list(Appointment.objects.filter(date=day)[:10])
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares per-request appointment inserts in the thread-sensitive "
+        "executor with the batching writer, under concurrent reads"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bookings", type=int, default=2000)
+        parser.add_argument(
+            "--concurrency", type=int, default=100, help="Bookings in flight"
+        )
+        parser.add_argument(
+            "--readers", type=int, default=20, help="Concurrent read loops"
+        )
+
+    def handle(self, *args, **options):
+        # A file database, so WAL applies as in production.
+        directory = tempfile.mkdtemp()
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+        test_db = connection.creation.create_test_db(verbosity=0)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                self.stdout.write(f"journal_mode: {cursor.fetchone()[0]}")
+            writer = AppointmentWriter()
+
+            async def per_request(payload):
+                return await sync_to_async(create_appointment)(payload)
+
+            async def batched(payload):
+                return await writer.submit(build_appointment(payload))
+
+            for label, book in (("per request", per_request), ("batched", batched)):
+                bookings, reads, elapsed = asyncio.run(self.run(book, options))
+                count = Appointment.objects.count()
+                self.stdout.write(
+                    f"{label:>11}: {options['bookings'] / elapsed:7.0f} bookings/s, "
+                    f"booking p50 {percentile(bookings, 0.5) * 1000:6.1f} ms "
+                    f"p95 {percentile(bookings, 0.95) * 1000:6.1f} ms, "
+                    f"read p50 {percentile(reads, 0.5) * 1000:6.1f} ms "
+                    f"p95 {percentile(reads, 0.95) * 1000:6.1f} ms, {count} rows"
+                )
+                Appointment.objects.all().delete()
+            writer.stop()
+            self.stdout.write(
+                f"writer: {writer.rows} rows in {writer.batches} batches, "
+                f"{writer.failures} failures"
+            )
+        finally:
+            connection.creation.destroy_test_db(test_db, verbosity=0)
+
+    async def run(self, book, options):
+        bookings, reads = [], []
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        done = asyncio.Event()
+
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                await book(booking(i))
+                bookings.append(time.perf_counter() - start)
+
+        async def reader(n):
+            day = date(2023, 6, 1) + timedelta(days=n)
+            while not done.is_set():
+                start = time.perf_counter()
+                await thread_sensitive_read(day)
+                await alist_appointments(day, day, 10)
+                reads.append(time.perf_counter() - start)
+
+        readers = [asyncio.create_task(reader(n)) for n in range(options["readers"])]
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(options["bookings"])))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await asyncio.gather(*readers)
+        return bookings, reads, elapsed
@@ -0,0 +1,456 @@
+import asyncio
+import atexit
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import date, timedelta
+
+import chromadb
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+
+from app.chatbot.admission import AdmissionController, get_admission, set_admission
+from app.chatbot.coalesce import CoalescingMixin, get_single_flight
+from app.chatbot.completion_cache import get_completion_cache
+from app.chatbot.fakes import FakeChatModel, FakeEmbeddings, FakeLLM
+from app.chatbot.metrics import get_metrics
+from app.chatbot.registry import ChatbotRegistry, set_registry
+from app.chatbot.utils import ThreadSafeChroma
+
+FLOWS = {
+    "symptom": "I have had a headache and a fever for three days.",
+    "appointment": "Please book an appointment with Dr. Smith tomorrow at 10:00.",
+    "general": "Hello, how are you today?",
+}
+
+_TOKEN_RE = re.compile(r"\s*\S+")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def answer_responder(tokens):
+    answer = " ".join(f"word{i}" for i in range(tokens))
+    return lambda prompt: answer
+
+
+def appointment_responder(prompt):
+    tomorrow = date.today() + timedelta(days=1)
+    return json.dumps(
+        {
+            "name": "Dr. Smith",
+            "date": tomorrow.isoformat(),
+            "time": "10:00",
+            "description": "Check-up",
+        }
+    )
+
+
+def intent_responder(prompt):
+    text = prompt.rsplit("\n", 1)[-1].lower()
+    for intent in ("appointment", "symptom"):
+        if intent in text:
+            return intent
+    return "general"
+
+
+class CoalescingFakeLLM(CoalescingMixin, FakeLLM):
+    pass
+
+
+class CoalescingFakeChatModel(CoalescingMixin, FakeChatModel):
+    pass
+
+
+class LoadTestRegistry(ChatbotRegistry):
+    """Registry whose chains talk to fakes instead of OpenAI."""
+
+    def __init__(self, options):
+        self.options = options
+        embeddings = FakeEmbeddings(latency=options["embedding_latency"])
+        # An in-memory collection keeps retrieval cost realistic without
+        # touching the persisted vector_db. Chroma still writes its HNSW
+        # index to disk, so give it a directory of its own.
+        directory = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        db = ThreadSafeChroma.from_texts(
+            [
+                f"Condition {i} question\nCondition {i} is a common cause of "
+                f"headache, fever and back pain in adults."
+                for i in range(options["documents"])
+            ],
+            embeddings,
+            metadatas=[{"focus": f"Condition {i}"} for i in range(options["documents"])],
+            collection_name="load_test",
+            client_settings=chromadb.config.Settings(
+                anonymized_telemetry=False, persist_directory=directory
+            ),
+        )
+        super().__init__(
+            embeddings=embeddings, retriever=db.as_retriever(search_type="mmr")
+        )
+        self.intents_chain.llm = self.chat_model(intent_responder)
+        if not options["response_cache"]:
+            self.response_cache = None
+        settings.CHATBOT_COMPLETION_CACHE = options["completion_cache"]
+
+    def chat_model(self, responder, callback_manager=None, streaming=False):
+        return CoalescingFakeChatModel(
+            responder=responder,
+            latency=self.options["llm_latency"],
+            tokens_per_second=self.options["tokens_per_second"],
+            streaming=streaming,
+            callback_manager=callback_manager,
+            verbose=True,
+        )
+
+    def build_session_chains(self, question_handler, stream_handler, memory, **kwargs):
+        # Tracing would post every run to a LangChain server.
+        kwargs["tracing"] = False
+        chains = super().build_session_chains(
+            question_handler, stream_handler, memory, **kwargs
+        )
+        answer = answer_responder(self.options["answer_tokens"])
+        qa = chains.symptoms_qa
+        qa.question_generator.llm = CoalescingFakeLLM(
+            responder=lambda prompt: FLOWS["symptom"],
+            latency=self.options["llm_latency"],
+            callback_manager=qa.question_generator.llm.callback_manager,
+            verbose=True,
+        )
+        stream_llm = qa.combine_docs_chain.llm_chain.llm
+        qa.combine_docs_chain.llm_chain.llm = CoalescingFakeLLM(
+            responder=answer,
+            latency=self.options["llm_latency"],
+            tokens_per_second=self.options["tokens_per_second"],
+            streaming=True,
+            callback_manager=stream_llm.callback_manager,
+            verbose=True,
+        )
+        chains.general_chat.llm = self.chat_model(
+            answer, chains.general_chat.llm.callback_manager, streaming=True
+        )
+        chains.appointment.llm = self.chat_model(
+            appointment_responder, chains.appointment.llm.callback_manager
+        )
+        return chains
+
+
+def install_admission(options):
+    # Simulated users send turns back to back, so --rate-limit defaults to off.
+    set_admission(
+        AdmissionController(
+            max_concurrent=options["max_concurrent_turns"],
+            rate_per_minute=options["rate_limit"],
+            burst=settings.CHATBOT_RATE_LIMIT_BURST,
+        )
+    )
+
+
+class TurnStats:
+    def __init__(self):
+        self.connect = []
+        self.ttft = {flow: [] for flow in FLOWS}
+        self.turn = {flow: [] for flow in FLOWS}
+        self.tokens_per_second = []
+        self.errors = Counter()
+        self.rejected = Counter()
+
+
+def create_user(number):
+    from patient.models import HealthProfile
+
+    user = get_user_model().objects.create_user(
+        username=f"load-test-{number}", password="load-test"
+    )
+    HealthProfile.objects.create(
+        user=user,
+        gender="O",
+        date_of_birth=date(1990, 1, 1),
+        height=175,
+        weight=70,
+        health_conditions_notes="None",
+    )
+    client = Client()
+    client.force_login(user)
+    return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives simulated users through ChatRoomConsumer with fake OpenAI "
+        "backends and reports latency percentiles"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--turns", type=int, default=3)
+        parser.add_argument(
+            "--flows",
+            default="symptom,appointment,general",
+            help="Comma separated flows each user cycles through",
+        )
+        parser.add_argument("--ramp-up", type=float, default=1.0, help="Seconds")
+        parser.add_argument("--llm-latency", type=float, default=0.3)
+        parser.add_argument("--tokens-per-second", type=float, default=50.0)
+        parser.add_argument("--answer-tokens", type=int, default=100)
+        parser.add_argument("--embedding-latency", type=float, default=0.05)
+        parser.add_argument("--documents", type=int, default=200)
+        parser.add_argument(
+            "--response-cache",
+            action="store_true",
+            help="Keep the semantic response cache; identical flows then hit it",
+        )
+        parser.add_argument(
+            "--completion-cache",
+            action="store_true",
+            help="Keep the completion cache of temperature-0 calls",
+        )
+        parser.add_argument(
+            "--no-coalesce",
+            action="store_true",
+            help="Send identical concurrent LLM calls separately",
+        )
+        parser.add_argument(
+            "--max-concurrent-turns",
+            type=int,
+            default=settings.CHATBOT_MAX_CONCURRENT_TURNS,
+        )
+        parser.add_argument(
+            "--rate-limit",
+            type=float,
+            default=0,
+            help="Messages per user and minute, 0 for no limit",
+        )
+        parser.add_argument(
+            "--spammers",
+            type=int,
+            default=0,
+            help="Extra users sending messages without waiting for answers",
+        )
+        parser.add_argument(
+            "--spam-interval", type=float, default=0.05, help="Seconds"
+        )
+        parser.add_argument("--timeout", type=float, default=60.0)
+        parser.add_argument(
+            "--no-memory",
+            action="store_true",
+            help="Skip tracemalloc, which slows down the connect phase",
+        )
+
+    def handle(self, *args, **options):
+        os.environ.setdefault("OPENAI_API_KEY", "load-test")
+        flows = options["flows"].split(",")
+        if options["no_coalesce"]:
+            settings.CHATBOT_COALESCE_LLM_CALLS = False
+        # Every simulated user books the same slot; measure bookings, not conflicts.
+        settings.CHATBOT_APPOINTMENT_CAPACITY = options["users"] * options["turns"]
+        test_db = connection.creation.create_test_db(verbosity=0)
+        try:
+            set_registry(LoadTestRegistry(options))
+            install_admission(options)
+            from config.asgi import application
+
+            cookies = [create_user(i) for i in range(options["users"])]
+            spammers = [
+                create_user(options["users"] + i) for i in range(options["spammers"])
+            ]
+            # The consumer prints every chain result; keep that out of the report.
+            if options["verbosity"] < 2:
+                quiet = contextlib.redirect_stdout(io.StringIO())
+            else:
+                quiet = contextlib.nullcontext()
+            with quiet:
+                stats, memory, wall = asyncio.run(
+                    self.run(application, cookies, flows, options, spammers)
+                )
+        finally:
+            connection.creation.destroy_test_db(test_db, verbosity=0)
+        self.report(stats, memory, wall, options)
+
+    async def run(self, application, cookies, flows, options, spammers=()):
+        stats = TurnStats()
+        users = len(cookies)
+        connected = asyncio.Event()
+        pending = [users]
+
+        def on_connected():
+            pending[0] -= 1
+            if not pending[0]:
+                connected.set()
+
+        if not options["no_memory"]:
+            tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        tasks = [
+            asyncio.ensure_future(
+                self.user(
+                    application, number, cookie, flows, options, stats, on_connected
+                )
+            )
+            for number, cookie in enumerate(cookies)
+        ]
+        await asyncio.wait_for(connected.wait(), options["timeout"])
+        # Measured once everyone is connected, before any answer is streamed.
+        memory = (tracemalloc.get_traced_memory()[0] - baseline) / users
+        tracemalloc.stop()
+        done = asyncio.Event()
+        spam = [
+            asyncio.ensure_future(
+                self.spammer(application, users + i, cookie, options, stats, done)
+            )
+            for i, cookie in enumerate(spammers)
+        ]
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+        done.set()
+        await asyncio.gather(*spam)
+        return stats, memory, wall
+
+    def open_connection(self, application, number, cookie):
+        return WebsocketCommunicator(
+            application,
+            f"/ws/chat/loadtest{number}/",
+            headers=[(b"cookie", f"{settings.SESSION_COOKIE_NAME}={cookie}".encode())],
+        )
+
+    async def user(self, application, number, cookie, flows, options, stats, on_connected):
+        await asyncio.sleep(options["ramp_up"] * number / options["users"])
+        communicator = self.open_connection(application, number, cookie)
+        timeout = options["timeout"]
+        start = time.perf_counter()
+        try:
+            try:
+                await communicator.connect(timeout)
+                while True:
+                    frame = json.loads(await communicator.receive_from(timeout))
+                    if frame["message"] == "Ready to accept questions":
+                        break
+                stats.connect.append(time.perf_counter() - start)
+            finally:
+                on_connected()
+            for turn in range(options["turns"]):
+                flow = flows[turn % len(flows)]
+                await self.turn(communicator, flow, stats, timeout)
+            await communicator.disconnect()
+        except Exception as e:
+            stats.errors[repr(e)] += 1
+
+    async def spammer(self, application, number, cookie, options, stats, done):
+        """Send messages every ``spam_interval`` until the other users finish."""
+        communicator = self.open_connection(application, number, cookie)
+        timeout = options["timeout"]
+
+        async def read():
+            while True:
+                frame = json.loads(await communicator.receive_from(timeout))
+                if frame["type"] == "error":
+                    stats.rejected[frame["message"]] += 1
+
+        try:
+            await communicator.connect(timeout)
+            reader = asyncio.ensure_future(read())
+            while not done.is_set():
+                await communicator.send_to(
+                    text_data=json.dumps({"message": FLOWS["general"]})
+                )
+                await asyncio.sleep(options["spam_interval"])
+            reader.cancel()
+            await communicator.disconnect()
+        except Exception as e:
+            stats.errors[f"spammer: {e!r}"] += 1
+
+    async def turn(self, communicator, flow, stats, timeout):
+        await communicator.send_to(text_data=json.dumps({"message": FLOWS[flow]}))
+        start = time.perf_counter()
+        first = None
+        frames = tokens = 0
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout))
+            if frame["username"] != "bot":
+                continue
+            if frame["type"] == "stream" and frame["message"]:
+                if first is None:
+                    first = time.perf_counter()
+                frames += 1
+                tokens += len(_TOKEN_RE.findall(frame["message"]))
+            elif frame["type"] in ("end", "clarification"):
+                break
+            elif frame["type"] == "error":
+                raise RuntimeError(frame["message"])
+        end = time.perf_counter()
+        stats.turn[flow].append(end - start)
+        if first is not None:
+            stats.ttft[flow].append(first - start)
+            # A single frame, e.g. an appointment confirmation, has no rate.
+            if frames > 1:
+                stats.tokens_per_second.append(tokens / (end - first))
+
+    def report(self, stats, memory, wall, options):
+        def summary(label, values, unit=1000, suffix="ms"):
+            if not values:
+                return
+            self.stdout.write(
+                f"{label:>22}: n={len(values)} "
+                f"p50 {percentile(values, 0.5) * unit:.1f} {suffix}, "
+                f"p95 {percentile(values, 0.95) * unit:.1f} {suffix}, "
+                f"p99 {percentile(values, 0.99) * unit:.1f} {suffix}"
+            )
+
+        turns = sum(len(values) for values in stats.turn.values())
+        self.stdout.write(
+            f"{options['users']} users, {turns} turns in {wall:.2f}s "
+            f"({turns / wall:.1f} turns/s), {sum(stats.errors.values())} errors"
+        )
+        for error, count in stats.errors.most_common():
+            self.stdout.write(f"{count:>6} x {error}")
+        summary("connect", stats.connect)
+        for flow in FLOWS:
+            summary(f"{flow} first token", stats.ttft[flow])
+            summary(f"{flow} turn", stats.turn[flow])
+        summary("tokens/s per answer", stats.tokens_per_second, 1, "tok/s")
+        admission = get_admission()
+        if admission.wait.count:
+            self.stdout.write(
+                f"{'admission wait':>22}: mean "
+                f"{admission.wait.sum / admission.wait.count * 1000:.1f} ms"
+            )
+        flight = get_single_flight()
+        if flight.calls:
+            self.stdout.write(
+                f"{'LLM calls':>22}: {sum(flight.calls.values())} sent, "
+                f"{sum(flight.coalesced.values())} coalesced"
+            )
+        cache = get_completion_cache()
+        if options["completion_cache"]:
+            self.stdout.write(
+                f"{'completion cache':>22}: {cache.memory_hits} memory hits, "
+                f"{cache.database_hits} database hits, {cache.misses} misses"
+            )
+        counts = get_metrics().counts
+        kept = counts.get(("symptom_message", "context_tokens"), 0)
+        saved = counts.get(("symptom_message", "context_tokens_saved"), 0)
+        if kept or saved:
+            self.stdout.write(
+                f"{'context tokens':>22}: {kept} stuffed, {saved} saved by packing"
+            )
+        for message, count in stats.rejected.most_common():
+            self.stdout.write(f"{'rejected':>22}: {count} x {message}")
+        if not options["no_memory"]:
+            self.stdout.write(f"{'memory/connection':>22}: {memory / 1024:.1f} KiB")
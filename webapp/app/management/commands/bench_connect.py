@@ -0,0 +1,64 @@
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from langchain.memory import ConversationBufferMemory
+
+from app.chatbot.callback import QuestionGenCallbackHandler, StreamingLLMCallbackHandler
+from app.chatbot.chains import (
+    get_appointment_chain,
+    get_general_chat_chain,
+    get_intents_chain,
+    get_symptoms_chain,
+)
+from app.chatbot.registry import get_registry
+from app.chatbot.utils import init_retriever
+
+
+def build_per_connection(question_handler, stream_handler, memory):
+    """Replicates what ChatRoomConsumer.connect did before the registry."""
+    retriever = init_retriever()
+    get_intents_chain()
+    get_symptoms_chain(retriever, question_handler, stream_handler)
+    get_general_chat_chain(stream_handler, memory=memory)
+    get_appointment_chain(memory)
+
+
+def build_from_registry(question_handler, stream_handler, memory):
+    get_registry().build_session_chains(question_handler, stream_handler, memory)
+
+
+class Command(BaseCommand):
+    help = "Measures chain setup latency of a chat connection before/after the registry"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=20)
+
+    def measure(self, label, build, connections):
+        timings = []
+        tracemalloc.start()
+        for _ in range(connections):
+            question_handler = QuestionGenCallbackHandler(None)
+            stream_handler = StreamingLLMCallbackHandler(None)
+            start = time.perf_counter()
+            build(question_handler, stream_handler, ConversationBufferMemory())
+            timings.append(time.perf_counter() - start)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        self.stdout.write(
+            f"{label:>16}: mean {sum(timings) / len(timings) * 1000:.2f} ms, "
+            f"p95 {p95 * 1000:.2f} ms, "
+            f"peak memory {peak / 1024 / 1024:.1f} MiB"
+        )
+
+    def handle(self, *args, **options):
+        connections = options["connections"]
+        self.measure("per-connection", build_per_connection, connections)
+        start = time.perf_counter()
+        get_registry()
+        self.stdout.write(
+            f"registry startup: {(time.perf_counter() - start) * 1000:.2f} ms"
+        )
+        self.measure("registry", build_from_registry, connections)
@@ -0,0 +1,99 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from langchain.schema import Document
+
+from app.chatbot.context import ContextPacker
+
+from .bench_chat_load import percentile
+
+SENTENCES = [
+    "{focus} is a condition that affects the {part}.",
+    "The most common symptoms of {focus} are pain, stiffness and swelling.",
+    "Symptoms usually get worse after long periods of sitting.",
+    "A doctor diagnoses {focus} with a physical exam and imaging tests.",
+    "Treatments include rest, physical therapy and pain relievers.",
+    "Surgery is rarely needed.",
+    "Most people recover within a few weeks.",
+    "Older adults and people who work at a desk are at higher risk.",
+    "These resources address the diagnosis or management of {focus}.",
+    "The Genetic Testing Registry lists laboratories that offer tests for it.",
+]
+FILLER = [
+    "Researchers are studying how {word} influences the course of the disease.",
+    "Some patients report {word} during the first months.",
+    "Clinical trials have compared {word} with a placebo in adults.",
+    "Guidelines differ on the role of {word} in long-term care.",
+]
+WORDS = [
+    "diet", "sleep", "genetics", "exercise", "stress", "smoking", "weather",
+    "posture", "weight", "age", "hormones", "medication",
+]
+PARTS = ["neck", "back", "knee", "shoulder", "hip", "wrist"]
+QUESTIONS = [
+    "What are the symptoms of {focus} ?",
+    "What are the treatments for {focus} ?",
+    "What is (are) {focus} ?",
+]
+
+
+def retrieved_documents(rng, sentences):
+    """Four MedQuAD-like answers about one focus that share some sentences."""
+    part = rng.choice(PARTS)
+    focus = f"{part.title()} Pain"
+    shared = [s.format(focus=focus, part=part) for s in SENTENCES]
+    documents = []
+    for number, question in enumerate(QUESTIONS + [rng.choice(QUESTIONS)]):
+        answer = [
+            rng.choice(shared)
+            if rng.random() < 0.25
+            else rng.choice(FILLER).format(word=rng.choice(WORDS))[:-1]
+            + f" (study {number}.{i})."
+            for i in range(sentences)
+        ]
+        lines = [" ".join(answer[i : i + 4]) for i in range(0, len(answer), 4)]
+        documents.append(
+            Document(
+                page_content="\n".join([question.format(focus=focus)] + lines),
+                metadata={"focus": focus},
+            )
+        )
+    return f"my {part} hurts, what are the symptoms of {part} pain?", documents
+
+
+class Command(BaseCommand):
+    help = "Measures the tokens saved by packing retrieved documents into a budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=200)
+        parser.add_argument(
+            "--sentences", type=int, default=60, help="Sentences per answer"
+        )
+        parser.add_argument(
+            "--budgets", type=int, nargs="+", default=[600, 1200, 2400]
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        turns = [
+            retrieved_documents(rng, options["sentences"])
+            for _ in range(options["turns"])
+        ]
+        for budget in options["budgets"]:
+            packer = ContextPacker(budget)
+            original = tokens = 0
+            latencies = []
+            for query, documents in turns:
+                start = time.perf_counter()
+                context = packer.pack(documents, query)
+                latencies.append(time.perf_counter() - start)
+                original += context.original_tokens
+                tokens += context.tokens
+            self.stdout.write(
+                f"budget {budget:>5}: {original / len(turns):7.0f} -> "
+                f"{tokens / len(turns):5.0f} tokens per turn "
+                f"({1 - tokens / original:.0%} saved), packing p50 "
+                f"{percentile(latencies, 0.5) * 1000:.2f} ms, p95 "
+                f"{percentile(latencies, 0.95) * 1000:.2f} ms"
+            )
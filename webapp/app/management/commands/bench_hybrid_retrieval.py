@@ -0,0 +1,128 @@
+import asyncio
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.chatbot.fakes import FakeEmbeddings
+from app.chatbot.lexical_index import BM25Index, HybridRetriever
+from app.chatbot.vector_index import NumpyVectorIndex
+
+from .bench_chat_load import percentile
+
+BODY_PARTS = [
+    "neck", "back", "knee", "shoulder", "hip", "ankle", "wrist", "chest",
+    "head", "skin", "eye", "ear", "stomach", "lung", "liver", "kidney",
+]
+KINDS = [
+    "pain", "arthritis", "injury", "cancer", "infection", "inflammation",
+    "syndrome", "disorder", "tumor", "rash",
+]
+QUESTIONS = [
+    "What is (are) {focus} ?",
+    "What are the symptoms of {focus} ?",
+    "What are the treatments for {focus} ?",
+    "How to diagnose {focus} ?",
+    "What causes {focus} ?",
+]
+SHORT_QUERIES = ["{focus}", "{focus} symptoms", "treatments for {focus}"]
+LONG_QUERIES = [
+    "My {part} has been bothering me for weeks, it started after I moved house",
+    "I keep waking up at night and something feels wrong, maybe my {part}?",
+    "Since the holidays I feel tired, dizzy and a bit feverish",
+]
+
+
+def medquad_like_corpus(documents):
+    """Questions about focuses such as "Neck Pain", five per focus."""
+    texts, metadatas, focuses = [], [], []
+    for number in range(documents // len(QUESTIONS)):
+        part = BODY_PARTS[number % len(BODY_PARTS)]
+        kind = KINDS[number // len(BODY_PARTS) % len(KINDS)]
+        generation = number // (len(BODY_PARTS) * len(KINDS))
+        focus = f"{part.title()} {kind.title()}"
+        if generation:
+            focus += f" type {generation}"
+        focuses.append((focus, part))
+        for question in QUESTIONS:
+            question = question.format(focus=focus)
+            texts.append(f"{question}\n{focus} is a condition of the {part}.")
+            metadatas.append({"focus": focus, "question": question})
+    return texts, metadatas, focuses
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares vector-only and hybrid BM25 + vector retrieval on a "
+        "MedQuAD-like corpus with slow fake embeddings"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--documents", type=int, default=16000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument(
+            "--short-share",
+            type=float,
+            default=0.5,
+            help="Share of keyword queries such as 'neck pain'",
+        )
+        parser.add_argument("--embedding-latency", type=float, default=0.1)
+        parser.add_argument("--confidence", type=float, default=0.9)
+
+    def handle(self, *args, **options):
+        texts, metadatas, focuses = medquad_like_corpus(options["documents"])
+        embeddings = FakeEmbeddings(dimensions=1536)
+        start = time.perf_counter()
+        vectors = NumpyVectorIndex.from_texts(texts, embeddings, metadatas)
+        self.stdout.write(f"Vector index: {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        lexical = BM25Index.from_texts(texts, metadatas)
+        self.stdout.write(
+            f"BM25 index: {time.perf_counter() - start:.2f}s, {len(lexical.terms)} "
+            f"terms, {len(lexical.postings)} postings"
+        )
+        embeddings.latency = options["embedding_latency"]
+        vector_retriever = vectors.as_retriever(search_type="mmr")
+        hybrid = HybridRetriever(
+            lexical, vector_retriever, confidence=options["confidence"]
+        )
+
+        rng = random.Random(0)
+        queries = []
+        for _ in range(options["queries"]):
+            focus, part = rng.choice(focuses)
+            if rng.random() < options["short_share"]:
+                query = rng.choice(SHORT_QUERIES).format(focus=focus.lower())
+            else:
+                query = rng.choice(LONG_QUERIES).format(part=part)
+            queries.append((query, focus))
+
+        async def run(label, retriever):
+            calls = embeddings.calls
+            latencies, found = [], 0
+            for query, focus in queries:
+                start = time.perf_counter()
+                docs = await retriever.aget_relevant_documents(query)
+                latencies.append(time.perf_counter() - start)
+                found += any(doc.metadata["focus"] == focus for doc in docs)
+            self.stdout.write(
+                f"{label:>12}: p50 {percentile(latencies, 0.5) * 1000:7.1f} ms, "
+                f"p95 {percentile(latencies, 0.95) * 1000:7.1f} ms, "
+                f"{embeddings.calls - calls} embeddings, "
+                f"target focus in results for {found}/{len(queries)} queries"
+            )
+
+        asyncio.run(run("vector", vector_retriever))
+        asyncio.run(run("hybrid", hybrid))
+        self.stdout.write(
+            f"Answered lexically: {hybrid.lexical_only}, fused: {hybrid.fused}"
+        )
+        rows = []
+        for query, _ in queries:
+            start = time.perf_counter()
+            lexical.search(query, 20)
+            rows.append(time.perf_counter() - start)
+        self.stdout.write(
+            f"BM25 search alone: p50 {percentile(rows, 0.5) * 1000:.2f} ms, "
+            f"p95 {percentile(rows, 0.95) * 1000:.2f} ms"
+        )
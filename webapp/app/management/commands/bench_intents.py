@@ -0,0 +1,84 @@
+import asyncio
+import csv
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from langchain.chains.llm import LLMChain
+
+from app.chatbot.fakes import FakeLLM
+from app.chatbot.intents import ABS_PATH, IntentRouter
+from app.chatbot.utils import get_intent_prompt
+
+INTENT_EVAL_FILE = os.path.join(ABS_PATH, "data", "intent_eval.csv")
+
+
+class Command(BaseCommand):
+    help = "Compares the local intent router with the LLM intents chain"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--eval-file", default=INTENT_EVAL_FILE)
+        parser.add_argument(
+            "--llm-latency",
+            type=float,
+            default=0.6,
+            help="Seconds the fake LLM waits before answering",
+        )
+        parser.add_argument(
+            "--threshold", type=float, default=settings.CHATBOT_INTENT_CONFIDENCE
+        )
+
+    def handle(self, *args, **options):
+        with open(options["eval_file"]) as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        gold = {row["input"]: row["intent"] for row in rows}
+
+        def oracle(prompt):
+            # The fake LLM always answers correctly; only its latency matters.
+            message = prompt.rsplit("input: ", 1)[-1].split("\n", 1)[0]
+            return gold[message]
+
+        llm_chain = LLMChain(
+            llm=FakeLLM(responder=oracle, latency=options["llm_latency"]),
+            prompt=get_intent_prompt(),
+        )
+        router = IntentRouter(threshold=options["threshold"])
+
+        correct, timings = 0, []
+        for row in rows:
+            start = time.perf_counter()
+            intent, _ = router.classify(row["input"])
+            timings.append(time.perf_counter() - start)
+            correct += intent == row["intent"]
+        self.report("local router", correct, timings, len(rows))
+
+        async def run(route):
+            correct, timings = 0, []
+            for row in rows:
+                start = time.perf_counter()
+                intent = await route(row["input"])
+                timings.append(time.perf_counter() - start)
+                correct += intent == row["intent"]
+            return correct, timings
+
+        correct, timings = asyncio.run(
+            run(lambda message: llm_chain.arun(input=message))
+        )
+        self.report("llm chain", correct, timings, len(rows))
+
+        correct, timings = asyncio.run(
+            run(lambda message: router.aroute(message, llm_chain))
+        )
+        self.report("router+fallback", correct, timings, len(rows))
+        self.stdout.write(
+            f"LLM fallbacks: {router.llm_fallbacks}/{len(rows)} "
+            f"at threshold {router.threshold}"
+        )
+
+    def report(self, label, correct, timings, total):
+        self.stdout.write(
+            f"{label:>16}: accuracy {correct / total:.1%}, "
+            f"mean {sum(timings) / total * 1000:.3f} ms, "
+            f"max {max(timings) * 1000:.3f} ms"
+        )
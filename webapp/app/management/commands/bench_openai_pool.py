@@ -0,0 +1,94 @@
+import asyncio
+import os
+import time
+
+import openai
+from aiohttp import web
+from django.core.management.base import BaseCommand
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import HumanMessage
+
+from app.chatbot.mock_openai import MockOpenAIServer
+from app.chatbot.openai_client import get_async_session, openai_llm_kwargs
+
+from .bench_chat_load import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares streamed ChatOpenAI calls against a local mock API with a "
+        "new aiohttp session per request (openai's default) and with the "
+        "shared connection pool"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--latency", type=float, default=0.05)
+        parser.add_argument("--tokens-per-second", type=float, default=0.0)
+        parser.add_argument("--answer-tokens", type=int, default=20)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+
+    def handle(self, *args, **options):
+        os.environ.setdefault("OPENAI_API_KEY", "load-test")
+        asyncio.run(self.bench(options))
+
+    async def bench(self, options):
+        server = MockOpenAIServer(
+            latency=options["latency"],
+            tokens_per_second=options["tokens_per_second"],
+            answer_tokens=options["answer_tokens"],
+            error_rate=options["error_rate"],
+        )
+        runner = web.AppRunner(server.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        api_base = openai.api_base
+        openai.api_base = f"http://127.0.0.1:{port}/v1"
+        try:
+            for name, session in (("per-request", None), ("pooled", get_async_session)):
+                server.requests = server.errors = 0
+                server._transports.clear()
+                latencies, failures, wall, retries = await self.run(session, options)
+                self.stdout.write(
+                    f"{name:>12}: {options['requests'] / wall:7.1f} req/s  "
+                    f"p50 {percentile(latencies, 0.5) * 1000:6.1f} ms  "
+                    f"p95 {percentile(latencies, 0.95) * 1000:6.1f} ms  "
+                    f"connections {server.connections}  "
+                    f"retries {retries}  failed {failures}"
+                )
+        finally:
+            openai.api_base = api_base
+            await runner.cleanup()
+
+    async def run(self, session_factory, options):
+        session = session_factory() if session_factory else None
+        token = openai.aiosession.set(session)
+        llm = ChatOpenAI(**openai_llm_kwargs(), streaming=True, temperature=0)
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        latencies = []
+        failures = 0
+
+        async def call(i):
+            nonlocal failures
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await llm.agenerate([[HumanMessage(content=f"Question {i}")]])
+                except Exception:
+                    failures += 1
+                else:
+                    latencies.append(time.perf_counter() - start)
+
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*(call(i) for i in range(options["requests"])))
+            wall = time.perf_counter() - start
+        finally:
+            openai.aiosession.reset(token)
+        retries = session.retries if session else 0
+        if session:
+            await session.close()
+        return latencies, failures, wall, retries
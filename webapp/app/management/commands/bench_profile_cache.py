@@ -0,0 +1,123 @@
+import asyncio
+import random
+import time
+from datetime import date
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from patient.models import HealthProfile
+from patient.profiles import (
+    aget_profile_snapshot,
+    format_profile,
+    get_profile_snapshot,
+    stats,
+)
+
+from .bench_chat_load import percentile
+
+
+def uncached_profile(user_id):
+    """The profile straight from the database."""
+    user = get_user_model().objects.get(pk=user_id)
+    return format_profile(user.healthprofile)
+
+
+class Command(BaseCommand):
+    help = "Compares loading health profiles per connect with the snapshot cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=500)
+        parser.add_argument("--connects", type=int, default=5000)
+        parser.add_argument("--concurrency", type=int, default=50)
+
+    def handle(self, *args, **options):
+        test_db = connection.creation.create_test_db(verbosity=0)
+        try:
+            self.bench(options)
+        finally:
+            connection.creation.destroy_test_db(test_db, verbosity=0)
+
+    def bench(self, options):
+        User = get_user_model()
+        users = User.objects.bulk_create(
+            User(username=f"profile-bench-{i}") for i in range(options["users"])
+        )
+        HealthProfile.objects.bulk_create(
+            HealthProfile(
+                user=user,
+                gender="O",
+                date_of_birth=date(1960 + i % 40, 1 + i % 12, 1 + i % 28),
+                height=150 + i % 50,
+                weight=50 + i % 60,
+                health_conditions_notes=f"Condition notes of user {i}",
+            )
+            for i, user in enumerate(users)
+        )
+        cache.clear()
+        rng = random.Random(0)
+        connects = [rng.choice(users).pk for _ in range(options["connects"])]
+
+        # In the scope the user is already loaded; only the profile is queried.
+        scope_users = {user.pk: user for user in User.objects.all()}
+
+        def per_connect(user_id):
+            user = scope_users[user_id]
+            user._state.fields_cache.clear()
+            return format_profile(user.healthprofile)
+
+        for label, load in (
+            ("per connect", database_sync_to_async(per_connect)),
+            ("snapshot cache", aget_profile_snapshot),
+        ):
+            timings, wall = asyncio.run(self.connect(load, connects, options))
+            self.stdout.write(
+                f"{label:>14}: {len(connects) / wall:7.0f} connects/s, "
+                f"p50 {percentile(timings, 0.5) * 1000:.3f} ms, "
+                f"p95 {percentile(timings, 0.95) * 1000:.3f} ms"
+            )
+        self.stdout.write(
+            f"snapshot cache: {stats.hits} hits, {stats.misses} misses "
+            f"({stats.hits / (stats.hits + stats.misses):.1%} hit rate)"
+        )
+
+        sample = connects[:200]
+        for label, load in (
+            ("per connect", per_connect),
+            ("snapshot cache", get_profile_snapshot),
+        ):
+            with CaptureQueriesContext(connection) as queries:
+                for user_id in sample:
+                    load(user_id)
+            self.stdout.write(
+                f"{label:>14}: {len(queries) / len(sample):.2f} queries per connect"
+            )
+
+        profile = HealthProfile.objects.get(user_id=sample[0])
+        before = get_profile_snapshot(profile.user_id)
+        profile.weight += 5
+        profile.save()
+        after = get_profile_snapshot(profile.user_id)
+        self.stdout.write(
+            f"after a profile save: snapshot updated {before != after}, "
+            f"matches the database {after == uncached_profile(profile.user_id)}, "
+            f"{stats.invalidations} invalidations"
+        )
+
+    async def connect(self, load, connects, options):
+        timings = []
+        semaphore = asyncio.Semaphore(options["concurrency"])
+
+        async def one(user_id):
+            async with semaphore:
+                start = time.perf_counter()
+                await load(user_id)
+                timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(user_id) for user_id in connects))
+        return timings, time.perf_counter() - start
@@ -0,0 +1,196 @@
+import os
+import random
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from datetime import time as dtime
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from app.chatbot.slots import SlotIndex
+from app.models import Appointment
+
+from .bench_chat_load import percentile
+
+
+def clock(minute):
+    minute = min(max(minute, 0), 24 * 60 - 1)
+    return dtime(minute // 60, minute % 60)
+
+
+def sql_busy(day, minute, minutes):
+    """The conflict check without the index: look for an overlapping row."""
+    return Appointment.objects.filter(
+        date=day, time__gt=clock(minute - minutes), time__lt=clock(minute + minutes)
+    ).exists()
+
+
+def sql_free_slots(index, after, n):
+    """Free slots from one (date, time) range query per day."""
+    found = []
+    opening, closing = index.hours[0] * 60, index.hours[1] * 60 - index.minutes
+    day = after.date()
+    while len(found) < n:
+        if day.weekday() in index.weekdays:
+            starts = [
+                t.hour * 60 + t.minute
+                for t in Appointment.objects.filter(date=day)
+                .order_by("time")
+                .values_list("time", flat=True)
+            ]
+            for minute in range(opening, closing + 1, index.minutes):
+                slot = datetime.combine(day, dtime(minute // 60, minute % 60))
+                if slot < after:
+                    continue
+                if not any(abs(s - minute) < index.minutes for s in starts):
+                    found.append(slot)
+                    if len(found) == n:
+                        break
+        day += timedelta(days=1)
+    return found
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills a database with appointments and compares the in-memory slot "
+        "index with SQL for conflict checks and next free slots"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--appointments", type=int, default=100000)
+        parser.add_argument("--queries", type=int, default=2000)
+        parser.add_argument(
+            "--occupancy", type=float, default=0.9, help="Share of slots booked"
+        )
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+        test_db = connection.creation.create_test_db(verbosity=0)
+        try:
+            self.bench(options)
+        finally:
+            connection.creation.destroy_test_db(test_db, verbosity=0)
+
+    def bench(self, options):
+        rng = random.Random(0)
+        index = SlotIndex()
+        today = date.today()
+        grid = range(index.hours[0] * 60, index.hours[1] * 60, index.minutes)
+        appointments = []
+        day = today
+        while len(appointments) < options["appointments"]:
+            if day.weekday() in index.weekdays:
+                for minute in grid:
+                    if rng.random() < options["occupancy"]:
+                        appointments.append(
+                            Appointment(
+                                name="Benchmark appointment",
+                                date=day,
+                                time=dtime(minute // 60, minute % 60),
+                                description="Created by bench_slot_index",
+                            )
+                        )
+            day += timedelta(days=1)
+        appointments = appointments[: options["appointments"]]
+        last_day = appointments[-1].date
+        start = time.perf_counter()
+        Appointment.objects.bulk_create(appointments, batch_size=5000)
+        self.stdout.write(
+            f"inserted {len(appointments)} appointments up to {last_day} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+        start = time.perf_counter()
+        index.load(today)
+        self.stdout.write(
+            f"index load: {time.perf_counter() - start:.2f}s, {len(index)} appointments"
+        )
+
+        span = (last_day - today).days
+        checks = [
+            (
+                today + timedelta(days=rng.randrange(span)),
+                rng.randrange(index.hours[0] * 60, index.hours[1] * 60, 15),
+            )
+            for _ in range(options["queries"])
+        ]
+        starts = [
+            datetime.combine(today + timedelta(days=rng.randrange(span)), dtime(8))
+            for _ in range(options["queries"] // 10)
+        ]
+
+        def measure(label, function, arguments):
+            timings, results = [], []
+            for argument in arguments:
+                begin = time.perf_counter()
+                results.append(function(*argument))
+                timings.append(time.perf_counter() - begin)
+            self.stdout.write(
+                f"{label:>28}: p50 {percentile(timings, 0.5) * 1000:7.3f} ms, "
+                f"p95 {percentile(timings, 0.95) * 1000:7.3f} ms"
+            )
+            return results
+
+        def index_busy(day, minute):
+            return not index.is_free(day, clock(minute))
+
+        def unindexed(label, function, arguments):
+            with connection.schema_editor() as editor:
+                editor.remove_index(Appointment, Appointment._meta.indexes[0])
+            try:
+                return measure(label, function, arguments)
+            finally:
+                with connection.schema_editor() as editor:
+                    editor.add_index(Appointment, Appointment._meta.indexes[0])
+
+        fast = measure("conflict check, index", index_busy, checks)
+        slow = measure(
+            "conflict check, sql",
+            sql_busy,
+            [(d, m, index.minutes) for d, m in checks],
+        )
+        unindexed(
+            "conflict check, sql no index",
+            sql_busy,
+            [(d, m, index.minutes) for d, m in checks[:200]],
+        )
+        self.stdout.write(
+            f"  agree on {sum(a == b for a, b in zip(fast, slow))}/{len(checks)}, "
+            f"{sum(fast)} conflicts"
+        )
+
+        fast = measure(
+            "next 3 free slots, index", index.free_slots, [(s, 3) for s in starts]
+        )
+        slow = measure(
+            "next 3 free slots, sql", sql_free_slots, [(index, s, 3) for s in starts]
+        )
+        unindexed(
+            "next 3 free, sql no index",
+            sql_free_slots,
+            [(index, s, 3) for s in starts[:20]],
+        )
+        self.stdout.write(
+            f"  agree on {sum(a == b for a, b in zip(fast, slow))}/{len(starts)}"
+        )
+
+        new = [
+            Appointment(
+                name="Benchmark appointment",
+                date=last_day + timedelta(days=i // 20 + 1),
+                time=dtime(8 + i % 20 // 2, i % 2 * 30),
+                description="Created by bench_slot_index",
+            )
+            for i in range(1000)
+        ]
+        Appointment.objects.bulk_create(new)
+        begin = time.perf_counter()
+        for appointment in new:
+            index.add(appointment)
+        elapsed = time.perf_counter() - begin
+        self.stdout.write(
+            f"incremental add: {elapsed / len(new) * 1e6:.1f} us per appointment, "
+            f"{len(index)} appointments"
+        )
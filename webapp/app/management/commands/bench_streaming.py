@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.chatbot.callback import (
+    BufferedStreamingLLMCallbackHandler,
+    StreamingLLMCallbackHandler,
+)
+
+
+class FrameCounter:
+    """Stands in for the consumer and only counts outgoing frames."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send(self, text_data):
+        self.frames += 1
+        self.bytes += len(text_data)
+
+
+class Command(BaseCommand):
+    help = "Measures frames and CPU per streamed answer for each stream handler"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--answers", type=int, default=200)
+        parser.add_argument("--tokens", type=int, default=250)
+        parser.add_argument(
+            "--token-interval",
+            type=float,
+            default=0.005,
+            help="Seconds between tokens, as produced by the LLM stream",
+        )
+        parser.add_argument("--flush-interval", type=float, default=0.03)
+
+    def handle(self, *args, **options):
+        tokens = [f" token{i}" for i in range(options["tokens"])]
+
+        async def stream(handler):
+            for token in tokens:
+                await handler.on_llm_new_token(token)
+                await asyncio.sleep(options["token_interval"])
+            await handler.on_llm_end(None)
+
+        async def run(make_handler):
+            consumer = FrameCounter()
+            handlers = [make_handler(consumer) for _ in range(options["answers"])]
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            await asyncio.gather(*(stream(handler) for handler in handlers))
+            return (
+                consumer,
+                time.process_time() - cpu,
+                time.perf_counter() - wall,
+            )
+
+        answers = options["answers"]
+        for label, make_handler in (
+            ("per-token", StreamingLLMCallbackHandler),
+            (
+                "buffered",
+                lambda consumer: BufferedStreamingLLMCallbackHandler(
+                    consumer, flush_interval=options["flush_interval"]
+                ),
+            ),
+        ):
+            consumer, cpu, wall = asyncio.run(run(make_handler))
+            self.stdout.write(
+                f"{label:>10}: {consumer.frames / answers:.1f} frames/answer, "
+                f"{consumer.frames / wall:.0f} frames/s, "
+                f"{cpu / answers * 1000:.3f} ms CPU/answer, "
+                f"{consumer.bytes / answers / 1024:.1f} KiB/answer"
+            )
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+from django.core.management.base import BaseCommand
+from langchain.embeddings import FakeEmbeddings
+
+from app.chatbot.utils import ThreadSafeChroma
+from app.chatbot.vector_index import NumpyVectorIndex, normalise
+
+from .bench_chat_load import percentile
+
+
+def synthetic_corpus(documents, dimensions, seed=0):
+    """Embeddings grouped in topics of five, like MedQuAD's questions per focus."""
+    rng = np.random.default_rng(seed)
+    topics = max(1, documents // 5)
+    centers = rng.standard_normal((topics, dimensions)).astype(np.float32)
+    labels = np.arange(documents) % topics
+    vectors = centers[labels] + 0.7 * rng.standard_normal((documents, dimensions))
+    texts = [f"Condition {label} question {i}" for i, label in enumerate(labels)]
+    metadatas = [{"focus": f"Condition {label}"} for label in labels]
+    return normalise(vectors), texts, metadatas
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares search latency of the Chroma collection with the NumPy "
+        "index (exact and clustered) on a synthetic corpus"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--documents", type=int, default=16000)
+        parser.add_argument("--dimensions", type=int, default=1536)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--k", type=int, default=4)
+        parser.add_argument("--fetch-k", type=int, default=20)
+        parser.add_argument(
+            "--clusters", type=int, default=0, help="Defaults to sqrt(documents)"
+        )
+        parser.add_argument("--nprobe", type=int, default=8)
+
+    def handle(self, *args, **options):
+        vectors, texts, metadatas = synthetic_corpus(
+            options["documents"], options["dimensions"]
+        )
+        rng = np.random.default_rng(1)
+        picks = rng.integers(0, len(vectors), options["queries"])
+        # Paraphrases: the document's vector plus noise of half its length.
+        noise = rng.standard_normal((len(picks), vectors.shape[1]))
+        queries = normalise(vectors[picks] + 0.5 * normalise(noise)).tolist()
+        filters = [metadatas[i] for i in picks]
+        k, fetch_k = options["k"], options["fetch_k"]
+
+        start = time.perf_counter()
+        chroma = ThreadSafeChroma(
+            collection_name="bench_vector_index",
+            embedding_function=FakeEmbeddings(size=options["dimensions"]),
+            client_settings=chromadb.config.Settings(anonymized_telemetry=False),
+        )
+        for begin in range(0, len(vectors), 1000):
+            end = begin + 1000
+            chroma._collection.add(
+                ids=[str(i) for i in range(begin, min(end, len(vectors)))],
+                embeddings=vectors[begin:end].tolist(),
+                documents=texts[begin:end],
+                metadatas=metadatas[begin:end],
+            )
+        self.stdout.write(f"Chroma load: {time.perf_counter() - start:.1f}s")
+
+        directory = tempfile.mkdtemp()
+        start = time.perf_counter()
+        index = NumpyVectorIndex(None, vectors, texts, metadatas)
+        index.build_clusters(options["clusters"] or int(len(vectors) ** 0.5))
+        index.save(directory)
+        self.stdout.write(f"NumPy build and save: {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        exact = NumpyVectorIndex.load(directory, None)
+        approximate = NumpyVectorIndex.load(directory, None, nprobe=options["nprobe"])
+        self.stdout.write(
+            f"NumPy load (memory-mapped): {(time.perf_counter() - start) * 1000:.1f} ms, "
+            f"{exact.vectors.nbytes / 2**20:.1f} MiB"
+        )
+
+        def run(label, search):
+            latencies, results = [], []
+            for query, focus in zip(queries, filters):
+                start = time.perf_counter()
+                results.append(search(query, focus))
+                latencies.append(time.perf_counter() - start)
+            self.stdout.write(
+                f"{label:>28}: p50 {percentile(latencies, 0.5) * 1000:7.2f} ms, "
+                f"p95 {percentile(latencies, 0.95) * 1000:7.2f} ms"
+            )
+            return [[doc.page_content for doc in docs] for docs in results]
+
+        run("chroma top-k", lambda q, f: chroma.similarity_search_by_vector(q, k))
+        run(
+            "chroma mmr",
+            lambda q, f: chroma.max_marginal_relevance_search_by_vector(q, k, fetch_k),
+        )
+        run(
+            "chroma top-k + focus",
+            lambda q, f: chroma.similarity_search_by_vector(q, k, filter=f),
+        )
+        truth = run("numpy exact top-k", lambda q, f: exact.similarity_search_by_vector(q, k))
+        run(
+            "numpy exact mmr",
+            lambda q, f: exact.max_marginal_relevance_search_by_vector(q, k, fetch_k),
+        )
+        found = run(
+            f"numpy nprobe={options['nprobe']} top-k",
+            lambda q, f: approximate.similarity_search_by_vector(q, k),
+        )
+        run(
+            f"numpy nprobe={options['nprobe']} mmr",
+            lambda q, f: approximate.max_marginal_relevance_search_by_vector(
+                q, k, fetch_k
+            ),
+        )
+        run(
+            "numpy top-k + focus",
+            lambda q, f: exact.similarity_search_by_vector(q, k, filter=f),
+        )
+        recall = np.mean(
+            [len(set(a) & set(b)) / len(a) for a, b in zip(truth, found)]
+        )
+        self.stdout.write(f"Recall@{k} of nprobe={options['nprobe']}: {recall:.3f}")
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
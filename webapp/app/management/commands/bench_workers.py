@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import connection
+
+from app.chatbot.registry import set_registry
+from app.models import Appointment
+
+from .bench_chat_load import Command as LoadTestCommand
+from .bench_chat_load import (
+    LoadTestRegistry,
+    create_user,
+    install_admission,
+    percentile,
+)
+
+# Options of bench_chat_load that configure the fakes inside each worker.
+FAKE_BACKEND_OPTIONS = (
+    "llm_latency",
+    "tokens_per_second",
+    "answer_tokens",
+    "embedding_latency",
+    "documents",
+    "max_concurrent_turns",
+    "rate_limit",
+)
+
+
+class WebsocketClient:
+    """Real WebSocket connection with the WebsocketCommunicator methods used
+    by bench_chat_load."""
+
+    def __init__(self, session, url, cookie):
+        self.session = session
+        self.url = url
+        self.cookie = cookie
+        self.ws = None
+
+    async def connect(self, timeout):
+        self.ws = await self.session.ws_connect(
+            self.url,
+            headers={"Cookie": f"{settings.SESSION_COOKIE_NAME}={self.cookie}"},
+            timeout=timeout,
+        )
+
+    async def send_to(self, text_data):
+        await self.ws.send_str(text_data)
+
+    async def receive_from(self, timeout):
+        return await self.ws.receive_str(timeout=timeout)
+
+    async def disconnect(self):
+        await self.ws.close()
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f"Worker on port {port} did not start")
+
+
+class Command(LoadTestCommand):
+    help = (
+        "Runs bench_chat_load against 1..N daphne worker processes and "
+        "reports how throughput scales with the worker count. Users share "
+        "chat boxes whose members land on different workers, so answers "
+        "fan out through the channel layer."
+    )
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.set_defaults(users=200, llm_latency=0.05, tokens_per_second=0.0)
+        parser.add_argument(
+            "--workers",
+            default="1,2,4",
+            help="Comma separated worker counts to compare",
+        )
+        parser.add_argument("--base-port", type=int, default=8100)
+        parser.add_argument(
+            "--channel-layer-url",
+            default="",
+            help="Redis shared by the workers; each worker keeps its own "
+            "in-memory layer when empty",
+        )
+        parser.add_argument(
+            "--fake-redis",
+            action="store_true",
+            help="Share an in-process fakeredis server between the workers",
+        )
+        parser.add_argument(
+            "--box-size",
+            type=int,
+            help="Members per chat box; the first one asks, the others only "
+            "receive the answers. Defaults to 2 with a shared channel layer, "
+            "else 1",
+        )
+        # Internal: run a single worker instead of the benchmark.
+        parser.add_argument("--serve-port", type=int, help=argparse.SUPPRESS)
+        parser.add_argument("--database", help=argparse.SUPPRESS)
+        parser.add_argument("--appointment-capacity", type=int, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        os.environ.setdefault("OPENAI_API_KEY", "load-test")
+        if options["serve_port"]:
+            return self.serve(options)
+        options["no_memory"] = True
+        if options["fake_redis"]:
+            options["channel_layer_url"] = self.start_fake_redis()
+        if options["channel_layer_url"]:
+            os.environ["CHANNEL_LAYER_URL"] = options["channel_layer_url"]
+        if options["box_size"] is None:
+            options["box_size"] = 2 if options["channel_layer_url"] else 1
+        worker_counts = [int(n) for n in options["workers"].split(",")]
+        if (
+            options["box_size"] > 1
+            and max(worker_counts) > 1
+            and not options["channel_layer_url"]
+        ):
+            raise CommandError(
+                "Chat boxes spread over several workers need a shared channel "
+                "layer: pass --channel-layer-url or --fake-redis, or --box-size 1"
+            )
+
+        directory = tempfile.mkdtemp()
+        # Workers are separate processes, so the test database lives in a file.
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(
+            directory, "bench.sqlite3"
+        )
+        test_db = connection.creation.create_test_db(verbosity=0)
+        try:
+            cookies = [create_user(i) for i in range(options["users"])]
+            connection.close()
+            results = []
+            for workers in worker_counts:
+                # Each run books the same slots from scratch.
+                Appointment.objects.all().delete()
+                connection.close()
+                self.boxes = {}
+                self.fanned_out = []
+                stats, wall = self.run_workers(workers, test_db, cookies, options)
+                self.stdout.write(f"--- {workers} worker(s)")
+                self.report(stats, 0, wall, options)
+                if self.fanned_out:
+                    self.stdout.write(
+                        f"{'fan-out':>22}: {len(self.fanned_out)} answers to "
+                        f"{options['users'] - len(self.boxes)} listeners, "
+                        f"p50 {percentile(self.fanned_out, 0.5) * 1000:.1f} ms "
+                        "from the question to the listener's answer"
+                    )
+                turns = sum(len(values) for values in stats.turn.values())
+                results.append((workers, turns / wall))
+        finally:
+            connection.creation.destroy_test_db(test_db, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+        self.stdout.write("--- scaling")
+        for workers, throughput in results:
+            self.stdout.write(
+                f"{workers:>3} worker(s): {throughput:.1f} turns/s "
+                f"({throughput / results[0][1]:.2f}x)"
+            )
+
+    def start_fake_redis(self):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError("--fake-redis requires fakeredis[lua]")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        server = TcpFakeServer(("127.0.0.1", port))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f"redis://127.0.0.1:{port}/0"
+
+    def run_workers(self, workers, database, cookies, options):
+        ports = [options["base_port"] + i for i in range(workers)]
+        arguments = [
+            f"--database={database}",
+            # As in bench_chat_load: measure bookings, not slot conflicts.
+            f"--appointment-capacity={options['users'] * options['turns']}",
+        ]
+        for name in FAKE_BACKEND_OPTIONS:
+            arguments.append(f"--{name.replace('_', '-')}={options[name]}")
+        if options["response_cache"]:
+            arguments.append("--response-cache")
+        if options["completion_cache"]:
+            arguments.append("--completion-cache")
+        if options["no_coalesce"]:
+            arguments.append("--no-coalesce")
+        output = None if options["verbosity"] > 1 else subprocess.DEVNULL
+        processes = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    str(settings.BASE_DIR / "manage.py"),
+                    "bench_workers",
+                    f"--serve-port={port}",
+                    *arguments,
+                ],
+                stdout=output,
+                stderr=output,
+            )
+            for port in ports
+        ]
+        try:
+            for port in ports:
+                wait_for_port(port, options["timeout"])
+            stats, _, wall = asyncio.run(self.run_clients(ports, cookies, options))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+        return stats, wall
+
+    async def run_clients(self, ports, cookies, options):
+        self.box_size = options["box_size"]
+        flows = options["flows"].split(",")
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await self.run((session, ports), cookies, flows, options)
+
+    def open_connection(self, target, number, cookie):
+        # Users are spread round-robin, as a load balancer would, so the
+        # consecutive members of a chat box end up on different workers.
+        session, ports = target
+        port = ports[number % len(ports)]
+        box = number // self.box_size
+        client = WebsocketClient(
+            session, f"ws://127.0.0.1:{port}/ws/chat/loadtest{box}/", cookie
+        )
+        client.box = box
+        return client
+
+    def join_box(self, number, options):
+        box = number // self.box_size
+        members = min(self.box_size, options["users"] - box * self.box_size)
+        state = self.boxes.setdefault(box, {"joined": 0, "full": asyncio.Event()})
+        state["joined"] += 1
+        if state["joined"] == members:
+            state["full"].set()
+
+    async def user(self, target, number, cookie, flows, options, stats, on_connected):
+        def joined():
+            on_connected()
+            self.join_box(number, options)
+
+        if number % self.box_size:
+            await self.listener(target, number, cookie, options, stats, joined)
+        else:
+            await super().user(target, number, cookie, flows, options, stats, joined)
+
+    async def turn(self, communicator, flow, stats, timeout):
+        # Listeners that have not joined yet would miss the answer.
+        state = self.boxes[communicator.box]
+        await asyncio.wait_for(state["full"].wait(), timeout)
+        state["asked"] = time.perf_counter()
+        await super().turn(communicator, flow, stats, timeout)
+
+    async def listener(self, target, number, cookie, options, stats, joined):
+        """Receive the answers to every question of the box's first member."""
+        await asyncio.sleep(options["ramp_up"] * number / options["users"])
+        communicator = self.open_connection(target, number, cookie)
+        timeout = options["timeout"]
+        start = time.perf_counter()
+        try:
+            try:
+                await communicator.connect(timeout)
+                while True:
+                    frame = json.loads(await communicator.receive_from(timeout))
+                    if frame["message"] == "Ready to accept questions":
+                        break
+                stats.connect.append(time.perf_counter() - start)
+            finally:
+                joined()
+            answers = 0
+            while answers < options["turns"]:
+                frame = json.loads(await communicator.receive_from(timeout))
+                if frame["username"] != "bot":
+                    continue
+                if frame["type"] in ("end", "clarification"):
+                    asked = self.boxes[communicator.box]["asked"]
+                    self.fanned_out.append(time.perf_counter() - asked)
+                    answers += 1
+                elif frame["type"] == "error":
+                    raise RuntimeError(frame["message"])
+            await communicator.disconnect()
+        except Exception as e:
+            stats.errors[f"listener: {e!r}"] += 1
+
+    def serve(self, options):
+        from daphne.endpoints import build_endpoint_description_strings
+        from daphne.server import Server
+
+        connection.settings_dict["NAME"] = options["database"]
+        settings.CHATBOT_APPOINTMENT_CAPACITY = options["appointment_capacity"]
+        if options["no_coalesce"]:
+            settings.CHATBOT_COALESCE_LLM_CALLS = False
+        set_registry(LoadTestRegistry(options))
+        install_admission(options)
+        from config.asgi import application
+
+        Server(
+            application,
+            endpoints=build_endpoint_description_strings(
+                host="127.0.0.1", port=options["serve_port"]
+            ),
+            verbosity=0,
+        ).run()
@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.chatbot.lexical_index import BM25Index
+
+from .build_vector_index import VECTOR_DB_DIR, open_collection
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the BM25 index of the conditions collection used with "
+        "CHATBOT_HYBRID_RETRIEVAL"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--vector-db", default=str(VECTOR_DB_DIR))
+        parser.add_argument("--collection", default="conditions")
+        parser.add_argument("--output", default=str(settings.CHATBOT_LEXICAL_INDEX_DIR))
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        collection = open_collection(options["vector_db"], options["collection"])
+        index = BM25Index.from_chroma(collection)
+        index.save(options["output"])
+        self.stdout.write(
+            f"Wrote {len(index)} documents, {len(index.terms)} terms and "
+            f"{len(index.postings)} postings to {options['output']} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
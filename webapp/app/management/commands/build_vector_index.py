@@ -0,0 +1,64 @@
+import os
+import time
+
+import chromadb
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app.chatbot.vector_index import NumpyVectorIndex
+
+VECTOR_DB_DIR = settings.BASE_DIR.parent / "vector_db"
+
+
+def read_only(texts):
+    raise CommandError("The collection is only read, nothing should be embedded")
+
+
+def open_collection(vector_db, name):
+    """The persisted Chroma collection, without loading an embedding model."""
+    if not os.path.isdir(vector_db):
+        raise CommandError(
+            f"{vector_db} does not exist, run "
+            "utils/write_data_to_vector_db.py ingest first"
+        )
+    client = chromadb.Client(
+        chromadb.config.Settings(
+            chroma_db_impl="duckdb+parquet",
+            persist_directory=vector_db,
+            anonymized_telemetry=False,
+        )
+    )
+    # Chroma falls back to a local SentenceTransformer model when no
+    # embedding function is given.
+    return client.get_collection(name, embedding_function=read_only)
+
+
+class Command(BaseCommand):
+    help = (
+        "Copies the conditions collection from Chroma into the NumPy index "
+        "used with CHATBOT_VECTOR_INDEX = 'numpy'"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--vector-db", default=str(VECTOR_DB_DIR))
+        parser.add_argument("--collection", default="conditions")
+        parser.add_argument("--output", default=str(settings.CHATBOT_VECTOR_INDEX_DIR))
+        parser.add_argument(
+            "--clusters",
+            type=int,
+            default=0,
+            help="k-means clusters for approximate search, e.g. sqrt(documents)",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        collection = open_collection(options["vector_db"], options["collection"])
+        index = NumpyVectorIndex.from_chroma(collection, embedding=None)
+        if options["clusters"]:
+            index.build_clusters(options["clusters"])
+        index.save(options["output"])
+        self.stdout.write(
+            f"Wrote {len(index)} documents x {index.vectors.shape[1]} dimensions "
+            f"({index.vectors.nbytes / 2**20:.1f} MiB) to {options['output']} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
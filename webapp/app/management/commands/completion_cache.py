@@ -0,0 +1,76 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from app.models import CompletionCacheEntry
+
+
+class Command(BaseCommand):
+    help = (
+        "Inspects or purges the completion cache. Running workers keep their "
+        "in-memory copies until they expire."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["stats", "list", "show", "purge"])
+        parser.add_argument("key", nargs="?", help="Entry key or prefix for show")
+        parser.add_argument("--model", help="Only entries of this LLM type")
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument(
+            "--expired",
+            action="store_true",
+            help="purge: only expired entries and those beyond the size limit",
+        )
+
+    def handle(self, *args, **options):
+        entries = CompletionCacheEntry.objects.all()
+        if options["model"]:
+            entries = entries.filter(model=options["model"])
+        actions = {
+            "stats": self.stats,
+            "list": self.list_entries,
+            "show": self.show,
+            "purge": self.purge,
+        }
+        actions[options["action"]](entries, options)
+
+    def stats(self, entries, options):
+        expired = timezone.now() - timedelta(
+            seconds=settings.CHATBOT_COMPLETION_CACHE_TTL
+        )
+        self.stdout.write(
+            f"{entries.count()} entries "
+            f"(limit {settings.CHATBOT_COMPLETION_CACHE_SIZE}), "
+            f"{entries.filter(created_at__lt=expired).count()} expired"
+        )
+        rows = entries.values("model").annotate(entries=Count("id"), hits=Sum("hits"))
+        for row in rows.order_by("-hits"):
+            self.stdout.write(
+                f"{row['model']:>20}: {row['entries']} entries, {row['hits']} hits"
+            )
+
+    def list_entries(self, entries, options):
+        for entry in entries.order_by("-used_at")[: options["limit"]]:
+            self.stdout.write(
+                f"{entry.key[:12]} {entry.model:>12} {entry.hits:>5} hits "
+                f"{entry.used_at:%Y-%m-%d %H:%M}"
+            )
+
+    def show(self, entries, options):
+        for entry in entries.filter(key__startswith=options["key"] or "")[:1]:
+            self.stdout.write(f"key: {entry.key}\nmodel: {entry.model}")
+            self.stdout.write(f"created: {entry.created_at}, hits: {entry.hits}")
+            self.stdout.write(f"--- result\n{entry.result}")
+
+    def purge(self, entries, options):
+        if options["expired"]:
+            # Only pruning needs the cache itself, which imports langchain.
+            from app.chatbot.completion_cache import get_completion_cache
+
+            deleted = get_completion_cache().prune()
+        else:
+            deleted, _ = entries.delete()
+        self.stdout.write(f"Deleted {deleted} entries")
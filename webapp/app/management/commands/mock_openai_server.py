@@ -0,0 +1,32 @@
+from aiohttp import web
+from django.core.management.base import BaseCommand
+
+from app.chatbot.mock_openai import MockOpenAIServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves a local OpenAI-compatible API for load tests; point the app "
+        "at it with OPENAI_API_BASE=http://127.0.0.1:<port>/v1"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8400)
+        parser.add_argument("--latency", type=float, default=0.2)
+        parser.add_argument("--tokens-per-second", type=float, default=50.0)
+        parser.add_argument("--answer-tokens", type=int, default=50)
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Fraction of requests answered with 503",
+        )
+
+    def handle(self, *args, **options):
+        server = MockOpenAIServer(
+            latency=options["latency"],
+            tokens_per_second=options["tokens_per_second"],
+            answer_tokens=options["answer_tokens"],
+            error_rate=options["error_rate"],
+        )
+        web.run_app(server.make_app(), host="127.0.0.1", port=options["port"])
@@ -0,0 +1,103 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What each kind of process imports before it can serve. Importing
+# config.asgi, as daphne does, also starts the warm-up when CHATBOT_WARM_UP.
+TARGETS = {
+    "setup": "import django; django.setup()",
+    "http": "import django; django.setup(); import config.urls",
+    "asgi": (
+        "import json, config.asgi; "
+        "from app.chatbot.warmup import wait_for_warm_up, warm_up_timings; "
+        "from django.conf import settings; "
+        "settings.CHATBOT_WARM_UP and wait_for_warm_up(); "
+        "print('TIMINGS', json.dumps(warm_up_timings()))"
+    ),
+}
+
+
+def parse_importtime(stderr):
+    """(module, self us, cumulative us, depth) of ``-X importtime`` lines."""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(own), int(cumulative), depth))
+    return modules
+
+
+class Command(BaseCommand):
+    help = (
+        "Profiles process startup: import time per package of the setup, "
+        "HTTP and ASGI import paths, and the duration of each warm-up step"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--targets", nargs="+", choices=list(TARGETS), default=list(TARGETS)
+        )
+        parser.add_argument("--top", type=int, default=10)
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        for target in options["targets"]:
+            start = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", TARGETS[target]],
+                cwd=settings.BASE_DIR,
+                env=env,
+                capture_output=True,
+                text=True,
+            )
+            wall = time.perf_counter() - start
+            if process.returncode:
+                errors = [
+                    line
+                    for line in process.stderr.splitlines()
+                    if not line.startswith("import time:")
+                ]
+                raise CommandError(f"{target} failed:\n" + "\n".join(errors[-20:]))
+            self.report(target, wall, parse_importtime(process.stderr), options)
+            for line in process.stdout.splitlines():
+                if line.startswith("TIMINGS ") and line != "TIMINGS {}":
+                    timings = json.loads(line[len("TIMINGS ") :])
+                    self.stdout.write(
+                        f"  warm-up {sum(timings.values()) * 1000:.0f} ms: "
+                        + ", ".join(
+                            f"{name} {seconds * 1000:.0f} ms"
+                            for name, seconds in timings.items()
+                        )
+                    )
+
+    def report(self, target, wall, modules, options):
+        packages = Counter()
+        for name, own, _, _ in modules:
+            packages[name.split(".")[0]] += own
+        total = sum(packages.values())
+        self.stdout.write(
+            f"{target}: {wall:.2f}s wall, {total / 1e6:.2f}s importing "
+            f"{len(modules)} modules"
+        )
+        top = ", ".join(
+            f"{package} {own / 1e3:.0f} ms"
+            for package, own in packages.most_common(options["top"])
+        )
+        self.stdout.write(f"  by package: {top}")
+        # The entry points and what they import directly, by cumulative time.
+        direct = sorted(
+            (m for m in modules if m[3] <= 1), key=lambda m: m[2], reverse=True
+        )
+        top = ", ".join(
+            f"{name} {cumulative / 1e3:.0f} ms"
+            for name, _, cumulative, _ in direct[: options["top"]]
+        )
+        self.stdout.write(f"  top level: {top}")
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 00:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_conversationturn'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('model', models.CharField(max_length=100)),
+                ('result', models.TextField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('used_at', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -11,11 +11,46 @@ class Appointment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["date", "time"], name="appointment_slot_idx")]
+
     def __str__(self) -> str:
         return f"{self.name} on {self.date} at {self.time}"
 
 
-def create_appointment(json_object):
+class ConversationTurn(models.Model):
+    HISTORY = "history"
+    MEMORY = "memory"
+    KIND_CHOICES = [
+        (HISTORY, "Chat history"),
+        (MEMORY, "Appointment memory"),
+    ]
+    session_key = models.CharField(max_length=255, db_index=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    question = models.TextField()
+    answer = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f"{self.session_key} {self.kind} turn at {self.created_at}"
+
+
+class CompletionCacheEntry(models.Model):
+    """A temperature-0 LLM completion, keyed by a hash of model and prompt."""
+
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=100)
+    result = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    used_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self) -> str:
+        return f"{self.model} completion {self.key[:12]}"
+
+
+def build_appointment(json_object):
+    """Validate the fields of an appointment and return it unsaved."""
     try:
         name = json_object["name"]
         date_str = json_object["date"]
@@ -23,9 +58,16 @@ def create_appointment(json_object):
         time_str = json_object["time"]
         time = datetime.strptime(time_str, "%H:%M").time()
         description = json_object["description"]
-        obj = Appointment.objects.create(
-            name=name, date=date, time=time, description=description
-        )
+        return Appointment(name=name, date=date, time=time, description=description)
+    except Exception as e:
+        print("Exception in create_appointment: ", e)
+        raise ValueError(e)
+
+
+def create_appointment(json_object):
+    obj = build_appointment(json_object)
+    try:
+        obj.save()
         return obj
     except Exception as e:
         print("Exception in create_appointment: ", e)
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .chatbot.slots import loaded_slot_index
+from .models import Appointment
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in getattr(settings, "SQLITE_PRAGMAS", {}).items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+@receiver(post_save, sender=Appointment)
+def index_appointment_slot(sender, instance, **kwargs):
+    slots = loaded_slot_index()
+    if slots is not None:
+        slots.add(instance)
+
+
+@receiver(post_delete, sender=Appointment)
+def unindex_appointment_slot(sender, instance, **kwargs):
+    slots = loaded_slot_index()
+    if slots is not None:
+        slots.remove(instance.pk)
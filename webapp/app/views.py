@@ -1,6 +1,44 @@
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
 
+from .chatbot.admission import get_admission
+from .chatbot.appointment_store import get_appointment_writer
+from .chatbot.metrics import get_metrics
+from .chatbot.slots import render_slots
+from .chatbot.warmup import is_ready, render_warmup, warm_up_timings
+from patient.profiles import render_profile_cache
+
 
 def chat_box(request):
     # we will get the chatbox name from the url
     return render(request, "index.html")
+
+
+def metrics(request):
+    # Imported here so that the URLconf, loaded by the admin and by every
+    # management command's checks, does not pull in langchain.
+    from .chatbot.coalesce import get_single_flight
+    from .chatbot.completion_cache import get_completion_cache
+    from .chatbot.registry import render_registry
+
+    # Prometheus text exposition format.
+    return HttpResponse(
+        get_metrics().render()
+        + get_admission().render()
+        + get_single_flight().render()
+        + get_completion_cache().render()
+        + render_registry()
+        + get_appointment_writer().render()
+        + render_slots()
+        + render_profile_cache()
+        + render_warmup(),
+        content_type="text/plain; version=0.0.4",
+    )
+
+
+def ready(request):
+    # For load balancers: 503 until the startup warm-up has run.
+    return JsonResponse(
+        {"ready": is_ready(), "warm_up": warm_up_timings()},
+        status=200 if is_ready() else 503,
+    )
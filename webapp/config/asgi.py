@@ -9,19 +9,29 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 from django.urls import re_path
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from dotenv import load_dotenv
 
-from app import consumers
-
 load_dotenv()
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
+# Set up Django before the chat stack below imports any models.
 asgi_app = get_asgi_application()
 
+from app import consumers  # noqa: E402
+from app.chatbot.openai_client import OpenAISessionMiddleware  # noqa: E402
+from app.chatbot.warmup import start_warm_up  # noqa: E402
+
+# Load the vector store, tokenizers and prompts while daphne starts
+# listening, so the first connection does not pay for them; /ready/
+# answers 503 until that is done.
+if settings.CHATBOT_WARM_UP:
+    start_warm_up()
+
 # URLs that handle the WebSocket connection are placed here.
 websocket_urlpatterns = [
     re_path(r"^ws/chat/(?P<chat_box_name>\w+)/$", consumers.ChatRoomConsumer.as_asgi()),
@@ -30,8 +40,10 @@ websocket_urlpatterns = [
 application = ProtocolTypeRouter(
     {
         "http": asgi_app,
-        "websocket": AuthMiddlewareStack(
-            AuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+        "websocket": OpenAISessionMiddleware(
+            AuthMiddlewareStack(
+                AuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+            )
         ),
     }
 )
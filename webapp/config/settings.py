@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -81,9 +82,19 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Seconds a connection waits for another one's write lock.
+        "OPTIONS": {"timeout": 20},
     }
 }
 
+# Applied to every new SQLite connection (see app/signals.py); the sqlite3
+# backend hands OPTIONS straight to sqlite3.connect, which has no PRAGMAs.
+# WAL lets readers run while the appointment writer holds the write lock.
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -127,4 +138,158 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 ASGI_APPLICATION = "config.asgi.application"
-CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+# A single process keeps its groups in memory. To run several daphne workers
+# behind a load balancer point CHANNEL_LAYER_URL at a shared Redis, e.g.
+# redis://localhost:6379/0 (requires channels_redis).
+CHANNEL_LAYER_URL = os.environ.get("CHANNEL_LAYER_URL", "")
+if CHANNEL_LAYER_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                # receive() blocks for up to 5 s (brpop_timeout); redis-py's
+                # default 5 s read timeout would race it and kill the consumer.
+                "hosts": [{"address": CHANNEL_LAYER_URL, "socket_timeout": 15}],
+                "capacity": 1000,
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+# Health profile snapshots (patient/profiles.py) and other shared state. The
+# default local memory cache is per process; set CACHE_URL to a Redis URL to
+# share it between daphne workers.
+CACHE_URL = os.environ.get("CACHE_URL", "")
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
+
+# Conversation state kept per chat box and user.
+# Backend is either "memory" (per process) or "database" (ConversationTurn rows).
+CHAT_SESSION_BACKEND = "memory"
+CHAT_SESSION_MAX_SESSIONS = 10000
+CHAT_SESSION_IDLE_TIMEOUT = 30 * 60
+CHAT_HISTORY_TOKEN_LIMIT = 1500
+
+# Messages classified locally below this confidence go to the intents LLM chain.
+CHATBOT_INTENT_CONFIDENCE = 0.6
+
+# On-disk embedding cache shared with utils/write_data_to_vector_db.py.
+CHATBOT_EMBEDDING_CACHE_DIR = BASE_DIR.parent / "embedding_cache"
+
+# Semantic cache of symptoms answers, shared by users with identical health data.
+CHATBOT_RESPONSE_CACHE_THRESHOLD = 0.95
+CHATBOT_RESPONSE_CACHE_TTL = 24 * 60 * 60
+CHATBOT_RESPONSE_CACHE_SIZE = 5000
+
+# Streamed tokens are batched into one WebSocket frame per interval (seconds)
+# or per this many characters. Set the interval to 0 to send every token.
+CHATBOT_STREAM_FLUSH_INTERVAL = 0.03
+CHATBOT_STREAM_MAX_BYTES = 512
+
+# Per-turn stage timings are served at /metrics/. Set a path to also append
+# every turn to a JSON Lines trace file.
+CHATBOT_TRACE_FILE = None
+
+# Connection pools shared by all OpenAI requests, see app/chatbot/openai_client.py.
+# Failed requests are retried with jittered exponential backoff (seconds).
+# Set the OPENAI_API_BASE environment variable to use a local mock server
+# (manage.py mock_openai_server).
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_MAX_CONNECTIONS_PER_HOST = 50
+OPENAI_KEEPALIVE_TIMEOUT = 30
+OPENAI_REQUEST_TIMEOUT = 60
+OPENAI_MAX_RETRIES = 3
+OPENAI_RETRY_BACKOFF = 0.5
+OPENAI_RETRY_MAX_BACKOFF = 8
+
+# Admission control, see app/chatbot/admission.py. At most
+# CHATBOT_MAX_CONCURRENT_TURNS turns per process call the LLM at once; the rest
+# wait and are let in round robin across users. Each user may send
+# CHATBOT_RATE_LIMIT_PER_MINUTE messages (0 disables the limit) in bursts of
+# CHATBOT_RATE_LIMIT_BURST. While a reply streams, up to
+# CHATBOT_SESSION_QUEUE_SIZE further messages of the chat box wait for it and
+# any more are rejected.
+CHATBOT_MAX_CONCURRENT_TURNS = 32
+CHATBOT_RATE_LIMIT_PER_MINUTE = 20
+CHATBOT_RATE_LIMIT_BURST = 5
+CHATBOT_SESSION_QUEUE_SIZE = 1
+
+# Identical concurrent LLM calls (same rendered prompt and model parameters)
+# share one request, see app/chatbot/coalesce.py.
+CHATBOT_COALESCE_LLM_CALLS = True
+
+# Exact-match cache of temperature-0 LLM completions: an in-memory LRU of
+# CHATBOT_COMPLETION_CACHE_MEMORY_SIZE entries in front of at most
+# CHATBOT_COMPLETION_CACHE_SIZE database rows, kept for TTL seconds.
+# Inspect or purge it with manage.py completion_cache.
+CHATBOT_COMPLETION_CACHE = True
+CHATBOT_COMPLETION_CACHE_TTL = 7 * 24 * 60 * 60
+CHATBOT_COMPLETION_CACHE_SIZE = 20000
+CHATBOT_COMPLETION_CACHE_MEMORY_SIZE = 2000
+
+# Retriever of the symptoms chain: "chroma" queries vector_db through Chroma,
+# "numpy" searches an in-memory copy built by manage.py build_vector_index.
+# With CHATBOT_VECTOR_INDEX_NPROBE > 0 and clusters in the index, only that
+# many of the nearest clusters are searched (approximate).
+CHATBOT_VECTOR_INDEX = "chroma"
+CHATBOT_VECTOR_INDEX_DIR = BASE_DIR.parent / "vector_index"
+CHATBOT_VECTOR_INDEX_NPROBE = 0
+
+# Hybrid retrieval: a BM25 index of the MedQuAD questions and focuses, built
+# by manage.py build_lexical_index or the ingest script, is searched first.
+# Queries whose best lexical match reaches CHATBOT_HYBRID_LEXICAL_CONFIDENCE
+# (about 1.0 when a question contains every query term) skip the embedding
+# call; the others merge lexical and vector results by reciprocal rank.
+CHATBOT_HYBRID_RETRIEVAL = False
+CHATBOT_LEXICAL_INDEX_DIR = BASE_DIR.parent / "lexical_index"
+CHATBOT_HYBRID_LEXICAL_CONFIDENCE = 0.9
+CHATBOT_HYBRID_RRF_K = 60
+
+# Tokens of retrieved documents stuffed into the symptoms prompt. Repeated
+# sentences are dropped and, over budget, answers are trimmed to the
+# sentences closest to the question. 0 stuffs whole documents.
+CHATBOT_CONTEXT_TOKEN_BUDGET = 1200
+
+# Appointment requests whose title, date and time are all found by the local
+# extractor skip the appointment LLM; otherwise the LLM fills what is missing.
+CHATBOT_APPOINTMENT_FAST_PATH = True
+
+# Appointments are inserted by a background thread, in one bulk_create per
+# CHATBOT_APPOINTMENT_WRITE_WINDOW seconds or CHATBOT_APPOINTMENT_WRITE_BATCH
+# appointments, whichever comes first.
+CHATBOT_APPOINTMENT_WRITE_WINDOW = 0.005
+CHATBOT_APPOINTMENT_WRITE_BATCH = 100
+
+# Appointment slots: every appointment lasts CHATBOT_APPOINTMENT_MINUTES and
+# at most CHATBOT_APPOINTMENT_CAPACITY may overlap; bookings over capacity
+# are rejected with the next CHATBOT_FREE_SLOTS_OFFERED free times. Free
+# times are offered within CHATBOT_CLINIC_HOURS on CHATBOT_CLINIC_WEEKDAYS
+# (Monday is 0). Checked against an in-memory index of this process.
+CHATBOT_APPOINTMENT_MINUTES = 30
+CHATBOT_APPOINTMENT_CAPACITY = 1
+CHATBOT_CLINIC_HOURS = (8, 19)
+CHATBOT_CLINIC_WEEKDAYS = (0, 1, 2, 3, 4)
+CHATBOT_FREE_SLOTS_OFFERED = 3
+
+# Formatted health profiles are cached per user for this many seconds and
+# dropped whenever the profile is saved or deleted.
+CHATBOT_PROFILE_CACHE_TTL = 24 * 60 * 60
+
+# config/asgi.py loads the Chroma index, tiktoken encodings, prompts and slot
+# index in a background thread; /ready/ answers 503 until it is done.
+# Without warm-up everything is loaded by the first connection instead.
+CHATBOT_WARM_UP = True
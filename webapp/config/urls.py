@@ -1,8 +1,10 @@
 from django.contrib import admin
 from django.urls import path
-from app.views import chat_box
+from app.views import chat_box, metrics, ready
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("chat/", chat_box, name="chat"),
+    path("metrics/", metrics, name="metrics"),
+    path("ready/", ready, name="ready"),
 ]
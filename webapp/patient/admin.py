@@ -7,6 +7,7 @@ from .models import HealthProfile
 @admin.register(HealthProfile)
 class HealthProfileAdmin(admin.ModelAdmin):
     list_display = ("get_username", "weight", "height", "age")
+    list_select_related = ("user",)
 
     def get_username(self, obj):
         return obj.user.username
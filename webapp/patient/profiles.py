@@ -0,0 +1,79 @@
+"""Cached health profile snapshots, the text the symptoms prompt receives.
+
+Every connection used to load ``user.healthprofile`` and format it. The
+text is now kept in the Django cache per user, so it is shared by the
+workers when the cache is Redis, and dropped by the HealthProfile
+signals in patient/signals.py. A snapshot also records the day it was
+made, since the age in it changes on birthdays.
+"""
+from datetime import date
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import HealthProfile
+
+KEY = "health_profile:{}"
+
+
+class ProfileCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chatbot_profile_cache_requests_total Health profile lookups by result.",
+            "# TYPE chatbot_profile_cache_requests_total counter",
+            f'chatbot_profile_cache_requests_total{{result="hit"}} {self.hits}',
+            f'chatbot_profile_cache_requests_total{{result="miss"}} {self.misses}',
+            "# HELP chatbot_profile_cache_invalidations_total Snapshots dropped on profile changes.",
+            "# TYPE chatbot_profile_cache_invalidations_total counter",
+            f"chatbot_profile_cache_invalidations_total {self.invalidations}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+stats = ProfileCacheStats()
+
+
+def format_profile(prof: HealthProfile) -> str:
+    return f"""User health data:
+    Gender: {prof.gender};
+    Age: {prof.age};
+    Weight: {prof.weight} kilograms;
+    Height: {prof.height} centimeters;
+    Health condition notes: {prof.health_conditions_notes}"""
+
+
+def get_profile_snapshot(user_id: int) -> str:
+    """The formatted health profile of ``user_id``, from the cache if fresh.
+
+    Raises HealthProfile.DoesNotExist for users without a profile.
+    """
+    today = date.today().isoformat()
+    snapshot = cache.get(KEY.format(user_id))
+    if snapshot is not None and snapshot[0] == today:
+        stats.hits += 1
+        return snapshot[1]
+    stats.misses += 1
+    text = format_profile(HealthProfile.objects.get(user_id=user_id))
+    cache.set(KEY.format(user_id), (today, text), settings.CHATBOT_PROFILE_CACHE_TTL)
+    return text
+
+
+# Cache hits need no database connection, so skip the single sync thread.
+aget_profile_snapshot = database_sync_to_async(
+    get_profile_snapshot, thread_sensitive=False
+)
+
+
+def invalidate_profile_snapshot(user_id: int) -> None:
+    stats.invalidations += 1
+    cache.delete(KEY.format(user_id))
+
+
+def render_profile_cache() -> str:
+    return stats.render()
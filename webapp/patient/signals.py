@@ -0,0 +1,17 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import HealthProfile
+from .profiles import invalidate_profile_snapshot
+
+
+@receiver(post_save, sender=HealthProfile)
+@receiver(post_delete, sender=HealthProfile)
+def drop_profile_snapshot(sender, instance, using, **kwargs):
+    # A reader between the save and the commit would cache the old row again.
+    transaction.on_commit(
+        partial(invalidate_profile_snapshot, instance.user_id), using=using
+    )